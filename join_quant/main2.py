@@ -432,18 +432,8 @@ def calc_signal(context, future, day) -> List[TradeSignal]:
 
     # 计算技术指标
     df["atr"] = calculate_atr(df.high, df.low, df.close, period=atr_n)  # 真实波动幅度
-    df["short_trend"] = df.close  # 短期均线
-    df["long_trend"] = df.close   # 长期均线
-            
-    # 手动计算移动平均线
-    for idx in range(1, df.shape[0]): # 手动计算SMA
-        df.short_trend[idx] = (df.short_trend[idx-1] * (short_n - 1) + df.close[idx]) / short_n
-        df.long_trend[idx] = (df.long_trend[idx-1] * (long_n - 1) + df.close[idx]) / long_n
-        
-        if pd.isna(df.short_trend[idx-1]):
-            df.short_trend[idx] = df.close[idx]
-        if pd.isna(df.long_trend[idx-1]):
-            df.long_trend[idx] = df.close[idx]
+    df["short_trend"] = calculate_wilder_average(df.close, short_n)  # 短期均线
+    df["long_trend"] = calculate_wilder_average(df.close, long_n)    # 长期均线
 
 
     # 计算突破指标
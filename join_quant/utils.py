@@ -100,6 +100,30 @@ def calculate_atr(high, low, close, period=14):
     return atr
 
 
+def calculate_wilder_average(values, period):
+    """
+    计算平滑移动平均: y[0] = x[0], y[i] = (y[i-1] * (period-1) + x[i]) / period
+    前一个值为NaN时从当前值重新开始
+
+    参数:
+    values: 价格数组
+    period: 计算周期
+
+    返回:
+    平滑移动平均数组
+    """
+    values = np.asarray(values, dtype=float).tolist()
+    result = np.empty(len(values))
+    if len(values) == 0:
+        return result
+    prev = values[0]
+    result[0] = prev
+    for i in range(1, len(values)):
+        prev = values[i] if np.isnan(prev) else (prev * (period - 1) + values[i]) / period
+        result[i] = prev
+    return result
+
+
 def price_round(x: Decimal, base: Decimal):
     """
     根据最小精度取整，例如对于IF最小精度是0.2，那么 1.3 -> 1.2, 1.5 -> 1.4
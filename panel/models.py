@@ -17,6 +17,7 @@ import pandas as pd
 from pandas.io.sql import read_sql_query
 from django.db import models
 from django.db import connection
+from django.db.models.functions import Coalesce
 from django.core.exceptions import EmptyResultSet
 
 from .const import *
@@ -191,6 +192,37 @@ class Signal(models.Model):
                f"{'(夜)' if self.instrument.night_trade else ''}"
 
 
+MAIN_BAR_PRICE_FIELDS = ['open', 'high', 'low', 'close', 'settlement']
+
+
+class MainBarQuerySet(models.QuerySet):
+    def adjusted(self):
+        """
+        后复权: 每根K线加上其后所有换月基差之和, 复权价格为 adj_open/adj_high/adj_low/adj_close/adj_settlement
+        MainBar 中保存的是原始价格, 换月只需在 MainBarAdjust 插入一行
+        """
+        adjust = MainBarAdjust.objects.filter(
+            exchange=models.OuterRef('exchange'), product_code=models.OuterRef('product_code'),
+            time__gt=models.OuterRef('time')).order_by().values('product_code').annotate(
+            total=models.Sum('basis')).values('total')
+        price_field = models.DecimalField(max_digits=12, decimal_places=3)
+        return self.annotate(
+            adjust=Coalesce(models.Subquery(adjust, output_field=price_field), models.Value(0), output_field=price_field),
+        ).annotate(**{f'adj_{field}': models.ExpressionWrapper(
+            models.F(field) + models.F('adjust'), output_field=price_field) for field in MAIN_BAR_PRICE_FIELDS})
+
+    def adjusted_df(self, *fields, limit: int = None, index_col=None, parse_dates=None):
+        """
+        同 to_df(queryset.values_list(*fields)), 价格字段取复权后的值, 列名不变
+        :param limit: 只取排序后的前 limit 条
+        """
+        queryset = self.adjusted().values_list(*[f'adj_{f}' if f in MAIN_BAR_PRICE_FIELDS else f for f in fields])
+        if limit is not None:
+            queryset = queryset[:limit]
+        df = to_df(queryset, index_col=index_col, parse_dates=parse_dates)
+        return df.rename(columns={f'adj_{f}': f for f in MAIN_BAR_PRICE_FIELDS})
+
+
 class MainBar(models.Model):
     exchange = models.CharField('交易所', max_length=8, choices=ExchangeType.choices)
     product_code = models.CharField('品种代码', max_length=8, null=True, db_index=True)
@@ -205,17 +237,42 @@ class MainBar(models.Model):
     open_interest = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='持仓量')
     basis = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='基差', null=True)
 
+    objects = MainBarQuerySet.as_manager()
+
     class Meta:
         verbose_name = '主力连续日K线'
         verbose_name_plural = '主力连续日K线列表'
+        constraints = [
+            models.UniqueConstraint(fields=['exchange', 'product_code', 'time'],
+                                    name='unique_mainbar_exchange_product_time'),
+        ]
 
     def __str__(self):
         return '{}.{}'.format(self.exchange, self.product_code)
 
 
+class MainBarAdjust(models.Model):
+    exchange = models.CharField('交易所', max_length=8, choices=ExchangeType.choices)
+    product_code = models.CharField('品种代码', max_length=8)
+    time = models.DateField('换月日期')
+    basis = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='基差')
+
+    class Meta:
+        verbose_name = '主力换月'
+        verbose_name_plural = '主力换月列表'
+        constraints = [
+            models.UniqueConstraint(fields=['exchange', 'product_code', 'time'],
+                                    name='unique_mainbaradjust_exchange_product_time'),
+        ]
+
+    def __str__(self):
+        return '{}.{}'.format(self.product_code, self.time)
+
+
 class DailyBar(models.Model):
     exchange = models.CharField('交易所', max_length=8, choices=ExchangeType.choices)
     code = models.CharField('品种代码', max_length=16, null=True, db_index=True)
+    product_code = models.CharField('品种', max_length=8, null=True)
     expire_date = models.IntegerField('交割时间', null=True)
     time = models.DateField('时间', db_index=True)
     open = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='开盘价')
@@ -229,11 +286,54 @@ class DailyBar(models.Model):
     class Meta:
         verbose_name = '日K线'
         verbose_name_plural = '日K线列表'
+        constraints = [
+            models.UniqueConstraint(fields=['exchange', 'code', 'time'], name='unique_dailybar_exchange_code_time'),
+        ]
+        indexes = [
+            models.Index(fields=['exchange', 'product_code', 'time', 'volume'], name='dailybar_product_time_volume'),
+            models.Index(fields=['code', 'time'], name='dailybar_code_time'),
+        ]
 
     def __str__(self):
         return '{}.{}'.format(self.exchange, self.code)
 
 
+class BackfillCheckpoint(models.Model):
+    exchange = models.CharField('交易所', max_length=8, choices=ExchangeType.choices)
+    day = models.DateField('日期')
+    bar_count = models.IntegerField('K线数量', default=0)
+    update_time = models.DateTimeField('完成时间', auto_now=True)
+
+    class Meta:
+        verbose_name = '回补进度'
+        verbose_name_plural = '回补进度列表'
+        constraints = [
+            models.UniqueConstraint(fields=['exchange', 'day'], name='unique_backfillcheckpoint_exchange_day'),
+        ]
+
+    def __str__(self):
+        return '{}.{}'.format(self.exchange, self.day)
+
+
+class HandledTrade(models.Model):
+    exchange = models.CharField('交易所', max_length=8, choices=ExchangeType.choices)
+    trade_date = models.CharField('成交日期', max_length=8)
+    trade_id = models.CharField('成交编号', max_length=32)
+    order_ref = models.CharField('报单引用', max_length=13, null=True, blank=True)
+    handle_time = models.DateTimeField('处理时间', auto_now_add=True)
+
+    class Meta:
+        verbose_name = '已处理成交'
+        verbose_name_plural = '已处理成交列表'
+        constraints = [
+            models.UniqueConstraint(fields=['exchange', 'trade_date', 'trade_id'],
+                                    name='unique_handledtrade_exchange_date_trade'),
+        ]
+
+    def __str__(self):
+        return '{}.{}'.format(self.exchange, self.trade_id)
+
+
 class Order(models.Model):
     broker = models.ForeignKey(Broker, verbose_name='账户', on_delete=models.CASCADE)
     strategy = models.ForeignKey(Strategy, verbose_name='策略', on_delete=models.SET_NULL, null=True, blank=True)
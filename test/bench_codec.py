@@ -0,0 +1,61 @@
+"""
+消息编解码速度对比: json / msgpack / struct, 分别测试行情、报单和成交回报
+用法: python test/bench_codec.py [次数]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+
+from trader.utils.codec import get_codec
+
+TICK = {
+    'TradingDay': '20240105', 'InstrumentID': 'rb2405', 'ExchangeID': 'SHFE', 'ExchangeInstID': 'rb2405',
+    'LastPrice': 3985.0, 'PreSettlementPrice': 3990.0, 'PreClosePrice': 3978.0, 'PreOpenInterest': 1652381.0,
+    'OpenPrice': 3980.0, 'HighestPrice': 3998.0, 'LowestPrice': 3971.0, 'Volume': 652381, 'Turnover': 25987463210.0,
+    'OpenInterest': 1668204.0, 'ClosePrice': 0.0, 'SettlementPrice': 0.0, 'UpperLimitPrice': 4309.0,
+    'LowerLimitPrice': 3670.0, 'PreDelta': 0.0, 'CurrDelta': 0.0, 'UpdateTime': '20240105 10:15:32:500',
+    'UpdateMillisec': 500, 'BidPrice1': 3984.0, 'BidVolume1': 312, 'AskPrice1': 3985.0, 'AskVolume1': 85,
+    'BidPrice2': 0.0, 'BidVolume2': 0, 'AskPrice2': 0.0, 'AskVolume2': 0, 'BidPrice3': 0.0, 'BidVolume3': 0,
+    'AskPrice3': 0.0, 'AskVolume3': 0, 'BidPrice4': 0.0, 'BidVolume4': 0, 'AskPrice4': 0.0, 'AskVolume4': 0,
+    'BidPrice5': 0.0, 'BidVolume5': 0, 'AskPrice5': 0.0, 'AskVolume5': 0, 'AveragePrice': 39834.6,
+    'ActionDay': '20240105'}
+ORDER = {
+    'BrokerID': '9999', 'InvestorID': '123456', 'InstrumentID': 'rb2405', 'OrderRef': '000012300045',
+    'Direction': '0', 'CombOffsetFlag': '0', 'LimitPrice': 3985.0, 'VolumeTotalOriginal': 2, 'RequestID': 1024,
+    'FrontID': 1, 'SessionID': 123456789, 'ExchangeID': 'SHFE', 'OrderSysID': '     1234567',
+    'OrderSubmitStatus': '3', 'OrderStatus': '0', 'VolumeTraded': 2, 'VolumeTotal': 0, 'InsertDate': '20240105',
+    'InsertTime': '10:15:32', 'StatusMsg': '全部成交'}
+TRADE = {
+    'BrokerID': '9999', 'InvestorID': '123456', 'InstrumentID': 'rb2405', 'OrderRef': '000012300045',
+    'ExchangeID': 'SHFE', 'TradeID': '      987654', 'Direction': '0', 'OrderSysID': '     1234567',
+    'OffsetFlag': '0', 'Price': 3985.0, 'Volume': 2, 'TradeDate': '20240105', 'TradeTime': '10:15:32'}
+MESSAGES = [('行情', 'MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:rb2405', TICK),
+            ('报单', 'MSG:CTP:RSP:TRADE:OnRtnOrder:000012300045', ORDER),
+            ('成交', 'MSG:CTP:RSP:TRADE:OnRtnTrade:000012300045', TRADE)]
+
+
+def bench(codec, channel: str, msg: dict, count: int) -> (int, float, float):
+    data = codec.encode(channel, msg)
+    begin = time.perf_counter()
+    for _ in range(count):
+        codec.encode(channel, msg)
+    encode_time = time.perf_counter() - begin
+    begin = time.perf_counter()
+    for _ in range(count):
+        codec.decode(channel, data)
+    decode_time = time.perf_counter() - begin
+    return len(data), count / encode_time, count / decode_time
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name in ('json', 'msgpack', 'struct'):
+        try:
+            codec = get_codec(name)
+        except ImportError as e:
+            print(f'{name:>8}: 跳过 {repr(e)}')
+            continue
+        for title, channel, msg in MESSAGES:
+            size, encode_rate, decode_rate = bench(codec, channel, msg, count)
+            print(f'{name:>8} {title}: {size:5d}字节 编码 {encode_rate:12,.0f}次/秒 解码 {decode_rate:12,.0f}次/秒')
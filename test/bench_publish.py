@@ -0,0 +1,81 @@
+"""
+报单发布延迟对比: 同步 redis 客户端 vs 异步 aioredis 客户端 vs 异步 pipeline 批量发布
+同时统计事件循环的最大停顿时间(另一个协程每1ms醒来一次, 记录实际醒来时间与预期的差)
+
+用法: python test/bench_publish.py [报单数量] [每批数量]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import asyncio
+import statistics
+
+import ujson as json
+import redis
+import aioredis
+
+from trader.utils.read_config import config
+
+CHANNEL = 'MSG:CTP:REQ:BenchOrderInsert'
+ORDER = {'InstrumentID': 'rb2410', 'VolumeTotalOriginal': 1, 'LimitPrice': 3521.0, 'Direction': '0',
+         'CombOffsetFlag': '0', 'RequestID': 0}
+
+
+def percentile(data: list, p: float) -> float:
+    data = sorted(data)
+    return data[min(len(data) - 1, int(len(data) * p))] * 1000
+
+
+async def watch_loop(lag_list: list, stop: asyncio.Event):
+    while not stop.is_set():
+        begin = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lag_list.append(time.perf_counter() - begin - 0.001)
+
+
+async def run(mode: str, count: int, batch: int, raw_redis: redis.StrictRedis, redis_client: aioredis.Redis):
+    latency = list()
+    lag_list = list()
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(lag_list, stop))
+    await asyncio.sleep(0.01)
+    for i in range(0, count, batch):
+        begin = time.perf_counter()
+        data_list = [json.dumps(dict(ORDER, RequestID=request_id)) for request_id in range(i, min(i + batch, count))]
+        if mode == 'sync':
+            for data in data_list:
+                raw_redis.publish(CHANNEL, data)
+        elif mode == 'async':
+            for data in data_list:
+                await redis_client.publish(CHANNEL, data)
+        else:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for data in data_list:
+                    pipe.publish(CHANNEL, data)
+                await pipe.execute()
+        latency.append((time.perf_counter() - begin) / len(data_list))
+        await asyncio.sleep(0.002)  # 模拟报单之间处理行情的间隔
+    stop.set()
+    await watcher
+    print(f'{mode:>8}: 单笔延迟 p50={percentile(latency, 0.5):.3f}ms p99={percentile(latency, 0.99):.3f}ms '
+          f'平均={statistics.mean(latency) * 1000:.3f}ms  事件循环停顿 p99={percentile(lag_list, 0.99):.3f}ms '
+          f'最大={max(lag_list) * 1000:.3f}ms')
+
+
+async def main(count: int, batch: int):
+    url = f"redis://{config.get('REDIS', 'host', fallback='localhost')}:" \
+          f"{config.getint('REDIS', 'port', fallback=6379)}/{config.getint('REDIS', 'db', fallback=0)}"
+    raw_redis = redis.StrictRedis.from_url(url, decode_responses=True)
+    redis_client = aioredis.from_url(url, decode_responses=True)
+    print(f'报单数量: {count} 每批: {batch}')
+    for mode in ('sync', 'async', 'pipeline'):
+        await run(mode, count, batch, raw_redis, redis_client)
+    await redis_client.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000, int(sys.argv[2]) if len(sys.argv) > 2 else 5))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import sys
+import os
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\GitHub\dashboard')
+else:
+    sys.path.append('/root/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+django.setup()
+import unittest
+from decimal import Decimal
+import numpy as np
+from panel.const import DirectionType, SignalType
+from trader.utils.bar_history import BarHistory
+from trader.utils.backtest import backtest_product
+from trader.utils.indicator_state import IndicatorState
+from trader.utils.strategy_param import StrategyParam
+from trader.strategy.brother2_signal import SignalInput, compute_signal
+
+PARAM = StrategyParam(break_n=20, atr_n=14, long_n=60, short_n=20, stop_n=3, risk=Decimal('0.01'))
+PRICE_TICK = Decimal(1)
+MULTIPLE = 10
+
+
+def synthetic_bars(days: int = 800, roll_every: int = 40) -> BarHistory:
+    """
+    整数价格的连续合约: 每120天换一次趋势方向, 保证有多空开仓和止损; 每 roll_every 天换一次主力合约
+    """
+    rng = np.random.default_rng(7)
+    drift = np.where((np.arange(days) // 120) % 2 == 0, 0.004, -0.004)
+    close = np.round(3000 * np.exp(np.cumsum(drift + rng.normal(0, 0.012, days))))
+    open_ = np.round(np.concatenate([[close[0]], close[:-1]]) + rng.normal(0, 5, days))
+    high = np.maximum(open_, close) + np.round(rng.uniform(0, 30, days))
+    low = np.minimum(open_, close) - np.round(rng.uniform(0, 30, days))
+    code = np.array([f'rb{1000 + i // roll_every}' for i in range(days)])
+    return BarHistory(time=np.arange('2020-01-01', days, dtype='datetime64[D]'), open=open_, high=high, low=low,
+                      close=close, settlement=close.copy(), code=code)
+
+
+def truncate(bars: BarHistory, end: int) -> BarHistory:
+    return BarHistory(time=bars.time[:end], open=bars.open[:end], high=bars.high[:end], low=bars.low[:end],
+                      close=bars.close[:end], settlement=bars.settlement[:end], code=bars.code[:end])
+
+
+def live_signals(bars: BarHistory) -> list:
+    """
+    按实盘的方式逐日调用 compute_signal: 当天收盘后计算信号, 下一交易日开盘成交
+    换月后的止损仍以最初开仓的日期和ATR为准(同 find_first_pos)
+    """
+    signal_list = list()
+    pos_code = pos_direction = pos_open_date = None
+    limit = {code: (Decimal(3000), Decimal('0.05')) for code in set(bars.code.tolist())}
+    for i in range(max(PARAM.atr_n, PARAM.break_n) + 1, len(bars) - 1):
+        history = truncate(bars, i + 1)
+        state = IndicatorState.build(history, PARAM.break_n, PARAM.atr_n, PARAM.short_n, PARAM.long_n)
+        data = SignalInput(
+            product_code='rb', name='螺纹钢', main_code=str(bars.code[i]), price_tick=PRICE_TICK,
+            volume_multiple=MULTIPLE, margin_rate=Decimal('0.1'), atr_n=PARAM.atr_n, stop_n=PARAM.stop_n,
+            risk=PARAM.risk, indicator=state.values(), bars=history, limit=limit, pos_code=pos_code,
+            pos_direction=pos_direction, pos_shares=1 if pos_code else None, pos_open_date=pos_open_date,
+            start_cash=Decimal(10 ** 9))
+        for sig in compute_signal(data).signals:
+            signal_list.append((sig['type'], bars.time[i], sig['code']))
+            if sig['type'] in (SignalType.BUY, SignalType.SELL_SHORT):
+                pos_code = sig['code']
+                pos_direction = DirectionType.values[DirectionType.LONG if sig['type'] == SignalType.BUY else DirectionType.SHORT]
+                pos_open_date = np.datetime_as_string(bars.time[i + 1], unit='D')
+            elif sig['type'] in (SignalType.SELL, SignalType.BUY_COVER):
+                pos_code = pos_direction = pos_open_date = None
+            elif sig['type'] == SignalType.ROLL_OPEN:
+                pos_code = sig['code']
+    return signal_list
+
+
+def backtest_signals(bars: BarHistory) -> list:
+    trade_list, _ = backtest_product('rb', bars, PARAM, PRICE_TICK, MULTIPLE)
+    signal_list = list()
+    for trade in trade_list:
+        signal_list.append((trade['open_type'], trade['open_signal_time'], trade['code']))
+        if trade.get('close_type'):
+            signal_list.append((trade['close_type'], trade['close_signal_time'], trade['code']))
+    return signal_list
+
+
+class BacktestTest(unittest.TestCase):
+    def setUp(self):
+        self.bars = synthetic_bars()
+
+    def test_same_signals_as_compute_signal(self):
+        expected = live_signals(self.bars)
+        # 数据中要包含开仓、ATR止损和换月, 否则比较没有意义
+        types = {sig_type for sig_type, _, _ in expected}
+        self.assertTrue(types & {SignalType.BUY, SignalType.SELL_SHORT})
+        self.assertTrue(types & {SignalType.SELL, SignalType.BUY_COVER})
+        self.assertTrue({SignalType.ROLL_CLOSE, SignalType.ROLL_OPEN} <= types)
+        # 换月的平旧和开新是同一天的两个信号, 顺序不重要
+        self.assertEqual(sorted(backtest_signals(self.bars)), sorted(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
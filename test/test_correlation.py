@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import sys
+import os
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\GitHub\dashboard')
+else:
+    sys.path.append('/root/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+django.setup()
+import unittest
+import numpy as np
+import pandas as pd
+from trader.utils.correlation import CorrelationState
+
+CODES = ['rb', 'cu', 'm', 'si']
+WINDOW = 20
+HALFLIFE = 8
+
+
+def random_closes(days: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    closes = pd.DataFrame(100 * np.exp(np.cumsum(rng.normal(0, 0.02, (days, len(CODES))), axis=0)),
+                          index=pd.date_range('2024-01-01', periods=days, freq='B'), columns=CODES)
+    closes.iloc[rng.choice(days, 15, replace=False), 1] = np.nan  # 中间缺几天K线
+    closes.iloc[:25, 3] = np.nan  # 晚上市的品种
+    return closes
+
+
+def window_returns(closes: pd.DataFrame) -> pd.DataFrame:
+    returns = pd.DataFrame({code: closes[code].dropna().pct_change() for code in CODES}).reindex(closes.index)
+    return returns.iloc[-WINDOW:]
+
+
+class CorrelationStateTest(unittest.TestCase):
+    def setUp(self):
+        self.closes = random_closes(80)
+        # 先用前30天初始化, 之后逐日增量更新, 窗口内的天数会多次移出
+        self.state = CorrelationState.build(CODES, self.closes.iloc[:30], WINDOW, HALFLIFE)
+        for time, close in zip(self.closes.index[30:], self.closes.iloc[30:].to_numpy(dtype=float)):
+            self.state.apply(time.date().isoformat(), close)
+
+    def test_corr_matches_pandas(self):
+        expected = window_returns(self.closes).corr()
+        np.testing.assert_allclose(self.state.corr().to_numpy(), expected.to_numpy(), rtol=1e-9, atol=1e-9)
+
+    def test_ew_corr_matches_rebuild(self):
+        rebuilt = CorrelationState.build(CODES, self.closes, WINDOW, HALFLIFE)
+        np.testing.assert_allclose(self.state.ew_corr().to_numpy(), rebuilt.ew_corr().to_numpy(), rtol=1e-9, atol=1e-9)
+
+    def test_ew_corr_matches_weighted_pearson(self):
+        rows = window_returns(self.closes).to_numpy(dtype=float)
+        weight = self.state.decay ** np.arange(WINDOW - 1, -1, -1, dtype=float)
+        result = self.state.ew_corr().to_numpy()
+        for i in range(len(CODES)):
+            for j in range(i + 1, len(CODES)):
+                mask = ~np.isnan(rows[:, i]) & ~np.isnan(rows[:, j])
+                expected = np.cov(rows[mask, i], rows[mask, j], aweights=weight[mask])
+                expected = expected[0, 1] / np.sqrt(expected[0, 0] * expected[1, 1])
+                self.assertAlmostEqual(result[i, j], expected, places=9)
+
+    def test_dumps_loads(self):
+        state = CorrelationState.loads(self.state.dumps())
+        np.testing.assert_array_equal(state.ew_corr().to_numpy(), self.state.ew_corr().to_numpy())
+        self.assertEqual(state.day, self.state.day)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import sys
+import os
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\GitHub\dashboard')
+else:
+    sys.path.append('/root/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+django.setup()
+import unittest
+import numpy as np
+import pandas as pd
+import talib
+from trader.utils.indicator import wilder_average, atr, rolling_high, rolling_low
+
+DAYS = 300
+PRODUCTS = 5
+
+
+def random_bars(seed: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    """(日期 x 品种) 的最高、最低、收盘价, 含晚上市(开头缺失)和中间缺失的数据"""
+    rng = np.random.default_rng(seed)
+    close = 3000 * np.exp(np.cumsum(rng.normal(0, 0.015, (DAYS, PRODUCTS)), axis=0))
+    close = np.round(close)  # 价格是整数档位, 比较大小时容易出现相等
+    high = close + np.round(rng.uniform(0, 40, close.shape))
+    low = close - np.round(rng.uniform(0, 40, close.shape))
+    close[:30, 1] = high[:30, 1] = low[:30, 1] = np.nan
+    close[rng.choice(DAYS, 10, replace=False), 2] = np.nan
+    return high, low, close
+
+
+def old_wilder_average(x: np.ndarray, n: int) -> np.ndarray:
+    """原来 brother2 中逐行计算均线的写法"""
+    s = pd.Series(x)
+    y = s.copy()
+    for idx in range(1, s.shape[0]):
+        y[idx] = (y[idx - 1] * (n - 1) + s[idx]) / n
+        if pd.isna(y[idx - 1]):
+            y[idx] = s[idx]
+    return y.to_numpy()
+
+
+class IndicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.high, self.low, self.close = random_bars(0)
+
+    def assertSame(self, actual, expected):
+        # 信号判断依赖价格比较, 要求逐位相同, NaN 的位置也相同
+        np.testing.assert_array_equal(actual, expected)
+
+    def test_wilder_average(self):
+        for n in (20, 120):
+            for i in range(PRODUCTS):
+                self.assertSame(wilder_average(self.close[:, i], n), old_wilder_average(self.close[:, i], n))
+
+    def test_atr(self):
+        for n in (1, 14, 26):
+            for i in range(PRODUCTS):
+                self.assertSame(atr(self.high[:, i], self.low[:, i], self.close[:, i], n),
+                                talib.ATR(self.high[:, i], self.low[:, i], self.close[:, i], timeperiod=n))
+
+    def test_rolling(self):
+        for n in (20, 55):
+            for i in range(PRODUCTS):
+                series = pd.Series(self.close[:, i])
+                self.assertSame(rolling_high(self.close[:, i], n), series.rolling(window=n).max().to_numpy())
+                self.assertSame(rolling_low(self.close[:, i], n), series.rolling(window=n).min().to_numpy())
+
+    def test_2d_matches_1d(self):
+        n = 20
+        for func, args in ((wilder_average, (self.close,)), (atr, (self.high, self.low, self.close)),
+                           (rolling_high, (self.close,)), (rolling_low, (self.close,))):
+            result = func(*args, n)
+            for i in range(PRODUCTS):
+                self.assertSame(result[:, i], func(*[arg[:, i] for arg in args], n))
+
+    def test_short_input(self):
+        self.assertEqual(wilder_average(np.array([]), 5).shape, (0,))
+        self.assertTrue(np.isnan(atr(self.high[:5, 0], self.low[:5, 0], self.close[:5, 0], 14)).all())
+        self.assertTrue(np.isnan(rolling_high(self.close[:5, 0], 20)).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
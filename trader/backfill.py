@@ -0,0 +1,64 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+历史日线回补, 例如:
+    python trader/backfill.py 20230101 20231231
+    python trader/backfill.py 20230101 20231231 --exchange SHFE,DCE --redo
+    python trader/backfill.py 20100101 20231231 --replay /data/exchange
+"""
+import sys
+import os
+import argparse
+import datetime
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\github\dashboard')
+else:
+    sys.path.append('/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+django.setup()
+import asyncio
+import logging
+from trader.utils import exchange_client
+from trader.utils.backfill import Backfill
+from trader.utils.exchange_source import ReplaySource
+from trader.utils.read_config import config
+
+
+async def main(args):
+    source = ReplaySource(args.replay) if args.replay else exchange_client
+    try:
+        failed = await Backfill(args.exchange.split(',') if args.exchange else None, source).run(
+            datetime.datetime.strptime(args.start, '%Y%m%d').date(),
+            datetime.datetime.strptime(args.end, '%Y%m%d').date(), args.redo)
+    finally:
+        await source.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='历史日线回补')
+    parser.add_argument('start', help='开始日期, 如 20230101')
+    parser.add_argument('end', help='结束日期, 如 20231231')
+    parser.add_argument('--exchange', help='只回补指定交易所, 逗号分隔, 如 SHFE,DCE; 默认不含 GFEX, '
+                                           '广期所接口只返回最新行情, 指定 GFEX 时只回补今天(--replay 时不受限制)')
+    parser.add_argument('--redo', action='store_true', help='忽略已完成的进度, 全部重新回补')
+    parser.add_argument('--replay', help='从抓取目录离线回放, 不访问网络')
+    logging.basicConfig(level=config.get('LOG', 'level', fallback='INFO'),
+                        format=config.get('LOG', 'format', fallback='%(asctime)s %(name)s [%(levelname)s] %(message)s'))
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -24,6 +24,7 @@ else:
     # sys.path.append('/root/gitee/dashboard')
     sys.path.append('/dashboard')
 os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+# 只为启动时的少量查询保留, 回调中的数据库访问必须经 BaseModule.db_call 放到线程池执行
 os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
 django.setup()
 import redis
@@ -0,0 +1,87 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+策略参数扫描, 结果按评价指标排序写入CSV, 例如:
+    python trader/param_sweep.py --break 20:100:10 --atr 10,20,30 --stop 2:4:1 -o sweep.csv
+    python trader/param_sweep.py --break 20:120:5 --long 60:200:20 --short 10:60:10 --sample 3000 --seed 1
+没有指定的参数取策略当前的值
+"""
+import sys
+import os
+import argparse
+import datetime
+from decimal import Decimal
+import django
+if sys.platform == 'darwin':
+    sys.path.append('/Users/jeffchen/Documents/gitdir/dashboard')
+elif sys.platform == 'win32':
+    sys.path.append(r'E:\github\dashboard')
+else:
+    sys.path.append('/dashboard')
+os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
+django.setup()
+import time
+import logging
+from panel.models import Strategy
+from trader.utils.bar_history import load_bar_range
+from trader.utils.param_sweep import make_grid, sample_grid, run_sweep, parse_values, current_space
+from trader.utils.read_config import config
+from trader.utils.strategy_param import param_cache
+
+logger = logging.getLogger('ParamSweep')
+
+
+def main(args):
+    strategy = Strategy.objects.get(name=args.strategy)
+    space = current_space(param_cache.get(strategy))
+    for name, text, cast in [('break_n', args.break_n, int), ('atr_n', args.atr_n, int), ('long_n', args.long_n, int),
+                             ('short_n', args.short_n, int), ('stop_n', args.stop_n, int), ('risk', args.risk, Decimal)]:
+        if text:
+            space[name] = parse_values(text, cast)
+    param_list = sample_grid(space, args.sample, args.seed) if args.sample else make_grid(space)
+    inst_list = list(strategy.instruments.all())
+    end = datetime.datetime.strptime(args.end, '%Y%m%d') if args.end else None
+    start = datetime.datetime.strptime(args.start, '%Y%m%d').date() if args.start else None
+    begin = time.time()
+    bar_dict = load_bar_range([inst.product_code for inst in inst_list], end)
+    logger.info(f'{len(bar_dict)}个品种, {len(param_list)}组参数, 开始扫描..')
+    df = run_sweep(bar_dict, inst_list, param_list, Decimal(args.capital) if args.capital else None, start,
+                   args.workers, args.sort)
+    df.to_csv(args.output)
+    logger.info(f'扫描完成, 耗时{time.time() - begin:.0f}秒, 结果已写入{args.output}\n{df.head(10)}')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='策略参数扫描')
+    parser.add_argument('--strategy', default='大哥2.0', help='策略名称')
+    parser.add_argument('--break', dest='break_n', help='BreakPeriod 取值, 如 20,40,60 或 20:100:10')
+    parser.add_argument('--atr', dest='atr_n', help='AtrPeriod 取值')
+    parser.add_argument('--long', dest='long_n', help='LongPeriod 取值')
+    parser.add_argument('--short', dest='short_n', help='ShortPeriod 取值')
+    parser.add_argument('--stop', dest='stop_n', help='StopLoss 取值')
+    parser.add_argument('--risk', help='Risk 取值, 如 0.001:0.005:0.001')
+    parser.add_argument('--sample', type=int, help='随机抽取的组合数, 不指定时评估全部组合')
+    parser.add_argument('--seed', type=int, help='随机抽样的种子')
+    parser.add_argument('--capital', help='开仓资金, 不指定时每次开1手')
+    parser.add_argument('--start', help='开始计算信号的日期, 如 20150101')
+    parser.add_argument('--end', help='结束日期, 如 20231231')
+    parser.add_argument('--workers', type=int, help='进程数, 默认为CPU核数')
+    parser.add_argument('--sort', default='sharpe', help='排序的评价指标: sharpe, profit, annual_return, win_rate')
+    parser.add_argument('-o', '--output', default='param_sweep.csv', help='结果文件')
+    logging.basicConfig(level=config.get('LOG', 'level', fallback='INFO'),
+                        format=config.get('LOG', 'format', fallback='%(asctime)s %(name)s [%(levelname)s] %(message)s'))
+    sys.exit(main(parser.parse_args()))
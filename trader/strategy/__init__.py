@@ -14,7 +14,6 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import redis
-import ujson as json
 
 import pytz
 import time
@@ -28,6 +27,10 @@ from abc import abstractmethod, ABCMeta
 import aioredis
 
 from trader.utils.func_container import CallbackFunctionContainer
+from trader.utils.db_executor import DBExecutor, LoopWatchdog
+from trader.utils.stream_reader import StreamReader
+from trader.utils.codec import get_codec
+from trader.utils.channel import ChannelDispatcher, parse_channel
 from trader.utils.read_config import config
 
 logger = logging.getLogger('BaseModule')
@@ -39,9 +42,10 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
     
     主要功能:
     1. 异步事件循环管理
-    2. Redis 发布/订阅通信
+    2. Redis 发布/订阅通信, 或者用 Redis Streams 接收回报([MSG_CHANNEL] transport = stream)
     3. 定时任务和消息回调注册
     4. 生命周期管理
+    5. 回调中的数据库访问(db_call)放到线程池执行, 并检查事件循环是否被阻塞
     """
     def __init__(self):
         """初始化基础模块，设置事件循环和Redis连接"""
@@ -58,24 +62,44 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
         self.raw_redis = redis.StrictRedis(host=config.get('REDIS', 'host', fallback='localhost'),
                                            port=config.getint('REDIS', 'port', fallback=6379),
                                            db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
+        # 消息编解码, 二进制 codec 收消息的客户端不能 decode_responses
+        self.codec = get_codec()
+        self.msg_client = aioredis.from_url(
+            f"redis://{config.get('REDIS', 'host', fallback='localhost')}:"
+            f"{config.getint('REDIS', 'port', fallback=6379)}/{config.getint('REDIS', 'db', fallback=0)}",
+            decode_responses=False) if self.codec.binary else self.redis_client
         # 创建Redis订阅客户端
-        self.sub_client = self.redis_client.pubsub()
+        self.sub_client = self.msg_client.pubsub()
+        # 回报的接收方式: pubsub 或 stream
+        self.transport = config.get('MSG_CHANNEL', 'transport', fallback='pubsub')
+        self.stream_task = None
         self.initialized = False
         self.sub_tasks = list()
         self.sub_channels = list()
-        # 消息路由表：将频道映射到回调函数
-        self.channel_router = dict()
+        # 消息路由表：按频道前缀(去掉最后的 key)精确查找回调函数, 一个前缀可以有多个回调
+        self.dispatcher = ChannelDispatcher()
         # 定时任务路由表：将cron表达式映射到回调函数
         self.crontab_router = defaultdict(dict)
         self.datetime = None
         self.time = None
         self.loop_time = None
+        # 数据库访问线程池和事件循环阻塞检查
+        self.db_executor = DBExecutor()
+        self.watchdog = LoopWatchdog(self.io_loop)
+
+    async def db_call(self, func, *args, key=None, **kwargs):
+        """
+        在线程池中执行同步的数据库操作, 不阻塞事件循环
+        :param key: 不为空时与相同 key 的调用按顺序串行执行, 如同一合约的成交/委托回报
+        """
+        return await self.db_executor.run(func, *args, key=key, **kwargs)
 
     def _register_callback(self):
         """注册所有回调函数，包括定时任务和消息回调"""
         self.datetime = timezone.localtime()
         self.time = time.time()
         self.loop_time = self.io_loop.time()
+        self.dispatcher.clear()
         for fun_name, args in self.callback_fun_args.items():
             if 'crontab' in args:
                 # 注册定时任务回调
@@ -85,7 +109,7 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
                 self.crontab_router[key]['handle'] = None
             elif 'channel' in args:
                 # 注册消息回调
-                self.channel_router[args['channel']] = getattr(self, fun_name)
+                self.dispatcher.register(args['channel'], getattr(self, fun_name))
 
     def _get_next(self, key):
         """计算下一次定时任务的执行时间"""
@@ -104,16 +128,29 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
         """安装模块：注册回调、订阅消息、启动定时任务"""
         try:
             self._register_callback()
-            # 订阅所有配置的频道
-            await self.sub_client.psubscribe(*self.channel_router.keys())
-            # 启动消息监听器
-            asyncio.run_coroutine_threadsafe(self._msg_reader(), self.io_loop)
+            if self.transport == 'stream':
+                # 从 stream 批量读取回报, 重启后从上次确认的位置继续
+                reader = StreamReader(
+                    self.msg_client, self.dispatcher.patterns(),
+                    group=config.get('MSG_CHANNEL', 'stream_group', fallback='trader'),
+                    consumer=config.get('MSG_CHANNEL', 'stream_consumer', fallback=type(self).__name__),
+                    count=config.getint('MSG_CHANNEL', 'stream_count', fallback=100),
+                    block=config.getint('MSG_CHANNEL', 'stream_block', fallback=1000),
+                    start=config.get('MSG_CHANNEL', 'stream_start', fallback='$'))
+                self.stream_task = self.io_loop.create_task(reader.run(self._stream_callback))
+                self.stream_task.add_done_callback(self._stream_done)
+            else:
+                # 订阅所有配置的频道
+                await self.sub_client.psubscribe(*self.dispatcher.patterns())
+                # 启动消息监听器
+                asyncio.run_coroutine_threadsafe(self._msg_reader(), self.io_loop)
             # self.io_loop.create_task(self._msg_reader())
             # 启动所有定时任务
             for key, cron_dict in self.crontab_router.items():
                 if cron_dict['handle'] is not None:
                     cron_dict['handle'].cancel()
                 cron_dict['handle'] = self.io_loop.call_at(self._get_next(key), self._call_next, key)
+            self.watchdog.start()
             self.initialized = True
             logger.debug('%s plugin installed', type(self).__name__)
         except Exception as e:
@@ -122,16 +159,22 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
     async def uninstall(self):
         """卸载模块：取消订阅、停止定时任务、释放资源"""
         try:
-            # 取消所有订阅
-            await self.sub_client.punsubscribe()
-            # await asyncio.wait(self.sub_tasks, loop=self.io_loop)
-            self.sub_tasks.clear()
-            await self.sub_client.close()
+            if self.stream_task is not None:
+                self.stream_task.cancel()
+                self.stream_task = None
+            else:
+                # 取消所有订阅
+                await self.sub_client.punsubscribe()
+                # await asyncio.wait(self.sub_tasks, loop=self.io_loop)
+                self.sub_tasks.clear()
+                await self.sub_client.close()
             # 取消所有定时任务
             for key, cron_dict in self.crontab_router.items():
                 if self.crontab_router[key]['handle'] is not None:
                     self.crontab_router[key]['handle'].cancel()
                     self.crontab_router[key]['handle'] = None
+            self.watchdog.stop()
+            self.db_executor.shutdown()
             self.initialized = False
             logger.debug('%s plugin uninstalled', type(self).__name__)
         except Exception as e:
@@ -142,16 +185,38 @@ class BaseModule(CallbackFunctionContainer, metaclass=ABCMeta):
         # {'type': 'pmessage', 'pattern': 'channel:*', 'channel': 'channel:1', 'data': 'Hello'}
         async for msg in self.sub_client.listen():
             if msg['type'] == 'pmessage':
-                channel = msg['channel']
-                pattern = msg['pattern']
-                data = json.loads(msg['data'])
+                channel = parse_channel(msg['channel'].decode() if self.codec.binary else msg['channel'])
+                handlers = self.dispatcher.handlers(channel)
+                if not handlers:
+                    continue
+                data = self.codec.decode(channel.name, msg['data'])
                 # logger.debug("%s channel[%s] Got Message:%s", type(self).__name__, channel, msg)
                 # 异步执行对应的回调函数
-                self.io_loop.create_task(self.channel_router[pattern](channel, data))
+                for handler in handlers:
+                    self.io_loop.create_task(handler(channel, data))
             elif msg['type'] == 'punsubscribe':
                 break
         logger.debug('%s quit _msg_reader!', type(self).__name__)
 
+    @staticmethod
+    def _stream_done(task: asyncio.Task):
+        """读取 stream 的任务只应在卸载时被取消, 其他原因退出时记录错误, 否则回报会无声地停止"""
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None:
+            logger.error(f'读取回报 stream 的任务异常退出: {repr(e)}', exc_info=e)
+        else:
+            logger.error('读取回报 stream 的任务意外结束')
+
+    async def _stream_callback(self, _: str, channel: str, data):
+        """stream 消息的回调, 全部回调完成后消息才会被确认"""
+        channel = parse_channel(channel)
+        handlers = self.dispatcher.handlers(channel)
+        if handlers:
+            data = self.codec.decode(channel.name, data)
+            await asyncio.gather(*[handler(channel, data) for handler in handlers])
+
     async def start(self):
         """启动模块"""
         await self.install()
@@ -19,20 +19,27 @@ from collections import defaultdict
 import datetime
 from decimal import Decimal
 import logging
+from django.db import transaction
 from django.db.models import Q, F, Sum
 from django.utils import timezone
-from talib import ATR
-import ujson as json
-import aioredis
 from trader.strategy import BaseModule
 from trader.utils.func_container import RegisterCallback
 from trader.utils.read_config import config, ctp_errors
-from trader.utils import ApiStruct, price_round, is_trading_day, update_from_shfe, update_from_dce, update_from_czce, update_from_cffex, \
-    get_contracts_argument, calc_main_inst, str_to_number, get_next_id, ORDER_REF_SIGNAL_ID_START, update_from_gfex
+from trader.utils import ApiStruct, price_round, trading_calendar, update_from_shfe, update_from_dce, update_from_czce, update_from_cffex, \
+    get_contracts_argument, calc_main_inst, str_to_number, get_next_id, ORDER_REF_SIGNAL_ID_START, update_from_gfex, exchange_client
+from trader.utils.exchange_source import ReplaySource
+from trader.utils.response_router import ResponseRouter
+from trader.utils.channel import Channel
+from trader.utils.rate_limit import TokenBucket
+from trader.utils.bar_history import BarHistory, load_bar_history, load_daily_bar
+from trader.utils.indicator_state import indicator_store
+from trader.utils.strategy_param import param_cache
+from trader.strategy.brother2_signal import SignalInput, compute_signal
 from panel.models import *
 
 logger = logging.getLogger('CTPApi')
 HANDLER_TIME_OUT = config.getint('TRADE', 'command_timeout', fallback=10)
+TRADE_DB_KEY = 'Trade'  # 所有写 Trade 表的数据库调用共用的 key, 见 DBExecutor.run
 
 
 class TradeStrategy(BaseModule):
@@ -60,10 +67,26 @@ class TradeStrategy(BaseModule):
         self.__re_extract_name = re.compile('(.*?)([0-9]+)(.*?)$')  # 提取合约文字部分
         self.__trading_day = timezone.make_aware(datetime.datetime.strptime(self.raw_redis.get("TradingDay")+'08', '%Y%m%d%H'))
         self.__last_trading_day = timezone.make_aware(datetime.datetime.strptime(self.raw_redis.get("LastTradingDay")+'08', '%Y%m%d%H'))
+        # 配置了回放目录时从本地目录读取交易所数据，不访问网络
+        replay_dir = config.get('HTTP', 'replay_dir', fallback=None)
+        self.__exchange_source = ReplaySource(replay_dir) if replay_dir else exchange_client
+        # CTP 查询流控
+        self.__query_bucket = TokenBucket(config.getfloat('TRADE', 'query_rate', fallback=1),
+                                          config.getfloat('TRADE', 'query_burst', fallback=1))
+        # 常驻的应答订阅, query/行情订阅/撤单的应答按频道分发
+        self.__response_router = ResponseRouter(self.msg_client, [
+            self.__trade_response_format.format('OnRspQry*', '*'),
+            self.__trade_response_format.format('OnRspError', '*'),
+            self.__trade_response_format.format('OnRspOrderAction', '*'),
+            self.__trade_response_format.format('OnRtnOrder', '*'),
+            self.__market_response_format.format('OnRspSubMarketData', '*'),
+            self.__market_response_format.format('OnRspUnSubMarketData', '*'),
+            self.__market_response_format.format('OnRspError', '*')], self.codec)
 
     async def start(self):
         await self.install()
-        self.raw_redis.set('HEARTBEAT:TRADER', 1, ex=61)
+        await self.__response_router.start()
+        await self.redis_client.set('HEARTBEAT:TRADER', 1, ex=61)
         today = timezone.localtime()
         now = int(today.strftime('%H%M'))
         if today.isoweekday() < 6 and (820 <= now <= 1550 or 2010 <= now <= 2359):  # 非交易时间查不到数据
@@ -77,12 +100,17 @@ class TradeStrategy(BaseModule):
                     await self.cancel_order(order)
                 # 已成交订单
                 elif order['OrderSubmitStatus'] == ApiStruct.OSS_Accepted:
-                    self.save_order(order)
+                    await self.db_call(self.save_order, order, key=order['InstrumentID'])
             await self.refresh_position()
         # today = timezone.make_aware(datetime.datetime.strptime(self.raw_redis.get('LastTradingDay'), '%Y%m%d'))
         # self.calculate(today, create_main_bar=False)
         # await self.processing_signal3()
 
+    async def stop(self):
+        await exchange_client.close()
+        await self.__response_router.stop()
+        await super().stop()
+
     async def refresh_account(self):
         try:
             logger.debug('更新账户')
@@ -105,7 +133,7 @@ class TradeStrategy(BaseModule):
             self.__broker.current = self.__current
             self.__broker.pre_balance = self.__pre_balance
             self.__broker.margin = self.__margin
-            self.__broker.save(update_fields=['cash', 'current', 'pre_balance', 'margin'])
+            await self.db_call(self.__broker.save, update_fields=['cash', 'current', 'pre_balance', 'margin'])
             logger.debug(f"更新账户,可用资金: {self.__cash:,.0f} 静态权益: {self.__pre_balance:,.0f} 动态权益: {self.__current:,.0f} "
                          f"出入金: {self.__withdraw - self.__deposit:,.0f} 虚拟: {fake:,.0f}")
         except Exception as e:
@@ -128,32 +156,43 @@ class TradeStrategy(BaseModule):
                         old_pos['Volume'] += pos['Volume']
                         old_pos['PositionProfitByTrade'] += pos['PositionProfitByTrade']
                         old_pos['Margin'] += pos['Margin']
-            Trade.objects.filter(~Q(code__in=self.__cur_pos.keys()), close_time__isnull=True).delete()  # 删除不存在的头寸
-            for _, pos in self.__cur_pos.items():
-                p_code = self.__re_extract_code.match(pos['InstrumentID']).group(1)
-                inst = Instrument.objects.get(product_code=p_code)
-                trade = Trade.objects.filter(broker=self.__broker, strategy=self.__strategy, instrument=inst, code=pos['InstrumentID'], close_time__isnull=True,
-                                             direction=DirectionType.values[pos['Direction']]).first()
-                bar = DailyBar.objects.filter(code=pos['InstrumentID']).order_by('-time').first()
-                profit = (bar.close - Decimal(pos['OpenPrice'])) * pos['Volume'] * inst.volume_multiple
-                if pos['Direction'] == DirectionType.values[DirectionType.SHORT]:
-                    profit *= -1
-                if trade:
-                    trade.shares = (trade.closed_shares if trade.closed_shares else 0) + pos['Volume']
-                    trade.filled_shares = trade.shares
-                    trade.profit = profit
-                    trade.save(update_fields=['shares', 'filled_shares', 'profit'])
-                else:
-                    Trade.objects.create(
-                        broker=self.__broker, strategy=self.__strategy, instrument=inst, code=pos['InstrumentID'], profit=profit, filled_shares=pos['Volume'],
-                        direction=DirectionType.values[pos['Direction']], avg_entry_price=Decimal(pos['OpenPrice']), shares=pos['Volume'],
-                        open_time=timezone.make_aware(datetime.datetime.strptime(pos['OpenDate'] + '08', '%Y%m%d%H')), frozen_margin=Decimal(pos['Margin']),
-                        cost=pos['Volume'] * Decimal(pos['OpenPrice']) * inst.fee_money * inst.volume_multiple + pos['Volume'] * inst.fee_volume)
+            await self.db_call(self.save_position, dict(self.__cur_pos), key=TRADE_DB_KEY)
             logger.debug('更新持仓完成!')
         except Exception as e:
             logger.warning(f'refresh_position 发生错误: {repr(e)}', exc_info=True)
 
+    def save_position(self, cur_pos: dict):
+        """
+        按查询到的持仓更新 Trade, 在数据库线程中执行
+        :param cur_pos: 持仓的快照, 执行期间 self.__cur_pos 可能被下一次查询修改
+        """
+        Trade.objects.filter(~Q(code__in=cur_pos.keys()), close_time__isnull=True).delete()  # 删除不存在的头寸
+        for _, pos in cur_pos.items():
+            p_code = self.__re_extract_code.match(pos['InstrumentID']).group(1)
+            inst = Instrument.objects.get(product_code=p_code)
+            trade = Trade.objects.filter(broker=self.__broker, strategy=self.__strategy, instrument=inst, code=pos['InstrumentID'], close_time__isnull=True,
+                                         direction=DirectionType.values[pos['Direction']]).first()
+            bar = DailyBar.objects.filter(exchange=inst.exchange, code=pos['InstrumentID']).order_by('-time').first()
+            profit = (bar.close - Decimal(pos['OpenPrice'])) * pos['Volume'] * inst.volume_multiple
+            if pos['Direction'] == DirectionType.values[DirectionType.SHORT]:
+                profit *= -1
+            if trade:
+                trade.shares = (trade.closed_shares if trade.closed_shares else 0) + pos['Volume']
+                trade.filled_shares = trade.shares
+                trade.profit = profit
+                trade.save(update_fields=['shares', 'filled_shares', 'profit'])
+            else:
+                Trade.objects.create(
+                    broker=self.__broker, strategy=self.__strategy, instrument=inst, code=pos['InstrumentID'], profit=profit, filled_shares=pos['Volume'],
+                    direction=DirectionType.values[pos['Direction']], avg_entry_price=Decimal(pos['OpenPrice']), shares=pos['Volume'],
+                    open_time=timezone.make_aware(datetime.datetime.strptime(pos['OpenDate'] + '08', '%Y%m%d%H')), frozen_margin=Decimal(pos['Margin']),
+                    cost=pos['Volume'] * Decimal(pos['OpenPrice']) * inst.fee_money * inst.volume_multiple + pos['Volume'] * inst.fee_volume)
+
     async def refresh_instrument(self):
+        """
+        更新合约列表, 以及主力合约的保证金率和手续费率
+        保证金和手续费查询并发进行(查询流控由 query 中的令牌桶保证), 最后用一次 bulk_update 写入
+        """
         try:
             logger.debug("更新合约...")
             inst_dict = defaultdict(dict)
@@ -169,6 +208,9 @@ class TradeStrategy(BaseModule):
                     inst_dict[inst['ProductID']][inst['InstrumentID']]['exchange'] = inst['ExchangeID']
                     inst_dict[inst['ProductID']][inst['InstrumentID']]['multiple'] = inst['VolumeMultiple']
                     inst_dict[inst['ProductID']][inst['InstrumentID']]['price_tick'] = inst['PriceTick']
+            exist_dict = await self.db_call(Instrument.objects.in_bulk, list(inst_dict.keys()), field_name='product_code')
+            new_list = list()
+            update_list = list()
             for code in inst_dict.keys():
                 all_inst = ','.join(sorted(inst_dict[code].keys()))
                 inst_data = list(inst_dict[code].values())[0]
@@ -179,31 +221,46 @@ class TradeStrategy(BaseModule):
                     valid_name = inst_data['name']
                 if valid_name == code:
                     valid_name = ''
-                inst_data['name'] = valid_name
-                inst, created = Instrument.objects.update_or_create(product_code=code, exchange=inst_data['exchange'])
-                print(f"inst:{inst} created:{created} main_code:{inst.main_code}")
-                update_field_list = list()
-                # 更新主力合约的保证金和手续费
+                inst = exist_dict.get(code)
+                if inst is None:
+                    new_list.append(Instrument(
+                        product_code=code, exchange=inst_data['exchange'], name=valid_name,
+                        volume_multiple=inst_data['multiple'], price_tick=inst_data['price_tick']))
+                    logger.debug(f"inst:{code} created:True main_code:None")
+                    continue
+                logger.debug(f"inst:{inst} created:False main_code:{inst.main_code}")
                 if inst.main_code:
-                    margin_rate = await self.query('InstrumentMarginRate', InstrumentID=inst.main_code)
-                    inst.margin_rate = margin_rate[0]['LongMarginRatioByMoney']
-                    fee = await self.query('InstrumentCommissionRate', InstrumentID=inst.main_code)
-                    inst.fee_money = Decimal(fee[0]['CloseRatioByMoney'])
-                    inst.fee_volume = Decimal(fee[0]['CloseRatioByVolume'])
-                    update_field_list += ['margin_rate', 'fee_money', 'fee_volume']
-                if created:
-                    inst.name = inst_data['name']
-                    inst.volume_multiple = inst_data['multiple']
-                    inst.price_tick = inst_data['price_tick']
-                    update_field_list += ['name', 'volume_multiple', 'price_tick']
-                elif inst.main_code:
                     inst.all_inst = all_inst
-                    update_field_list.append('all_inst')
-                inst.save(update_fields=update_field_list)
-            logger.debug("更新合约完成!")
+                    update_list.append(inst)
+            # 更新主力合约的保证金和手续费
+            semaphore = asyncio.Semaphore(config.getint('TRADE', 'query_concurrency', fallback=4))
+            result = await asyncio.gather(*[self.refresh_fee(inst, semaphore) for inst in update_list])
+            await self.db_call(self.save_instrument, new_list, update_list)
+            logger.debug(f"更新合约完成! 新增{len(new_list)}个, 更新{len(update_list)}个, 保证金/手续费查询失败{result.count(False)}个")
         except Exception as e:
             logger.warning(f'refresh_instrument 发生错误: {repr(e)}', exc_info=True)
 
+    @staticmethod
+    def save_instrument(new_list: list, update_list: list):
+        with transaction.atomic():
+            Instrument.objects.bulk_create(new_list)
+            Instrument.objects.bulk_update(update_list, ['margin_rate', 'fee_money', 'fee_volume', 'all_inst'])
+
+    async def refresh_fee(self, inst: Instrument, semaphore: asyncio.Semaphore) -> bool:
+        """查询主力合约的保证金率和手续费率, 只修改 inst 不保存"""
+        try:
+            async with semaphore:
+                margin_rate, fee = await asyncio.gather(
+                    self.query('InstrumentMarginRate', InstrumentID=inst.main_code),
+                    self.query('InstrumentCommissionRate', InstrumentID=inst.main_code))
+            inst.margin_rate = margin_rate[0]['LongMarginRatioByMoney']
+            inst.fee_money = Decimal(fee[0]['CloseRatioByMoney'])
+            inst.fee_volume = Decimal(fee[0]['CloseRatioByVolume'])
+            return True
+        except Exception as e:
+            logger.warning(f'查询{inst}保证金/手续费发生错误: {repr(e)}', exc_info=True)
+            return False
+
     def getShares(self, instrument: str):
         # 这个函数只能处理持有单一方向仓位的情况，若同时持有多空的头寸，返回结果不正确
         shares = 0
@@ -217,88 +274,47 @@ class TradeStrategy(BaseModule):
         # 这个函数只能处理持有单一方向仓位的情况，若同时持有多空的头寸，返回结果不正确
         return self.__shares[inst_id][0]
 
-    def async_query(self, query_type: str, **kwargs):
+    async def async_query(self, query_type: str, **kwargs):
         request_id = get_next_id()
         kwargs['RequestID'] = request_id
-        self.raw_redis.publish(self.__request_format.format('ReqQry' + query_type), json.dumps(kwargs))
-
-    @staticmethod
-    async def query_reader(pb: aioredis.client.PubSub):
-        msg_list = []
-        async for msg in pb.listen():
-            # print(f"query_reader msg: {msg}")
-            msg_dict = json.loads(msg['data'])
-            if 'empty' not in msg_dict or not msg_dict['empty']:
-                msg_list.append(msg_dict)
-            if 'bIsLast' not in msg_dict or msg_dict['bIsLast']:
-                return msg_list
+        channel = self.__request_format.format('ReqQry' + query_type)
+        await self.redis_client.publish(channel, self.codec.encode(channel, kwargs))
 
     async def query(self, query_type: str, **kwargs):
-        sub_client = None
-        channel_rsp_qry, channel_rsp_err = None, None
         try:
-            sub_client = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            await self.__query_bucket.acquire()
             request_id = get_next_id()
             kwargs['RequestID'] = request_id
-            channel_rsp_qry = self.__trade_response_format.format('OnRspQry' + query_type, request_id)
-            channel_rsp_err = self.__trade_response_format.format('OnRspError', request_id)
-            await sub_client.psubscribe(channel_rsp_qry, channel_rsp_err)
-            task = asyncio.create_task(self.query_reader(sub_client))
-            self.raw_redis.publish(self.__request_format.format('ReqQry' + query_type), json.dumps(kwargs))
-            await asyncio.wait_for(task, HANDLER_TIME_OUT)
-            await sub_client.punsubscribe()
-            await sub_client.close()
-            return task.result()
+            return await self.__response_router.request(
+                [self.__trade_response_format.format('OnRspQry' + query_type, request_id),
+                 self.__trade_response_format.format('OnRspError', request_id)],
+                self.__request_format.format('ReqQry' + query_type), kwargs, HANDLER_TIME_OUT)
         except Exception as e:
             logger.warning(f'{query_type} 发生错误: {repr(e)}', exc_info=True)
-            if sub_client and channel_rsp_qry:
-                await sub_client.unsubscribe()
-                await sub_client.close()
             return None
 
     async def SubscribeMarketData(self, inst_ids: list):
-        sub_client = None
-        channel_rsp_dat, channel_rsp_err = None, None
         try:
-            sub_client = self.redis_client.pubsub(ignore_subscribe_messages=True)
-            channel_rsp_dat = self.__market_response_format.format('OnRspSubMarketData', 0)
-            channel_rsp_err = self.__market_response_format.format('OnRspError', 0)
-            await sub_client.psubscribe(channel_rsp_dat, channel_rsp_err)
-            task = asyncio.create_task(self.query_reader(sub_client))
-            self.raw_redis.publish(self.__request_format.format('SubscribeMarketData'), json.dumps(inst_ids))
-            await asyncio.wait_for(task, HANDLER_TIME_OUT)
-            await sub_client.punsubscribe()
-            await sub_client.close()
-            return task.result()
+            return await self.__response_router.request(
+                [self.__market_response_format.format('OnRspSubMarketData', 0),
+                 self.__market_response_format.format('OnRspError', 0)],
+                self.__request_format.format('SubscribeMarketData'), inst_ids, HANDLER_TIME_OUT)
         except Exception as e:
             logger.warning(f'SubscribeMarketData 发生错误: {repr(e)}', exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_rsp_dat:
-                await sub_client.unsubscribe()
-                await sub_client.close()
             return None
 
     async def UnSubscribeMarketData(self, inst_ids: list):
-        sub_client = None
-        channel_rsp_dat, channel_rsp_err = None, None
         try:
-            sub_client = self.redis_client.pubsub(ignore_subscribe_messages=True)
-            channel_rsp_dat = self.__market_response_format.format('OnRspUnSubMarketData', 0)
-            channel_rsp_err = self.__market_response_format.format('OnRspError', 0)
-            await sub_client.psubscribe(channel_rsp_dat, channel_rsp_err)
-            task = asyncio.create_task(self.query_reader(sub_client))
-            self.raw_redis.publish(self.__request_format.format('UnSubscribeMarketData'), json.dumps(inst_ids))
-            await asyncio.wait_for(task, HANDLER_TIME_OUT)
-            await sub_client.punsubscribe()
-            await sub_client.close()
-            return task.result()
+            return await self.__response_router.request(
+                [self.__market_response_format.format('OnRspUnSubMarketData', 0),
+                 self.__market_response_format.format('OnRspError', 0)],
+                self.__request_format.format('UnSubscribeMarketData'), inst_ids, HANDLER_TIME_OUT)
         except Exception as e:
             logger.warning(f'UnSubscribeMarketData 发生错误: {repr(e)}', exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_rsp_dat:
-                await sub_client.unsubscribe()
-                await sub_client.close()
             return None
 
-    def ReqOrderInsert(self, sig: Signal):
+    def build_order(self, sig: Signal) -> dict:
+        """根据信号生成报单参数, 出错时返回 None"""
         try:
             request_id = get_next_id()
             autoid = Autonumber.objects.create()
@@ -338,42 +354,60 @@ class TradeStrategy(BaseModule):
                         broker=self.__broker, strategy=self.__strategy, code=sig.instrument.last_main, shares=sig.volume).first()
                     param_dict['Direction'] = ApiStruct.D_Buy if pos.direction == DirectionType.values[DirectionType.LONG] else ApiStruct.D_Sell
                     logger.info(f'{pos.code}->{sig.code} {pos.direction}头换月开新{sig.volume}手 价格: {sig.price}')
-            self.raw_redis.publish(self.__request_format.format('ReqOrderInsert'), json.dumps(param_dict))
+            return param_dict
+        except Exception as e:
+            logger.warning(f'ReqOrderInsert 发生错误: {repr(e)}', exc_info=True)
+            return None
+
+    async def ReqOrderInsert(self, sig: Signal):
+        param_dict = await self.db_call(self.build_order, sig)
+        if param_dict is None:
+            return
+        try:
+            channel = self.__request_format.format('ReqOrderInsert')
+            await self.redis_client.publish(channel, self.codec.encode(channel, param_dict))
         except Exception as e:
             logger.warning(f'ReqOrderInsert 发生错误: {repr(e)}', exc_info=True)
 
+    def build_orders(self, sig_list: list) -> list:
+        return [param_dict for param_dict in map(self.build_order, sig_list) if param_dict is not None]
+
+    async def send_orders(self, sig_list: list):
+        """批量报单, 全部报单参数生成后用一个 pipeline 按顺序发布"""
+        param_list = await self.db_call(self.build_orders, sig_list)
+        if not param_list:
+            return
+        try:
+            channel = self.__request_format.format('ReqOrderInsert')
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for param_dict in param_list:
+                    pipe.publish(channel, self.codec.encode(channel, param_dict))
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f'send_orders 发生错误: {repr(e)}', exc_info=True)
+
     async def cancel_order(self, order: dict):
-        sub_client = None
-        channel_rsp_odr_act, channel_rsp_err = None, None
         try:
-            sub_client = self.redis_client.pubsub(ignore_subscribe_messages=True)
             request_id = get_next_id()
             order['RequestID'] = request_id
-            channel_rtn_odr = self.__trade_response_format.format('OnRtnOrder', order['OrderRef'])
-            channel_rsp_odr_act = self.__trade_response_format.format('OnRspOrderAction', 0)
-            channel_rsp_err = self.__trade_response_format.format('OnRspError', request_id)
-            await sub_client.psubscribe(channel_rtn_odr, channel_rsp_odr_act, channel_rsp_err)
-            task = asyncio.create_task(self.query_reader(sub_client))
-            self.raw_redis.publish(self.__request_format.format('ReqOrderAction'), json.dumps(order))
-            await asyncio.wait_for(task, HANDLER_TIME_OUT)
-            await sub_client.punsubscribe()
-            await sub_client.close()
-            result = task.result()[0]
+            action_channel = self.__trade_response_format.format('OnRspOrderAction', 0)
+            result = (await self.__response_router.request(
+                [self.__trade_response_format.format('OnRtnOrder', order['OrderRef']), action_channel,
+                 self.__trade_response_format.format('OnRspError', request_id)],
+                self.__request_format.format('ReqOrderAction'), order, HANDLER_TIME_OUT,
+                match={action_channel: {'OrderRef': order['OrderRef']}}))[0]
             if 'ErrorID' in result:
                 logger.warning(f"撤销订单出错: {ctp_errors[result['ErrorID']]}")
                 return False
             return True
         except Exception as e:
             logger.warning('cancel_order 发生错误: %s', repr(e), exc_info=True)
-            if sub_client and sub_client.in_pubsub and channel_rsp_odr_act:
-                await sub_client.unsubscribe()
-                await sub_client.close()
             return False
 
     @RegisterCallback(channel='MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:*')
-    async def OnRtnDepthMarketData(self, channel, tick: dict):
+    async def OnRtnDepthMarketData(self, channel: Channel, tick: dict):
         try:
-            inst = channel.split(':')[-1]
+            inst = channel.key
             tick['UpdateTime'] = datetime.datetime.strptime(tick['UpdateTime'], "%Y%m%d %H:%M:%S:%f")
             logger.debug('inst=%s, tick: %s', inst, tick)
         except Exception as ee:
@@ -389,82 +423,102 @@ class TradeStrategy(BaseModule):
                f"价格:{trade['Price']} 时间:{trade['TradeTime']} 订单号: {trade['OrderRef']}"
 
     @RegisterCallback(channel='MSG:CTP:RSP:TRADE:OnRtnTrade:*')
-    async def OnRtnTrade(self, channel, trade: dict):
+    async def OnRtnTrade(self, channel: Channel, trade: dict):
         try:
-            signal = None
-            new_trade = False
-            trade_completed = False
-            order_ref: str = channel.split(':')[-1]
-            manual_trade = int(order_ref) < 10000
-            if not manual_trade:
-                signal = Signal.objects.get(id=int(order_ref[ORDER_REF_SIGNAL_ID_START:]))
-            logger.info(f"成交回报: {self.get_trade_string(trade)}")
-            inst = Instrument.objects.get(product_code=self.__re_extract_code.match(trade['InstrumentID']).group(1))
-            order = Order.objects.filter(order_ref=order_ref, code=trade['InstrumentID']).order_by('-send_time').first()
-            trade_cost = trade['Volume'] * Decimal(trade['Price']) * inst.fee_money * inst.volume_multiple + trade['Volume'] * inst.fee_volume
-            trade_margin = trade['Volume'] * Decimal(trade['Price']) * inst.margin_rate
-            now = timezone.localtime()
-            trade_time = timezone.make_aware(datetime.datetime.strptime(trade['TradeDate'] + trade['TradeTime'], '%Y%m%d%H:%M:%S'))
-            if trade_time.date() > now.date():
-                trade_time.replace(year=now.year, month=now.month, day=now.day)
-            if trade['OffsetFlag'] == OffsetFlag.Open:  # 开仓
-                last_trade = Trade.objects.filter(
-                    broker=self.__broker, strategy=self.__strategy, instrument=inst, code=trade['InstrumentID'], open_time__lte=trade_time,
-                    close_time__isnull=True,
-                    direction=DirectionType.values[trade['Direction']]).first() if manual_trade else Trade.objects.filter(open_order=order).first()
-                # print(connection.queries[-1]['sql'])
-                if last_trade is None:
-                    new_trade = True
-                    last_trade = Trade.objects.create(
-                        broker=self.__broker, strategy=self.__strategy, instrument=inst, code=trade['InstrumentID'], open_order=order if order else None,
-                        direction=DirectionType.values[trade['Direction']], open_time=trade_time, shares=order.volume if order else trade['Volume'],
-                        cost=trade_cost, filled_shares=trade['Volume'], avg_entry_price=trade['Price'], frozen_margin=trade_margin)
-                if order is None or order.status == OrderStatus.values[OrderStatus.AllTraded]:
-                    trade_completed = True
-                if (not new_trade and not manual_trade) or (trade_completed and not new_trade and manual_trade):
-                    last_trade.avg_entry_price = (last_trade.avg_entry_price * last_trade.filled_shares + trade['Volume'] * Decimal(trade['Price'])) / \
-                                                 (last_trade.filled_shares + trade['Volume'])
-                    last_trade.filled_shares += trade['Volume']
-                    if trade_completed and not new_trade and manual_trade:
-                        last_trade.shares += trade['Volume']
-                    last_trade.cost += trade_cost
-                    last_trade.frozen_margin += trade_margin
-                    last_trade.save()
-            else:  # 平仓
-                open_direct = DirectionType.values[DirectionType.LONG] if trade['Direction'] == DirectionType.SHORT else DirectionType.values[DirectionType.SHORT]
-                last_trade = Trade.objects.filter(Q(closed_shares__isnull=True) | Q(closed_shares__lt=F('shares')), shares=F('filled_shares'),
-                                                  broker=self.__broker, strategy=self.__strategy, instrument=inst, code=trade['InstrumentID'],
-                                                  direction=open_direct).first()
-                # print(connection.queries[-1]['sql'])
-                logger.debug(f'trade={last_trade}')
-                if last_trade:
-                    if last_trade.closed_shares and last_trade.avg_exit_price:
-                        last_trade.avg_exit_price = (last_trade.avg_exit_price * last_trade.closed_shares + trade['Volume'] * Decimal(trade['Price'])) / \
-                                                    (last_trade.closed_shares + trade['Volume'])
-                        last_trade.closed_shares += trade['Volume']
-                    else:
-                        last_trade.avg_exit_price = trade['Volume'] * Decimal(trade['Price']) / trade['Volume']
-                        last_trade.closed_shares = trade['Volume']
-                    last_trade.cost += trade_cost
-                    last_trade.close_order = order
-                    if last_trade.closed_shares == last_trade.shares:  # 全部成交
+            # 同一合约的成交和委托回报按到达顺序处理
+            await self.db_call(self.handle_rtn_trade, channel.key, trade, key=[trade['InstrumentID'], TRADE_DB_KEY])
+        except Exception:
+            if self.transport == 'stream':
+                raise  # 不确认, 重启后重新处理
+
+    def handle_rtn_trade(self, order_ref: str, trade: dict):
+        """
+        根据成交回报更新 Trade/Signal/Order, 在数据库线程中执行
+        在一个事务中完成, 出错时全部回滚并抛出异常, stream 方式下该回报不会被确认, 重启后重新处理
+        同一笔成交可能被重复投递(如 stream 中处理完但没来得及确认的回报), 成交编号与更新写在同一个事务里, 已处理过的直接忽略
+        """
+        try:
+            with transaction.atomic():
+                _, created = HandledTrade.objects.get_or_create(
+                    exchange=trade['ExchangeID'], trade_date=trade['TradeDate'], trade_id=trade['TradeID'].strip(),
+                    defaults={'order_ref': order_ref})
+                if not created:
+                    logger.info(f"成交回报已处理过, 忽略: {self.get_trade_string(trade)}")
+                    return
+                signal = None
+                new_trade = False
+                trade_completed = False
+                manual_trade = int(order_ref) < 10000
+                if not manual_trade:
+                    signal = Signal.objects.get(id=int(order_ref[ORDER_REF_SIGNAL_ID_START:]))
+                logger.info(f"成交回报: {self.get_trade_string(trade)}")
+                inst = Instrument.objects.get(product_code=self.__re_extract_code.match(trade['InstrumentID']).group(1))
+                order = Order.objects.filter(order_ref=order_ref, code=trade['InstrumentID']).order_by('-send_time').first()
+                trade_cost = trade['Volume'] * Decimal(trade['Price']) * inst.fee_money * inst.volume_multiple + trade['Volume'] * inst.fee_volume
+                trade_margin = trade['Volume'] * Decimal(trade['Price']) * inst.margin_rate
+                now = timezone.localtime()
+                trade_time = timezone.make_aware(datetime.datetime.strptime(trade['TradeDate'] + trade['TradeTime'], '%Y%m%d%H:%M:%S'))
+                if trade_time.date() > now.date():
+                    trade_time.replace(year=now.year, month=now.month, day=now.day)
+                if trade['OffsetFlag'] == OffsetFlag.Open:  # 开仓
+                    last_trade = Trade.objects.filter(
+                        broker=self.__broker, strategy=self.__strategy, instrument=inst, code=trade['InstrumentID'], open_time__lte=trade_time,
+                        close_time__isnull=True,
+                        direction=DirectionType.values[trade['Direction']]).first() if manual_trade else Trade.objects.filter(open_order=order).first()
+                    # print(connection.queries[-1]['sql'])
+                    if last_trade is None:
+                        new_trade = True
+                        last_trade = Trade.objects.create(
+                            broker=self.__broker, strategy=self.__strategy, instrument=inst, code=trade['InstrumentID'], open_order=order if order else None,
+                            direction=DirectionType.values[trade['Direction']], open_time=trade_time, shares=order.volume if order else trade['Volume'],
+                            cost=trade_cost, filled_shares=trade['Volume'], avg_entry_price=trade['Price'], frozen_margin=trade_margin)
+                    if order is None or order.status == OrderStatus.values[OrderStatus.AllTraded]:
                         trade_completed = True
-                        last_trade.close_time = trade_time
-                        if last_trade.direction == DirectionType.values[DirectionType.LONG]:
-                            profit_point = last_trade.avg_exit_price - last_trade.avg_entry_price
+                    if (not new_trade and not manual_trade) or (trade_completed and not new_trade and manual_trade):
+                        last_trade.avg_entry_price = (last_trade.avg_entry_price * last_trade.filled_shares + trade['Volume'] * Decimal(trade['Price'])) / \
+                                                     (last_trade.filled_shares + trade['Volume'])
+                        last_trade.filled_shares += trade['Volume']
+                        if trade_completed and not new_trade and manual_trade:
+                            last_trade.shares += trade['Volume']
+                        last_trade.cost += trade_cost
+                        last_trade.frozen_margin += trade_margin
+                        last_trade.save()
+                else:  # 平仓
+                    open_direct = DirectionType.values[DirectionType.LONG] if trade['Direction'] == DirectionType.SHORT else DirectionType.values[DirectionType.SHORT]
+                    last_trade = Trade.objects.filter(Q(closed_shares__isnull=True) | Q(closed_shares__lt=F('shares')), shares=F('filled_shares'),
+                                                      broker=self.__broker, strategy=self.__strategy, instrument=inst, code=trade['InstrumentID'],
+                                                      direction=open_direct).first()
+                    # print(connection.queries[-1]['sql'])
+                    logger.debug(f'trade={last_trade}')
+                    if last_trade:
+                        if last_trade.closed_shares and last_trade.avg_exit_price:
+                            last_trade.avg_exit_price = (last_trade.avg_exit_price * last_trade.closed_shares + trade['Volume'] * Decimal(trade['Price'])) / \
+                                                        (last_trade.closed_shares + trade['Volume'])
+                            last_trade.closed_shares += trade['Volume']
                         else:
-                            profit_point = last_trade.avg_entry_price - last_trade.avg_exit_price
-                        last_trade.profit = profit_point * last_trade.shares * inst.volume_multiple
-                    last_trade.save(force_update=True)
-            logger.debug(f"new_trade:{new_trade} manual_trade:{manual_trade} trade_completed:{trade_completed} "
-                         f"order:{order} signal: {signal}")
-            if trade_completed and not manual_trade:
-                signal.processed = True
-                signal.save(update_fields=['processed'])
-                order.signal = signal
-                order.save(update_fields=['signal'])
+                            last_trade.avg_exit_price = trade['Volume'] * Decimal(trade['Price']) / trade['Volume']
+                            last_trade.closed_shares = trade['Volume']
+                        last_trade.cost += trade_cost
+                        last_trade.close_order = order
+                        if last_trade.closed_shares == last_trade.shares:  # 全部成交
+                            trade_completed = True
+                            last_trade.close_time = trade_time
+                            if last_trade.direction == DirectionType.values[DirectionType.LONG]:
+                                profit_point = last_trade.avg_exit_price - last_trade.avg_entry_price
+                            else:
+                                profit_point = last_trade.avg_entry_price - last_trade.avg_exit_price
+                            last_trade.profit = profit_point * last_trade.shares * inst.volume_multiple
+                        last_trade.save(force_update=True)
+                logger.debug(f"new_trade:{new_trade} manual_trade:{manual_trade} trade_completed:{trade_completed} "
+                             f"order:{order} signal: {signal}")
+                if trade_completed and not manual_trade:
+                    signal.processed = True
+                    signal.save(update_fields=['processed'])
+                    order.signal = signal
+                    order.save(update_fields=['signal'])
         except Exception as ee:
             logger.warning(f'OnRtnTrade 发生错误: {repr(ee)}', exc_info=True)
+            raise
 
     @staticmethod
     def save_order(order: dict):
@@ -506,7 +560,16 @@ class TradeStrategy(BaseModule):
         return order_str
 
     @RegisterCallback(channel='MSG:CTP:RSP:TRADE:OnRtnOrder:*')
-    async def OnRtnOrder(self, _: str, order: dict):
+    async def OnRtnOrder(self, _: Channel, order: dict):
+        signal = await self.db_call(self.handle_rtn_order, order, key=order['InstrumentID'])
+        if signal is not None:
+            await self.ReqOrderInsert(signal)
+
+    def handle_rtn_order(self, order: dict):
+        """
+        保存委托回报, 在数据库线程中执行
+        :return: 因超出涨跌停板被拒绝时返回调整价格后需要重新报单的信号, 否则返回 None
+        """
         try:
             if order["OrderSysID"]:
                 logger.debug(f"订单回报: {self.get_order_string(order)}")
@@ -529,7 +592,7 @@ class TradeStrategy(BaseModule):
                             return
                         logger.info(f"{inst} 以价格 {price} 开多{volume}手 重新报单...")
                         signal.price = price
-                        self.io_loop.call_soon(self.ReqOrderInsert, signal)
+                        return signal
                     else:
                         delta = (last_bar.settlement - price) * Decimal(0.5)
                         price = price_round(last_bar.settlement - delta, inst.price_tick)
@@ -538,7 +601,7 @@ class TradeStrategy(BaseModule):
                             return
                         logger.info(f"{inst} 以价格 {price} 开空{volume}手 重新报单...")
                         signal.price = price
-                        self.io_loop.call_soon(self.ReqOrderInsert, signal)
+                        return signal
                 else:
                     if order['Direction'] == DirectionType.LONG:
                         delta = (price - last_bar.settlement) * Decimal(0.5)
@@ -548,7 +611,7 @@ class TradeStrategy(BaseModule):
                             return
                         logger.info(f"{inst} 以价格 {price} 买平{volume}手 重新报单...")
                         signal.price = price
-                        self.io_loop.call_soon(self.ReqOrderInsert, signal)
+                        return signal
                     else:
                         delta = (last_bar.settlement - price) * Decimal(0.5)
                         price = price_round(last_bar.settlement - delta, inst.price_tick)
@@ -557,25 +620,35 @@ class TradeStrategy(BaseModule):
                             return
                         logger.info(f"{inst} 以价格 {price} 卖平{volume}手 重新报单...")
                         signal.price = price
-                        self.io_loop.call_soon(self.ReqOrderInsert, signal)
+                        return signal
         except Exception as ee:
             logger.warning(f'OnRtnOrder 发生错误: {repr(ee)}', exc_info=True)
 
     @RegisterCallback(crontab='*/1 * * * *')
     async def heartbeat(self):
-        self.raw_redis.set('HEARTBEAT:TRADER', 1, ex=301)
+        await self.redis_client.set('HEARTBEAT:TRADER', 1, ex=301)
+
+    @RegisterCallback(crontab='50 8,20 * * *')
+    async def refresh_calendar(self):
+        # CTP登录后会更新Redis中的TradingDay, 开盘前重新加载交易日历
+        await self.db_call(trading_calendar.refresh)
+
+    def load_signals(self, *args, **kwargs) -> list:
+        """上个交易日以来未处理的信号, 按优先级排序"""
+        return list(Signal.objects.filter(*args, trigger_time__gte=self.__last_trading_day, strategy=self.__strategy, processed=False,
+                                          **kwargs).select_related('instrument').order_by('-priority'))
 
     @RegisterCallback(crontab='55 8 * * *')
     async def processing_signal1(self):
         await asyncio.sleep(5)
         day = timezone.localtime()
-        _, trading = await is_trading_day(day)
+        trading = await self.db_call(trading_calendar.is_trading_day, day)
         if trading:
             logger.debug('查询日盘信号..')
-            for sig in Signal.objects.filter(~Q(instrument__exchange=ExchangeType.CFFEX), trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
-                                             instrument__night_trade=False, processed=False).order_by('-priority'):
+            sig_list = await self.db_call(self.load_signals, ~Q(instrument__exchange=ExchangeType.CFFEX), instrument__night_trade=False)
+            for sig in sig_list:
                 logger.info(f'发现日盘信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+            await self.send_orders(sig_list)
             if (self.__trading_day - self.__last_trading_day).days > 3:
                 logger.info(f'假期后第一天，处理节前未成交夜盘信号.')
                 self.io_loop.call_soon(asyncio.create_task, self.processing_signal3())
@@ -583,64 +656,64 @@ class TradeStrategy(BaseModule):
     @RegisterCallback(crontab='1 9 * * *')
     async def check_signal1_processed(self):
         day = timezone.localtime()
-        _, trading = await is_trading_day(day)
+        trading = await self.db_call(trading_calendar.is_trading_day, day)
         if trading:
             logger.debug('查询遗漏的日盘信号..')
-            for sig in Signal.objects.filter(~Q(instrument__exchange=ExchangeType.CFFEX), trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
-                                             instrument__night_trade=False, processed=False).order_by('-priority'):
+            sig_list = await self.db_call(self.load_signals, ~Q(instrument__exchange=ExchangeType.CFFEX), instrument__night_trade=False)
+            for sig in sig_list:
                 logger.info(f'发现遗漏信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+            await self.send_orders(sig_list)
 
     @RegisterCallback(crontab='25 9 * * *')
     async def processing_signal2(self):
         await asyncio.sleep(5)
         day = timezone.localtime()
-        _, trading = await is_trading_day(day)
+        trading = await self.db_call(trading_calendar.is_trading_day, day)
         if trading:
             logger.debug('查询股指和国债信号..')
-            for sig in Signal.objects.filter(instrument__exchange=ExchangeType.CFFEX, trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
-                                             instrument__night_trade=False, processed=False).order_by('-priority'):
+            sig_list = await self.db_call(self.load_signals, instrument__exchange=ExchangeType.CFFEX, instrument__night_trade=False)
+            for sig in sig_list:
                 logger.info(f'发现股指和国债信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+            await self.send_orders(sig_list)
 
     @RegisterCallback(crontab='31 9 * * *')
     async def check_signal2_processed(self):
         day = timezone.localtime()
-        _, trading = await is_trading_day(day)
+        trading = await self.db_call(trading_calendar.is_trading_day, day)
         if trading:
             logger.debug('查询遗漏的股指和国债信号..')
-            for sig in Signal.objects.filter(instrument__exchange=ExchangeType.CFFEX, trigger_time__gte=self.__last_trading_day, strategy=self.__strategy,
-                                             instrument__night_trade=False, processed=False).order_by('-priority'):
+            sig_list = await self.db_call(self.load_signals, instrument__exchange=ExchangeType.CFFEX, instrument__night_trade=False)
+            for sig in sig_list:
                 logger.info(f'发现遗漏的股指和国债信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+            await self.send_orders(sig_list)
 
     @RegisterCallback(crontab='55 20 * * *')
     async def processing_signal3(self):
         await asyncio.sleep(5)
         day = timezone.localtime()
-        _, trading = await is_trading_day(day)
+        trading = await self.db_call(trading_calendar.is_trading_day, day)
         if trading:
             logger.debug('查询夜盘信号..')
-            for sig in Signal.objects.filter(
-                    trigger_time__gte=self.__last_trading_day, strategy=self.__strategy, instrument__night_trade=True, processed=False).order_by('-priority'):
+            sig_list = await self.db_call(self.load_signals, instrument__night_trade=True)
+            for sig in sig_list:
                 logger.info(f'发现夜盘信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+            await self.send_orders(sig_list)
 
     @RegisterCallback(crontab='1 21 * * *')
     async def check_signal3_processed(self):
         day = timezone.localtime()
-        _, trading = await is_trading_day(day)
+        trading = await self.db_call(trading_calendar.is_trading_day, day)
         if trading:
             logger.debug('查询遗漏的夜盘信号..')
-            for sig in Signal.objects.filter(
-                    trigger_time__gte=self.__last_trading_day, strategy=self.__strategy, instrument__night_trade=True, processed=False).order_by('-priority'):
+            sig_list = await self.db_call(self.load_signals, instrument__night_trade=True)
+            for sig in sig_list:
                 logger.info(f'发现遗漏的夜盘信号: {sig}')
-                self.io_loop.call_soon(self.ReqOrderInsert, sig)
+            await self.send_orders(sig_list)
 
     @RegisterCallback(crontab='20 15 * * *')
     async def refresh_all(self):
         day = timezone.localtime()
-        _, trading = await is_trading_day(day)
+        trading = await self.db_call(trading_calendar.is_trading_day, day)
         if not trading:
             logger.info('今日是非交易日, 不更新任何数据。')
             return
@@ -651,34 +724,39 @@ class TradeStrategy(BaseModule):
 
     @RegisterCallback(crontab='30 15 * * *')
     async def update_equity(self):
-        today, trading = await is_trading_day(timezone.localtime())
+        today = timezone.localtime()
+        trading = await self.db_call(trading_calendar.is_trading_day, today)
         if trading:
-            dividend = Performance.objects.filter(
-                broker=self.__broker, day__lt=today.date()).aggregate(Sum('dividend'))['dividend__sum']
-            if dividend is None:
-                dividend = Decimal(0)
-            dividend = dividend + self.__deposit - self.__withdraw
-            # 虚拟=虚拟(原始)-入金+出金
-            self.__fake = self.__fake - self.__deposit + self.__withdraw
-            if self.__fake < 1:
-                self.__fake = 0
-            self.__broker.fake = self.__fake
-            self.__broker.save(update_fields=['fake'])
-            unit = dividend + self.__fake
-            nav = (self.__current + self.__fake) / unit  # 单位净值
-            accumulated = self.__current / (unit - self.__fake)  # 累计净值
-            Performance.objects.update_or_create(broker=self.__broker, day=today.date(), defaults={
-                'used_margin': self.__margin, 'dividend': self.__deposit - self.__withdraw, 'fake': self.__fake, 'capital': self.__current, 'unit_count': unit,
-                'NAV': nav, 'accumulated': accumulated})
-            logger.info(f"动态权益: {self.__current:,.0f}({self.__current/10000:.1f}万) "
-                        f"静态权益: {self.__pre_balance:,.0f}({self.__pre_balance/10000:.1f}万) "
-                        f"可用资金: {self.__cash:,.0f}({self.__cash/10000:.1f}万) "
-                        f"保证金占用: {self.__margin:,.0f}({self.__margin/10000:.1f}万) "
-                        f"虚拟资金: {self.__fake:,.0f}({self.__fake/10000:.1f}万) 当日入金: {self.__deposit:,.0f} "
-                        f"当日出金: {self.__withdraw:,.0f} 单位净值: {nav:,.2f} 累计净值: {accumulated:,.2f}")
+            await self.db_call(self.save_equity, today)
+
+    def save_equity(self, today: datetime.datetime):
+        """计算并保存当日净值, 在数据库线程中执行"""
+        dividend = Performance.objects.filter(
+            broker=self.__broker, day__lt=today.date()).aggregate(Sum('dividend'))['dividend__sum']
+        if dividend is None:
+            dividend = Decimal(0)
+        dividend = dividend + self.__deposit - self.__withdraw
+        # 虚拟=虚拟(原始)-入金+出金
+        self.__fake = self.__fake - self.__deposit + self.__withdraw
+        if self.__fake < 1:
+            self.__fake = 0
+        self.__broker.fake = self.__fake
+        self.__broker.save(update_fields=['fake'])
+        unit = dividend + self.__fake
+        nav = (self.__current + self.__fake) / unit  # 单位净值
+        accumulated = self.__current / (unit - self.__fake)  # 累计净值
+        Performance.objects.update_or_create(broker=self.__broker, day=today.date(), defaults={
+            'used_margin': self.__margin, 'dividend': self.__deposit - self.__withdraw, 'fake': self.__fake, 'capital': self.__current, 'unit_count': unit,
+            'NAV': nav, 'accumulated': accumulated})
+        logger.info(f"动态权益: {self.__current:,.0f}({self.__current/10000:.1f}万) "
+                    f"静态权益: {self.__pre_balance:,.0f}({self.__pre_balance/10000:.1f}万) "
+                    f"可用资金: {self.__cash:,.0f}({self.__cash/10000:.1f}万) "
+                    f"保证金占用: {self.__margin:,.0f}({self.__margin/10000:.1f}万) "
+                    f"虚拟资金: {self.__fake:,.0f}({self.__fake/10000:.1f}万) 当日入金: {self.__deposit:,.0f} "
+                    f"当日出金: {self.__withdraw:,.0f} 单位净值: {nav:,.2f} 累计净值: {accumulated:,.2f}")
 
     @RegisterCallback(crontab='0 17 * * *')
-    async def collect_quote(self, tasks=None):
+    async def collect_quote(self, tasks=None, source=None):
         """
         每日收盘后收集行情数据并计算交易信号
         
@@ -687,10 +765,11 @@ class TradeStrategy(BaseModule):
         
         参数:
             tasks: 可选，指定要执行的数据收集任务列表
+            source: 可选，交易所数据来源，默认为网络(或配置的回放目录)
         """
         try:
             day = timezone.localtime()
-            _, trading = await is_trading_day(day)
+            trading = await self.db_call(trading_calendar.is_trading_day, day)
             if not trading:
                 logger.info('今日是非交易日, 不计算任何数据。')
                 return
@@ -698,24 +777,42 @@ class TradeStrategy(BaseModule):
             if tasks is None:
                 # 默认从所有交易所获取数据
                 tasks = [update_from_shfe, update_from_dce, update_from_czce, update_from_cffex, update_from_gfex, get_contracts_argument]
-            result = await asyncio.gather(*[func(day) for func in tasks], return_exceptions=True)
+            if source is None:
+                source = self.__exchange_source
+            result = await asyncio.gather(*[func(day, source) for func in tasks], return_exceptions=True)
             if all(result):
                 # 所有数据获取成功，计算交易信号
-                self.io_loop.call_soon(self.calculate, day)
+                self.io_loop.create_task(self.calculate(day))
             else:
                 # 部分数据获取失败，10分钟后重试失败的任务
                 failed_tasks = [tasks[i] for i, rst in enumerate(result) if not rst]
-                self.io_loop.call_later(10*60, asyncio.create_task, self.collect_quote(failed_tasks))
+                self.io_loop.call_later(10*60, asyncio.create_task, self.collect_quote(failed_tasks, source))
         except Exception as e:
             logger.warning(f'collect_quote 发生错误: {repr(e)}', exc_info=True)
         logger.debug('盘后计算完毕!')
 
-    def calculate(self, day, create_main_bar=True):
+    @staticmethod
+    def compute_signals(input_list: list) -> list:
+        """
+        依次计算各品种的信号, 每个品种只是几微秒的数值计算, 在一个线程里算完即可
+        不用进程池: 进程里已经有数据库线程和 Redis 连接, fork 出的子进程可能卡在继承来的锁上, 序列化输入也比计算本身更慢
+        """
+        proposal_list = list()
+        for data in input_list:
+            try:
+                proposal_list.append(compute_signal(data))
+            except Exception as e:
+                logger.warning(f'计算交易信号 {data.name} 发生错误: {repr(e)}', exc_info=True)
+        return proposal_list
+
+    async def calculate(self, day, create_main_bar=True):
         """
         计算交易信号并生成连续合约
         
-        处理所有关注的品种，生成连续合约数据，计算交易信号，
-        并进行风险评估
+        分三步进行, 计算期间事件循环仍然可以处理行情和回报:
+        1. 在线程中读取数据: 生成连续合约, 读取K线、持仓和参数, 推进指标状态
+        2. 在一个线程中依次计算各品种的信号(纯计算, 见 brother2_signal.compute_signal)
+        3. 在线程中用一个事务写入全部信号, 最后进行风险评估
         
         参数:
             day: 计算日期
@@ -723,20 +820,13 @@ class TradeStrategy(BaseModule):
         """
         try:
             # 获取所有需要计算的品种代码
-            p_code_set = set(self.__inst_ids)
+            p_code_set = await self.db_call(set, self.__inst_ids)
             for code in self.__cur_pos.keys():
                 p_code_set.add(self.__re_extract_code.match(code).group(1))
-            all_margin = 0
-            for inst in Instrument.objects.all().order_by('section', 'exchange', 'name'):
-                if create_main_bar:
-                    # 生成连续合约数据
-                    logger.debug(f'生成连续合约: {inst.name}')
-                    calc_main_inst(inst, day)
-                if inst.product_code in p_code_set:
-                    # 计算交易信号
-                    logger.debug(f'计算交易信号: {inst.name}')
-                    sig, margin = self.calc_signal(inst, day)
-                    all_margin += margin
+            inst_list, input_list = await self.db_call(self.prepare_signals, day, p_code_set, create_main_bar)
+            proposal_list = await self.io_loop.run_in_executor(None, self.compute_signals, input_list)
+            inst_dict = {inst.product_code: inst for inst in inst_list}
+            all_margin = await self.db_call(self.save_signals, day, inst_dict, proposal_list)
             # 风险评估：如果所需保证金超过账户资金的80%，发出风险警告
             if (all_margin + self.__margin) / self.__current > 0.8:
                 logger.info(f"！！！风险提示！！！开仓保证金共计: {all_margin:.0f}({all_margin/10000:.1f}万) "
@@ -744,231 +834,162 @@ class TradeStrategy(BaseModule):
         except Exception as e:
             logger.warning(f'calculate 发生错误: {repr(e)}', exc_info=True)
 
-    def calc_signal(self, inst: Instrument, day: datetime.datetime) -> (Signal, Decimal):
+    def prepare_signals(self, day: datetime.datetime, p_code_set: set, create_main_bar: bool = True) -> (list, list):
+        """
+        读取计算信号所需的全部数据
+        
+        返回:
+            inst_list: 全部品种
+            input_list: 需要计算信号的品种的 SignalInput 列表
+        """
+        inst_list = list(Instrument.objects.all().order_by('section', 'exchange', 'name'))
+        if create_main_bar:
+            for inst in inst_list:
+                # 生成连续合约数据
+                logger.debug(f'生成连续合约: {inst.name}')
+                calc_main_inst(inst, day)
+        # 一次读出全部品种的K线、当日日线和共用数据
+        bar_dict = load_bar_history(p_code_set, day)
+        daily_bars = load_daily_bar(day)
+        context = self.load_signal_context()
+        input_list = list()
+        for inst in inst_list:
+            if inst.product_code not in p_code_set:
+                continue
+            if inst.product_code not in bar_dict:
+                logger.warning(f'{inst} 没有连续合约数据, 无法计算信号')
+                continue
+            logger.debug(f'计算交易信号: {inst.name}')
+            data = self.prepare_signal(inst, bar_dict[inst.product_code], daily_bars, context)
+            if data is not None:
+                input_list.append(data)
+        return inst_list, input_list
+
+    def load_signal_context(self) -> dict:
+        """全部品种共用的数据: 策略参数、初始资金、各板块盈亏、当前持仓和手动开仓品种"""
+        param = param_cache.get(self.__strategy)
+        performance = Performance.objects.last()
+        section_profit = {
+            row['instrument__section']: row['sum'] for row in Trade.objects.filter(strategy=self.__strategy).values(
+                'instrument__section').annotate(sum=Sum('profit')).order_by()}
+        positions = dict()
+        for pos in Trade.objects.filter(close_time__isnull=True, broker=self.__broker, strategy=self.__strategy,
+                                        shares__gt=0).order_by('id'):
+            positions.setdefault(pos.instrument_id, pos)
+        return {
+            'param': param,
+            'start_cash': performance.unit_count if performance else None,
+            'section_profit': section_profit,
+            'positions': positions,
+            'force_opens': set(self.__strategy.force_opens.values_list('id', flat=True)),
+        }
+
+    def prepare_signal(self, inst: Instrument, bars: BarHistory, daily_bars: dict, context: dict) -> SignalInput:
+        """
+        准备单个品种的计算数据: 推进指标状态, 查找换月前最初的持仓, 读取涨跌停幅度
+        K线数量不足时返回 None
+        """
+        # 技术指标: ATR、短期均线、长期均线、截止前一天的N日最高/最低收盘价, 每天只需增量计算一根K线
+        param = context['param']
+        state = indicator_store.advance(inst.product_code, bars, param.break_n, param.atr_n, param.short_n, param.long_n)
+        if state is None:
+            logger.warning(f'{inst} K线数量不足, 无法计算信号')
+            return None
+        pos = context['positions'].get(inst.id)
+        code_list = [inst.main_code] if pos is None or pos.code == inst.main_code else [inst.main_code, pos.code]
+        bar_list = [daily_bars.get((inst.exchange, code)) for code in code_list]
+        ratio_list = self.raw_redis.mget(
+            [f"LIMITRATIO:{inst.exchange}:{inst.product_code}:{code}" for code in code_list])
+        limit = {code: (bar.settlement, str_to_number(ratio))
+                 for code, bar, ratio in zip(code_list, bar_list, ratio_list) if bar is not None}
+        profit = context['section_profit'].get(inst.section)
+        data = SignalInput(
+            product_code=inst.product_code, name=str(inst), main_code=inst.main_code, price_tick=inst.price_tick,
+            volume_multiple=inst.volume_multiple, margin_rate=inst.margin_rate, atr_n=param.atr_n,
+            stop_n=param.stop_n, risk=param.risk, indicator=state.values(), bars=bars, limit=limit,
+            force_open=inst.id in context['force_opens'], start_cash=context['start_cash'],
+            section_profit=profit if profit else Decimal(0))
+        if pos is not None:
+            data.pos_code = pos.code
+            data.pos_direction = pos.direction
+            data.pos_shares = pos.shares
+            data.pos_open_date = self.find_first_pos(pos).open_time.astimezone().date().isoformat()
+        return data
+
+    @staticmethod
+    def find_first_pos(pos: Trade) -> Trade:
+        """循环查找最初的持仓 - 处理因换月导致的多次换仓情况"""
+        first_pos = pos
+        while hasattr(first_pos, 'open_order') and first_pos.open_order and first_pos.open_order.signal \
+                and first_pos.open_order.signal.type == SignalType.ROLL_OPEN:
+            # 如果当前持仓是通过换月开的新仓，则寻找换月前的原始持仓
+            last_pos = Trade.objects.filter(
+                close_order__signal__type=SignalType.ROLL_CLOSE,  # 寻找因换月而平仓的订单
+                instrument=first_pos.instrument,                  # 同一个品种
+                strategy=first_pos.strategy,                      # 同一个策略
+                shares=first_pos.shares,                          # 相同持仓量
+                direction=first_pos.direction,                    # 相同方向
+                close_time__date=first_pos.open_time.date()       # 平仓时间与当前持仓开仓时间是同一天(换月特征)
+            ).first()
+            if last_pos is None:  # 如果找不到更早的持仓，跳出循环
+                break
+            logger.debug(f"发现换月前持仓:{last_pos} 开仓时间: {last_pos.open_time}")
+            first_pos = last_pos
+        return first_pos
+
+    def save_signals(self, day: datetime.datetime, inst_dict: dict, proposal_list: list) -> Decimal:
+        """
+        在一个事务中写入全部信号, 并移除已使用的手动开仓品种
+        :return: 新开仓所需的保证金合计
         """
-        计算单个品种的交易信号
+        all_margin = 0
+        with transaction.atomic():
+            for proposal in proposal_list:
+                inst = inst_dict[proposal.product_code]
+                if proposal.force_open_used:
+                    self.__strategy.force_opens.remove(inst)
+                sig = None
+                # 换月时先写平旧仓信号, 最后一个是主信号
+                for item in proposal.signals:
+                    sig, _ = Signal.objects.update_or_create(
+                        code=item['code'], strategy=self.__strategy, instrument=inst, type=item['type'], trigger_time=day,
+                        defaults={'price': item['price'], 'volume': item['volume'], 'priority': item['priority'], 'processed': False})
+                if sig is not None:
+                    volume_ori = proposal.volume_ori if proposal.volume_ori else sig.volume
+                    logger.info(f"新信号: {sig}({volume_ori:.1f}手) "
+                                f"预估保证金: {proposal.use_margin:.0f}({proposal.use_margin/10000:.1f}万)")
+                all_margin += proposal.use_margin
+        return all_margin
+
+    def calc_signal(self, inst: Instrument, day: datetime.datetime, bars: BarHistory = None, daily_bars: dict = None) -> (Signal, Decimal):
+        """
+        计算单个品种的交易信号, 在当前线程中完成, 不经过进程池
         
-        实现了《趋势交易》一书中的策略:
-        1. 只有在短期均线高于长期均线时才能开多仓
-        2. 只有在短期均线低于长期均线时才能开空仓
-        3. 如果收盘价是过去N天内最高价，在下一交易日买入
-        4. 如果收盘价是过去N天内最低价，在下一交易日卖出
-        5. 仓位大小基于ATR和风险因子计算
-        6. 多头止损设置在开仓以来最高价下方N个ATR
-        7. 空头止损设置在开仓以来最低价上方N个ATR
+        策略见 brother2_signal.compute_signal
         
         参数:
             inst: 品种对象
             day: 计算日期
+            bars: 可选，预先读取的连续合约K线，为空时单独查询
+            daily_bars: 可选，预先读取的当日日线 {(交易所, 合约): DailyBar}，为空时单独查询
             
         返回:
-            signal: 生成的信号对象
+            signal: 生成的信号类型
             margin: 所需保证金
         """
         try:
-            '''
-实际上，我们发现这个策略就是《趋势交易》一书中提供的策略，书中提供的策略细节如下：
-只有在50天均线高于100天均线的时候才能开多仓。
-只有在50天均线低于100天均线的时候才能开空仓。
-如果某一天的收盘价是过去50天内最高的收盘价，我们就在下一个交易日买入。
-如果出现过去50天内最低的收盘价，我们就在下一个交易日卖出或卖空。
-单个品种的仓位额度与其波动性有关，我们根据前面讲过的真实波动幅度均值（ATR）公式来确定，风险因子可以暂时设定为20个基点。
-多头仓位的止损价格设定为开仓以来最高收盘价之下3个ATR的位置。
-空头仓位的止损价格设定为开仓以来最低收盘价之上3个ATR的位置。
-投资的品种池应该涵盖全部5个板块，而且从每个板块中选取的品种数量不少于10个。
-
-对应作者的系统里面，策略参数则是
-
-@dataclass  
-class Parameter:  
-    break_n = 50  
-    atr_n = 20  
-    long_n = 100  
-    short_n = 50  
-    stop_n = 3  
-    risk = 0.002   # 70种为0.002，0.05为十四种或九种
-            '''
-            break_n = self.__strategy.param_set.get(code='BreakPeriod').int_value
-            atr_n = self.__strategy.param_set.get(code='AtrPeriod').int_value
-            long_n = self.__strategy.param_set.get(code='LongPeriod').int_value
-            short_n = self.__strategy.param_set.get(code='ShortPeriod').int_value
-            stop_n = self.__strategy.param_set.get(code='StopLoss').int_value
-            risk = self.__strategy.param_set.get(code='Risk').float_value
             # 只读取最近400条记录，减少运算量
-            df = to_df(MainBar.objects.filter(time__lte=day.date(), exchange=inst.exchange, product_code=inst.product_code).order_by('-time').values_list(
-                'time', 'open', 'high', 'low', 'close')[:400], index_col='time', parse_dates=['time'])
-            df = df.iloc[::-1]  # 日期升序排列
-            
-            # 计算技术指标
-            df["atr"] = ATR(df.high, df.low, df.close, timeperiod=atr_n)  # 真实波动幅度
-            df["short_trend"] = df.close  # 短期均线
-            df["long_trend"] = df.close   # 长期均线
-            
-            # 手动计算移动平均线
-            for idx in range(1, df.shape[0]): # 手动计算SMA
-                df.short_trend[idx] = (df.short_trend[idx-1] * (short_n - 1) + df.close[idx]) / short_n
-                df.long_trend[idx] = (df.long_trend[idx-1] * (long_n - 1) + df.close[idx]) / long_n
-                
-            # 计算突破指标
-            df["high_line"] = df.close.rolling(window=break_n).max()  # N日最高收盘价
-            df["low_line"] = df.close.rolling(window=break_n).min()   # N日最低收盘价
-            
-            idx = -1  # 使用最新数据
-            
-            # 生成交易信号
-            # 多头信号：短期均线在长期均线上方且价格突破N日最高价
-            buy_sig = df.short_trend[idx] > df.long_trend[idx] and price_round(df.close[idx], inst.price_tick) >= price_round(df.high_line[idx - 1], inst.price_tick)
-            # 空头信号：短期均线在长期均线下方且价格跌破N日最低价
-            sell_sig = df.short_trend[idx] < df.long_trend[idx] and price_round(df.close[idx], inst.price_tick) <= price_round(df.low_line[idx - 1], inst.price_tick)
-            
-            # 检查当前持仓
-            pos = Trade.objects.filter(close_time__isnull=True, broker=self.__broker, strategy=self.__strategy, instrument=inst, shares__gt=0).first()
-            roll_over = False
-            if pos:
-                roll_over = pos.code != inst.main_code and pos.code < inst.main_code
-            elif self.__strategy.force_opens.filter(id=inst.id).exists() and not buy_sig and not sell_sig:
-                logger.info(f'强制开仓: {inst}')
-                if df.short_trend[idx] > df.long_trend[idx]:
-                    buy_sig = True
-                else:
-                    sell_sig = True
-                self.__strategy.force_opens.remove(inst)
-            # 后续代码处理持仓管理、止损、换月和开仓逻辑...
-            signal = signal_code = price = volume = volume_ori = use_margin = None
-            priority = PriorityType.LOW
-            if pos:
-                # 多头持仓
-                if pos.direction == DirectionType.values[DirectionType.LONG]:
-                    first_pos = pos  # 初始化首次持仓变量为当前持仓
-                    
-                    # 循环查找最初的持仓 - 处理因换月导致的多次换仓情况
-                    while hasattr(first_pos, 'open_order') and first_pos.open_order and first_pos.open_order.signal and first_pos.open_order.signal.type == SignalType.ROLL_OPEN:
-                        # 如果当前持仓是通过换月开的新仓，则寻找换月前的原始持仓
-                        last_pos = Trade.objects.filter(
-                            close_order__signal__type=SignalType.ROLL_CLOSE,  # 寻找因换月而平仓的订单
-                            instrument=first_pos.instrument,                  # 同一个品种
-                            strategy=first_pos.strategy,                      # 同一个策略
-                            shares=first_pos.shares,                          # 相同持仓量
-                            direction=first_pos.direction,                    # 相同方向(多头)
-                            close_time__date=first_pos.open_time.date()       # 平仓时间与当前持仓开仓时间是同一天(换月特征)
-                        ).first()
-                        
-                        if last_pos is None:  # 如果找不到更早的持仓，跳出循环
-                            break
-                        logger.debug(f"发现换月前持仓:{last_pos} 开仓时间: {last_pos.open_time}")
-                        first_pos = last_pos  # 更新首次持仓为找到的更早持仓
-                    
-                    # 获取首次持仓开仓时间在价格数据中的位置索引
-                    pos_idx = df.index.get_loc(first_pos.open_time.astimezone().date().isoformat())
-                    
-                    # 多头止损逻辑: 当前收盘价低于开仓以来最高价减去N倍ATR
-                    if df.close[idx] <= df.high[pos_idx:idx].max() - df.atr[pos_idx - 1] * stop_n:
-                        signal = SignalType.SELL                      # 生成卖出信号
-                        signal_code = pos.code                        # 设置信号对应的合约代码
-                        volume = pos.shares                           # 设置卖出数量为持仓量
-                        # 获取最新的合约日线数据
-                        last_bar = DailyBar.objects.filter(exchange=inst.exchange, code=pos.code, time=day.date()).first()
-                        # 计算卖出价格(向下接近跌停价以确保成交)
-                        price = self.calc_down_limit(inst, last_bar)
-                        priority = PriorityType.High                  # 止损信号设为高优先级
-                    
-                    # 多头换月逻辑: 当前持有的合约不再是主力合约且需要换月
-                    elif roll_over:
-                        signal = SignalType.ROLL_OPEN                 # 生成换月开新仓信号
-                        volume = pos.shares                           # 设置开仓数量为当前持仓量
-                        # 获取旧合约和新合约(主力)的日线数据
-                        last_bar = DailyBar.objects.filter(exchange=inst.exchange, code=pos.code, time=day.date()).first()
-                        new_bar = DailyBar.objects.filter(exchange=inst.exchange, code=inst.main_code, time=day.date()).first()
-                        # 计算开新仓价格(接近涨停价以确保成交)
-                        price = self.calc_up_limit(inst, new_bar)
-                        priority = PriorityType.Normal                # 换月信号设为普通优先级
-                        
-                        # 同时创建平旧仓信号 - 换月需要同时平旧仓开新仓
-                        Signal.objects.update_or_create(
-                            code=pos.code,                            # 旧合约代码
-                            strategy=self.__strategy,                 # 当前策略
-                            instrument=inst,                          # 品种
-                            type=SignalType.ROLL_CLOSE,               # 平仓类型为换月平仓
-                            trigger_time=day,                         # 信号触发时间
-                            defaults={
-                                'price': self.calc_down_limit(inst, last_bar),  # 平仓价格(接近跌停价)
-                                'volume': volume,                               # 平仓数量
-                                'priority': priority,                           # 优先级
-                                'processed': False                              # 未处理标记
-                            }
-                        )
-                # 空头持仓
-                else:
-                    first_pos = pos
-                    while hasattr(first_pos, 'open_order') and first_pos.open_order and first_pos.open_order.signal \
-                            and first_pos.open_order.signal.type == SignalType.ROLL_OPEN:
-                        last_pos = Trade.objects.filter(
-                            close_order__signal__type=SignalType.ROLL_CLOSE, instrument=first_pos.instrument, strategy=first_pos.strategy,
-                            shares=first_pos.shares, direction=first_pos.direction,close_time__date=first_pos.open_time.date()).first()
-                        if last_pos is None:
-                            break
-                        logger.debug(f"发现换月前持仓:{last_pos} 开仓时间: {last_pos.open_time}")
-                        first_pos = last_pos
-                    pos_idx = df.index.get_loc(first_pos.open_time.astimezone().date().isoformat())
-                    # 空头止损
-                    if df.close[idx] >= df.low[pos_idx:idx].min() + df.atr[pos_idx - 1] * stop_n:
-                        signal = SignalType.BUY_COVER
-                        signal_code = pos.code
-                        volume = pos.shares
-                        last_bar = DailyBar.objects.filter(exchange=inst.exchange, code=pos.code, time=day.date()).first()
-                        price = self.calc_up_limit(inst, last_bar)
-                        priority = PriorityType.High
-                    # 空头换月
-                    elif roll_over:
-                        signal = SignalType.ROLL_OPEN
-                        volume = pos.shares
-                        last_bar = DailyBar.objects.filter(exchange=inst.exchange, code=pos.code, time=day.date()).first()
-                        new_bar = DailyBar.objects.filter(exchange=inst.exchange, code=inst.main_code, time=day.date()).first()
-                        price = self.calc_down_limit(inst, new_bar)
-                        priority = PriorityType.Normal
-                        Signal.objects.update_or_create(
-                            code=pos.code, strategy=self.__strategy, instrument=inst, type=SignalType.ROLL_CLOSE, trigger_time=day,
-                            defaults={'price': self.calc_up_limit(inst, last_bar), 'volume': volume, 'priority': priority, 'processed': False})
-            # 开新仓
-            elif buy_sig or sell_sig:
-                start_cash = Performance.objects.last().unit_count
-                # 原始扎堆儿
-                profit = Trade.objects.filter(strategy=self.__strategy, instrument__section=inst.section).aggregate(sum=Sum('profit'))['sum']
-                profit = profit if profit else 0
-                risk_each = Decimal(df.atr[idx]) * Decimal(inst.volume_multiple)
-                volume_ori = (start_cash + profit) * risk / risk_each
-                volume = round(volume_ori)
-                print(f"{inst}: ({start_cash:,.0f} + {profit:,.0f}) / {risk_each:,.0f} = {volume_ori}")
-                if volume > 0:
-                    new_bar = DailyBar.objects.filter(exchange=inst.exchange, code=inst.main_code, time=day.date()).first()
-                    use_margin = new_bar.settlement * inst.volume_multiple * inst.margin_rate * volume
-                    price = self.calc_up_limit(inst, new_bar) if buy_sig else self.calc_down_limit(inst, new_bar)
-                    signal = SignalType.BUY if buy_sig else SignalType.SELL_SHORT
-                else:
-                    logger.info(f"做{'多' if buy_sig else '空'}{inst},单手风险:{risk_each:.0f},超出风控额度，放弃。")
-            if signal:
-                use_margin = use_margin if use_margin else 0
-                sig, _ = Signal.objects.update_or_create(
-                    code=signal_code if signal_code else inst.main_code,strategy=self.__strategy, instrument=inst, type=signal, trigger_time=day,
-                    defaults={'price': price, 'volume': volume, 'priority': priority, 'processed': False})
-                volume_ori = volume_ori if volume_ori else volume
-                logger.info(f"新信号: {sig}({volume_ori:.1f}手) "
-                            f"预估保证金: {use_margin:.0f}({use_margin/10000:.1f}万)")
-                return signal, use_margin
+            if bars is None:
+                bars = load_bar_history([inst.product_code], day)[inst.product_code]
+            if daily_bars is None:
+                daily_bars = load_daily_bar(day)
+            data = self.prepare_signal(inst, bars, daily_bars, self.load_signal_context())
+            if data is None:
+                return None, 0
+            proposal = compute_signal(data)
+            self.save_signals(day, {inst.product_code: inst}, [proposal])
+            if proposal.signals:
+                return proposal.signals[-1]['type'], proposal.use_margin
         except Exception as e:
             logger.warning(f'calc_signal 发生错误: {repr(e)}', exc_info=True)
         return None, 0
-
-    def calc_up_limit(self, inst: Instrument, bar: DailyBar):
-        settlement = bar.settlement
-        limit_ratio = str_to_number(self.raw_redis.get(f"LIMITRATIO:{inst.exchange}:{inst.product_code}:{bar.code}"))
-        price_tick = inst.price_tick
-        price = price_round(settlement * (Decimal(1) + Decimal(limit_ratio)), price_tick)
-        return price - price_tick
-
-    def calc_down_limit(self, inst: Instrument, bar: DailyBar):
-        settlement = bar.settlement
-        limit_ratio = str_to_number(self.raw_redis.get(f"LIMITRATIO:{inst.exchange}:{inst.product_code}:{bar.code}"))
-        price_tick = inst.price_tick
-        price = price_round(settlement * (Decimal(1) - Decimal(limit_ratio)), price_tick)
-        return price + price_tick
@@ -0,0 +1,156 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+大哥2.0 信号计算的纯计算部分, 不访问数据库和Redis, 在线程中执行时不占用事件循环
+输入由 TradeStrategy 准备好, 输出的信号由 TradeStrategy 统一写库
+"""
+import logging
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from panel.const import DirectionType, SignalType, PriorityType
+from trader.utils.bar_history import BarHistory
+from trader.utils.indicator import atr
+from trader.utils import price_round
+
+logger = logging.getLogger('CTPApi')
+
+
+@dataclass
+class SignalInput:
+    product_code: str
+    name: str
+    main_code: str
+    price_tick: Decimal
+    volume_multiple: int
+    margin_rate: Decimal
+    atr_n: int
+    stop_n: int
+    risk: Decimal
+    indicator: dict  # IndicatorState.values()
+    bars: BarHistory
+    limit: dict  # {合约: (结算价, 涨跌停幅度)}, 包含持仓合约和主力合约
+    pos_code: str = None
+    pos_direction: str = None
+    pos_shares: int = None
+    pos_open_date: str = None  # 考虑换月后最初开仓的日期
+    force_open: bool = False
+    start_cash: Decimal = None
+    section_profit: Decimal = Decimal(0)
+
+
+@dataclass
+class SignalProposal:
+    product_code: str
+    signals: list = field(default_factory=list)  # [{'code', 'type', 'price', 'volume', 'priority'}]
+    use_margin: Decimal = Decimal(0)
+    volume_ori: float = None
+    force_open_used: bool = False
+
+
+def up_limit(data: SignalInput, code: str):
+    """接近涨停的价格, 确保成交"""
+    settlement, limit_ratio = data.limit[code]
+    price = price_round(settlement * (Decimal(1) + Decimal(limit_ratio)), data.price_tick)
+    return price - data.price_tick
+
+
+def down_limit(data: SignalInput, code: str):
+    """接近跌停的价格, 确保成交"""
+    settlement, limit_ratio = data.limit[code]
+    price = price_round(settlement * (Decimal(1) - Decimal(limit_ratio)), data.price_tick)
+    return price + data.price_tick
+
+
+def compute_signal(data: SignalInput) -> SignalProposal:
+    """
+    根据指标和持仓计算单个品种的信号, 即《趋势交易》一书中的策略:
+    1. 只有在短期均线高于长期均线时才能开多仓
+    2. 只有在短期均线低于长期均线时才能开空仓
+    3. 如果收盘价是过去N天内最高价，在下一交易日买入
+    4. 如果收盘价是过去N天内最低价，在下一交易日卖出
+    5. 仓位大小基于ATR和风险因子计算: 手数 = (初始资金+板块盈亏) * 风险因子 / (ATR*合约乘数)
+    6. 多头止损设置在开仓以来最高价下方N个ATR
+    7. 空头止损设置在开仓以来最低价上方N个ATR
+    持仓合约不再是主力合约时换月
+    """
+    ind = data.indicator
+    proposal = SignalProposal(data.product_code)
+    # 多头信号：短期均线在长期均线上方且价格突破N日最高价
+    buy_sig = ind['short_trend'] > ind['long_trend'] and \
+        price_round(ind['close'], data.price_tick) >= price_round(ind['high_line'], data.price_tick)
+    # 空头信号：短期均线在长期均线下方且价格跌破N日最低价
+    sell_sig = ind['short_trend'] < ind['long_trend'] and \
+        price_round(ind['close'], data.price_tick) <= price_round(ind['low_line'], data.price_tick)
+    if data.pos_code is None and data.force_open and not buy_sig and not sell_sig:
+        logger.info(f'强制开仓: {data.name}')
+        if ind['short_trend'] > ind['long_trend']:
+            buy_sig = True
+        else:
+            sell_sig = True
+        proposal.force_open_used = True
+    if data.pos_code is not None:
+        roll_over = data.pos_code != data.main_code and data.pos_code < data.main_code
+        # 止损需要开仓以来的最高/最低价和开仓时的ATR
+        df = data.bars.to_df()
+        df["atr"] = atr(df.high, df.low, df.close, data.atr_n)
+        idx = -1
+        pos_idx = df.index.get_loc(data.pos_open_date)
+        if data.pos_direction == DirectionType.values[DirectionType.LONG]:
+            # 多头止损: 当前收盘价低于开仓以来最高价减去N倍ATR
+            if df.close.iloc[idx] <= df.high.iloc[pos_idx:idx].max() - df.atr.iloc[pos_idx - 1] * data.stop_n:
+                proposal.signals.append({
+                    'code': data.pos_code, 'type': SignalType.SELL, 'price': down_limit(data, data.pos_code),
+                    'volume': data.pos_shares, 'priority': PriorityType.High})
+            # 多头换月: 平旧仓(接近跌停价) 开新仓(接近涨停价)
+            elif roll_over:
+                proposal.signals.append({
+                    'code': data.pos_code, 'type': SignalType.ROLL_CLOSE, 'price': down_limit(data, data.pos_code),
+                    'volume': data.pos_shares, 'priority': PriorityType.Normal})
+                proposal.signals.append({
+                    'code': data.main_code, 'type': SignalType.ROLL_OPEN, 'price': up_limit(data, data.main_code),
+                    'volume': data.pos_shares, 'priority': PriorityType.Normal})
+        else:
+            # 空头止损: 当前收盘价高于开仓以来最低价加上N倍ATR
+            if df.close.iloc[idx] >= df.low.iloc[pos_idx:idx].min() + df.atr.iloc[pos_idx - 1] * data.stop_n:
+                proposal.signals.append({
+                    'code': data.pos_code, 'type': SignalType.BUY_COVER, 'price': up_limit(data, data.pos_code),
+                    'volume': data.pos_shares, 'priority': PriorityType.High})
+            # 空头换月
+            elif roll_over:
+                proposal.signals.append({
+                    'code': data.pos_code, 'type': SignalType.ROLL_CLOSE, 'price': up_limit(data, data.pos_code),
+                    'volume': data.pos_shares, 'priority': PriorityType.Normal})
+                proposal.signals.append({
+                    'code': data.main_code, 'type': SignalType.ROLL_OPEN, 'price': down_limit(data, data.main_code),
+                    'volume': data.pos_shares, 'priority': PriorityType.Normal})
+    # 开新仓
+    elif buy_sig or sell_sig:
+        risk_each = Decimal(ind['atr']) * Decimal(data.volume_multiple)
+        volume_ori = (data.start_cash + data.section_profit) * data.risk / risk_each
+        volume = round(volume_ori)
+        logger.debug(f"{data.name}: ({data.start_cash:,.0f} + {data.section_profit:,.0f}) / {risk_each:,.0f} = {volume_ori}")
+        if volume > 0:
+            settlement, _ = data.limit[data.main_code]
+            proposal.use_margin = settlement * data.volume_multiple * data.margin_rate * volume
+            proposal.volume_ori = volume_ori
+            proposal.signals.append({
+                'code': data.main_code, 'type': SignalType.BUY if buy_sig else SignalType.SELL_SHORT,
+                'price': up_limit(data, data.main_code) if buy_sig else down_limit(data, data.main_code),
+                'volume': volume, 'priority': PriorityType.LOW})
+        else:
+            logger.info(f"做{'多' if buy_sig else '空'}{data.name},单手风险:{risk_each:.0f},超出风控额度，放弃。")
+    return proposal
@@ -23,33 +23,36 @@ import xml.etree.ElementTree as ET
 import asyncio
 import os
 from functools import reduce
-from itertools import combinations
 
-import pytz
-import aiohttp
-from django.db.models import Q, F, Max, Min
+from django.db import connection, transaction
+from django.db.models import Q
 from django.utils import timezone
 import redis
-from talib import ATR
 from tqdm import tqdm
 
 from panel.models import *
 from trader.utils import ApiStruct
 from trader.utils.read_config import config
+from trader.utils.exchange_client import ExchangeClient
+from trader.utils.exchange_source import ExchangeSource, ReplaySource
+from trader.utils.trading_calendar import trading_calendar
+from trader.utils.db_executor import call_in_thread
+from trader.utils.indicator_state import indicator_store
+from trader.utils.strategy_param import param_cache
+from trader.utils.bar_history import load_bar_range
+from trader.utils.backtest import run_backtest, save_backtest
+from trader.utils.portfolio import PortfolioSelector
+from trader.utils.correlation import correlation_service
 
 logger = logging.getLogger('utils')
 
-max_conn_shfe = asyncio.Semaphore(15)
-max_conn_dce = asyncio.Semaphore(5)
-max_conn_gfex = asyncio.Semaphore(5)
-max_conn_czce = asyncio.Semaphore(15)
-max_conn_cffex = asyncio.Semaphore(15)
-max_conn_sina = asyncio.Semaphore(15)
 cffex_ip = 'www.cffex.com.cn'    # www.cffex.com.cn
 shfe_ip = 'www.shfe.com.cn'      # www.shfe.com.cn
 czce_ip = 'www.czce.com.cn'     # www.czce.com.cn
 dce_ip = 'www.dce.com.cn'        # www.dce.com.cn
 gfex_ip = 'www.gfex.com.cn'
+# 所有交易所请求共用的连接池, 括号内为各交易所的最大并发连接数
+exchange_client = ExchangeClient({shfe_ip: 15, dce_ip: 5, gfex_ip: 5, czce_ip: 15, cffex_ip: 15})
 IGNORE_INST_LIST = config.get('TRADE', 'ignore_inst').split(',')
 INE_INST_LIST = ['sc', 'bc', 'nr', 'lu']
 ORDER_REF_SIGNAL_ID_START = -5
@@ -92,20 +95,13 @@ def get_next_id():
 
 
 async def is_trading_day(day: datetime.datetime):
-    s = redis.StrictRedis(
-        host=config.get('REDIS', 'host', fallback='localhost'),
-        db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
-    return day, day.strftime('%Y%m%d') in (s.get('TradingDay'), s.get('LastTradingDay'))
+    return day, trading_calendar.is_trading_day(day)
 
 
-async def check_trading_day(day: datetime.datetime) -> (datetime.datetime, bool):
-    async with aiohttp.ClientSession() as session:
-        await max_conn_cffex.acquire()
-        async with session.get(
-                'http://{}/fzjy/mrhq/{}/index.xml'.format(cffex_ip, day.strftime('%Y%m/%d')),
-                allow_redirects=False) as response:
-            max_conn_cffex.release()
-            return day, response.status == 200
+async def check_trading_day(day: datetime.datetime, source: ExchangeSource = exchange_client) -> (datetime.datetime, bool):
+    response = await source.get(
+        'http://{}/fzjy/mrhq/{}/index.xml'.format(cffex_ip, day.strftime('%Y%m/%d')), allow_redirects=False)
+    return day, response.status == 200
 
 
 def get_expire_date(inst_code: str, day: datetime.datetime):
@@ -118,235 +114,292 @@ def get_expire_date(inst_code: str, day: datetime.datetime):
     return expire_date
 
 
-async def update_from_shfe(day: datetime.datetime) -> bool:
+DAILY_BAR_UPDATE_FIELDS = ['product_code', 'expire_date', 'open', 'high', 'low', 'close', 'settlement', 'volume', 'open_interest']
+
+
+def bulk_save_daily_bar(bar_list: list) -> int:
+    """
+    批量写入日K线, 一个交易所一天的数据只发一条 INSERT ... ON DUPLICATE KEY UPDATE
+    :param bar_list: list of DailyBar, 依赖 (exchange, code, time) 唯一索引
+    :return: int 写入条数
+    """
+    bar_dict = dict()
+    for bar in bar_list:  # 同一批次内的重复合约以最后一条为准
+        bar_dict[(bar.exchange, bar.code, bar.time)] = bar
+    if not bar_dict:
+        return 0
+    # MySQL 的 ON DUPLICATE KEY UPDATE 不能指定冲突字段
+    unique_fields = ['exchange', 'code', 'time'] if connection.features.supports_update_conflicts_with_target else None
+    DailyBar.objects.bulk_create(
+        bar_dict.values(), update_conflicts=True, unique_fields=unique_fields, update_fields=DAILY_BAR_UPDATE_FIELDS)
+    return len(bar_dict)
+
+
+def parse_shfe(day: datetime.datetime, rst: bytes, inst_name_dict: dict = None) -> list:
+    bar_list = []
+    rst_json = json.loads(rst)
+    for inst_data in rst_json['o_curinstrument']:
+        """
+{"PRODUCTID":"cu_f    ","PRODUCTGROUPID":"cu      ","PRODUCTSORTNO":10,"PRODUCTNAME":"铜                  ",
+"DELIVERYMONTH":"2112","PRESETTLEMENTPRICE":69850,"OPENPRICE":69770,"HIGHESTPRICE":70280,"LOWESTPRICE":69600,
+"CLOSEPRICE":69900,"SETTLEMENTPRICE":69950,"ZD1_CHG":50,"ZD2_CHG":100,"VOLUME":19450,"TURNOVER":680294.525,
+"TASVOLUME":"","OPENINTEREST":19065,"OPENINTERESTCHG":-5585,"ORDERNO":0,"ORDERNO2":0}
+        """
+        if inst_data['DELIVERYMONTH'] == '小计' or inst_data['PRODUCTID'] == '总计':
+            continue
+        if '_f' not in inst_data['PRODUCTID']:
+            continue
+        code = inst_data['PRODUCTGROUPID'].strip()
+        if code in IGNORE_INST_LIST:
+            continue
+        if inst_name_dict is not None and code not in inst_name_dict:
+            inst_name_dict[code] = inst_data['PRODUCTNAME'].strip()
+        exchange_str = ExchangeType.SHFE
+        # 上期能源的四个品种
+        if code in INE_INST_LIST:
+            exchange_str = ExchangeType.INE
+        bar_list.append(DailyBar(
+            code=code + inst_data['DELIVERYMONTH'], product_code=code, exchange=exchange_str, time=day,
+            expire_date=inst_data['DELIVERYMONTH'],
+            open=inst_data['OPENPRICE'] if inst_data['OPENPRICE'] else inst_data['CLOSEPRICE'],
+            high=inst_data['HIGHESTPRICE'] if inst_data['HIGHESTPRICE'] else inst_data['CLOSEPRICE'],
+            low=inst_data['LOWESTPRICE'] if inst_data['LOWESTPRICE'] else inst_data['CLOSEPRICE'],
+            close=inst_data['CLOSEPRICE'],
+            settlement=inst_data['SETTLEMENTPRICE'] if inst_data['SETTLEMENTPRICE'] else
+            inst_data['PRESETTLEMENTPRICE'],
+            volume=inst_data['VOLUME'] if inst_data['VOLUME'] else 0,
+            open_interest=inst_data['OPENINTEREST'] if inst_data['OPENINTEREST'] else 0))
+    return bar_list
+
+
+def parse_czce(day: datetime.datetime, rst: str) -> list:
+    bar_list = []
+    for lines in rst.split('\n')[1:-3]:
+        if '小计' in lines or '合约' in lines or '品种' in lines:
+            continue
+        inst_data = [x.strip() for x in lines.split('|' if '|' in lines else ',')]
+        """
+[0'合约代码', 1'昨结算', 2'今开盘', 3'最高价', 4'最低价', 5'今收盘', 6'今结算', 7'涨跌1', 8'涨跌2', 9'成交量(手)', 
+ 10'持仓量', 11'增减量', 12'成交额(万元)', 13'交割结算价']
+['CF601', '11,970.00', '11,970.00', '11,970.00', '11,800.00', '11,870.00', '11,905.00', '-100.00',
+ '-65.00', '13,826', '59,140', '-10,760', '82,305.24', '']
+        """
+        product_code = re.findall('[A-Za-z]+', inst_data[0])[0]
+        if product_code in IGNORE_INST_LIST:
+            continue
+        close = inst_data[5].replace(',', '') if Decimal(inst_data[5].replace(',', '')) > 0.1 \
+            else inst_data[6].replace(',', '')
+        bar_list.append(DailyBar(
+            code=inst_data[0], product_code=product_code, exchange=ExchangeType.CZCE, time=day,
+            expire_date=get_expire_date(inst_data[0], day),
+            open=inst_data[2].replace(',', '') if Decimal(inst_data[2].replace(',', '')) > 0.1 else close,
+            high=inst_data[3].replace(',', '') if Decimal(inst_data[3].replace(',', '')) > 0.1 else close,
+            low=inst_data[4].replace(',', '') if Decimal(inst_data[4].replace(',', '')) > 0.1 else close,
+            close=close,
+            settlement=inst_data[6].replace(',', '') if Decimal(inst_data[6].replace(',', '')) > 0.1 else
+            inst_data[1].replace(',', ''),
+            volume=inst_data[9].replace(',', ''),
+            open_interest=inst_data[10].replace(',', '')))
+    return bar_list
+
+
+def parse_dce(day: datetime.datetime, rst: str) -> list:
+    bar_list = []
+    for lines in rst.split('\r\n')[3:-3]:
+        if '小计' in lines or '品种' in lines:
+            continue
+        inst_data_raw = [x.strip() for x in lines.split('\t')]
+        inst_data = []
+        for cell in inst_data_raw:
+            if len(cell) > 0:
+                inst_data.append(cell)
+        """
+[0'商品名称', 1'交割月份', 2'开盘价', 3'最高价', 4'最低价', 5'收盘价', 6'前结算价', 7'结算价', 8'涨跌', 9'涨跌1', 10'成交量', 
+11'持仓量', 12'持仓量变化', 13'成交额']
+['豆一', '1611', '3,760', '3,760', '3,760', '3,760', '3,860', '3,760', '-100', '-100', '2', '0', '0', '7.52']
+        """
+        if '小计' in inst_data[0]:
+            continue
+        if DCE_NAME_CODE[inst_data[0]] in IGNORE_INST_LIST:
+            continue
+        bar_list.append(DailyBar(
+            code=inst_data[1], product_code=DCE_NAME_CODE[inst_data[0]], exchange=ExchangeType.DCE, time=day,
+            expire_date=inst_data[1].removeprefix(DCE_NAME_CODE[inst_data[0]]),
+            open=inst_data[2].replace(',', '') if inst_data[2] != '-' else inst_data[5].replace(',', ''),
+            high=inst_data[3].replace(',', '') if inst_data[3] != '-' else inst_data[5].replace(',', ''),
+            low=inst_data[4].replace(',', '') if inst_data[4] != '-' else inst_data[5].replace(',', ''),
+            close=inst_data[5].replace(',', ''),
+            settlement=inst_data[7].replace(',', '') if inst_data[7] != '-' else inst_data[6].replace(',', ''),
+            volume=inst_data[10].replace(',', ''),
+            open_interest=inst_data[11].replace(',', '')))
+    return bar_list
+
+
+def parse_gfex(day: datetime.datetime, rst: str, variety: str) -> list:
+    bar_list = []
+    for inst_code, inst_data in json.loads(rst)['contractQuote'].items():
+        bar_list.append(DailyBar(
+            code=inst_code, product_code=variety, exchange=ExchangeType.GFEX, time=day,
+            expire_date=inst_code.removeprefix(variety),
+            open=inst_data['openPrice'] if inst_data['openPrice'] != "--" else inst_data['closePrice'],
+            high=inst_data['highPrice'] if inst_data['highPrice'] != "--" else inst_data['closePrice'],
+            low=inst_data['lowPrice'] if inst_data['lowPrice'] != "--" else inst_data['closePrice'],
+            close=inst_data['closePrice'],
+            settlement=inst_data['clearPrice'],
+            volume=inst_data['matchTotQty'] if inst_data['matchTotQty'] != "--" else 0,
+            open_interest=inst_data['openInterest'] if inst_data['openInterest'] != "--" else 0))
+    return bar_list
+
+
+def parse_cffex(day: datetime.datetime, rst: str) -> list:
+    bar_list = []
+    tree = ET.fromstring(rst)
+    for inst_data in tree:
+        """
+        <dailydata>
+        <instrumentid>IC2112</instrumentid>
+        <tradingday>20211209</tradingday>
+        <openprice>7272</openprice>
+        <highestprice>7330</highestprice>
+        <lowestprice>7264.4</lowestprice>
+        <closeprice>7302.4</closeprice>
+        <preopeninterest>107546</preopeninterest>
+        <openinterest>101956</openinterest>
+        <presettlementprice>7274.4</presettlementprice>
+        <settlementpriceif>7314.2</settlementpriceif>
+        <settlementprice>7314.2</settlementprice>
+        <volume>51752</volume>
+        <turnover>75570943720</turnover>
+        <productid>IC</productid>
+        <delta/>
+        <expiredate>20211217</expiredate>
+        </dailydata>
+        """
+        # 不存储期权合约
+        if len(inst_data.findtext('instrumentid').strip()) > 6:
+            continue
+        if inst_data.findtext('productid').strip() in IGNORE_INST_LIST:
+            continue
+        close = inst_data.findtext('closeprice').replace(',', '')
+        bar_list.append(DailyBar(
+            code=inst_data.findtext('instrumentid').strip(), product_code=inst_data.findtext('productid').strip(),
+            exchange=ExchangeType.CFFEX, time=day,
+            expire_date=inst_data.findtext('expiredate')[2:6],
+            open=inst_data.findtext('openprice').replace(',', '') if inst_data.findtext('openprice') else close,
+            high=inst_data.findtext('highestprice').replace(',', '') if inst_data.findtext('highestprice') else close,
+            low=inst_data.findtext('lowestprice').replace(',', '') if inst_data.findtext('lowestprice') else close,
+            close=close,
+            settlement=inst_data.findtext('settlementprice').replace(',', '')
+            if inst_data.findtext('settlementprice') else inst_data.findtext('presettlementprice').replace(',', ''),
+            volume=inst_data.findtext('volume').replace(',', ''),
+            open_interest=inst_data.findtext('openinterest').replace(',', '')))
+    return bar_list
+
+
+GFEX_VARIETY_LIST = ['lc', 'si']
+
+
+async def fetch_daily_bar(exchange: str, day: datetime.datetime, source: ExchangeSource = exchange_client) -> list:
+    """
+    下载某个交易所一天的日线原始数据
+    :return: [(cache_key, ExchangeResponse)], 广期所按品种分多次请求
+    """
+    day_str = day.strftime('%Y%m%d')
+    response_list = []
+    match exchange:
+        case ExchangeType.SHFE:
+            cache_key = (ExchangeType.SHFE, day, 'dailydata')
+            response_list.append((cache_key, await source.get(
+                f'http://{shfe_ip}/data/tradedata/future/dailydata/kx{day_str}.dat', cache_key=cache_key)))
+        case ExchangeType.CZCE:
+            cache_key = (ExchangeType.CZCE, day, 'FutureDataDaily')
+            response_list.append((cache_key, await source.get(
+                f'http://{czce_ip}/cn/DFSStaticFiles/Future/{day.year}/{day_str}/FutureDataDaily.txt',
+                cache_key=cache_key)))
+        case ExchangeType.DCE:
+            cache_key = (ExchangeType.DCE, day, 'DayQuotes')
+            response_list.append((cache_key, await source.post(
+                f'http://{dce_ip}/publicweb/quotesdata/exportDayQuotesChData.html', data={
+                    'dayQuotes.variety': 'all', 'dayQuotes.trade_type': 0, 'exportFlag': 'txt',
+                    'year': day.year, 'month': day.month-1, 'day': day.day}, cache_key=cache_key)))
+        case ExchangeType.GFEX:
+            # 广期所接口不带日期, 只返回最新行情, 用它回补历史会把最新行情写到过去的日期上
+            if not isinstance(source, ReplaySource) and day.date() != timezone.localtime().date():
+                raise ValueError(f'广期所接口只能获取当天的行情, 不能回补 {day_str}')
+            for ids in GFEX_VARIETY_LIST:
+                # 按当天日期缓存以便日后回放
+                cache_key = (ExchangeType.GFEX, day, f'getQuote_ftr_{ids}')
+                response_list.append((cache_key, await source.post(
+                    f'http://{gfex_ip}/gfexweb/Quote/getQuote_ftr', data={'varietyid': ids}, cache_key=cache_key)))
+        case ExchangeType.CFFEX:
+            cache_key = (ExchangeType.CFFEX, day, 'rtj')
+            response_list.append((cache_key, await source.get(
+                f"http://{cffex_ip}/sj/hqsj/rtj/{day.strftime('%Y%m/%d')}/index.xml?id=7", cache_key=cache_key)))
+    for cache_key, response in response_list:
+        if response.status != 200:
+            raise ValueError(f'{exchange} {day_str} {cache_key[2]} 返回 {response.status}')
+    return response_list
+
+
+def parse_daily_bar(exchange: str, day: datetime.datetime, response_list: list, inst_name_dict: dict = None) -> list:
+    """
+    把 fetch_daily_bar 下载的原始数据解析成 DailyBar 列表, 不访问数据库
+    """
+    match exchange:
+        case ExchangeType.SHFE:
+            return parse_shfe(day, response_list[0][1].body, inst_name_dict)
+        case ExchangeType.CZCE:
+            return parse_czce(day, response_list[0][1].text())
+        case ExchangeType.DCE:
+            return parse_dce(day, response_list[0][1].text())
+        case ExchangeType.GFEX:
+            return [bar for ids, (_, response) in zip(GFEX_VARIETY_LIST, response_list)
+                    for bar in parse_gfex(day, response.text(), ids)]
+        case ExchangeType.CFFEX:
+            return parse_cffex(day, response_list[0][1].text())
+    return []
+
+
+def save_daily_bar(exchange: str, day: datetime.datetime, response_list: list):
+    """解析并保存 fetch_daily_bar 下载的数据, 在线程池中执行"""
+    inst_name_dict = {}
+    bulk_save_daily_bar(parse_daily_bar(exchange, day, response_list, inst_name_dict))
+    # 更新上期所合约中文名称
+    for code, name in inst_name_dict.items():
+        Instrument.objects.filter(product_code=code).update(name=name)
+
+
+async def update_daily_bar(exchange: str, day: datetime.datetime, source: ExchangeSource = exchange_client) -> bool:
+    response_list = []
     try:
-        async with aiohttp.ClientSession() as session:
-            day_str = day.strftime('%Y%m%d')
-            await max_conn_shfe.acquire()
-            async with session.get(f'http://{shfe_ip}/data/tradedata/future/dailydata/kx{day_str}.dat') as response:
-                rst = await response.read()
-                rst_json = json.loads(rst)
-                max_conn_shfe.release()
-                inst_name_dict = {}
-                for inst_data in rst_json['o_curinstrument']:
-                    """
-        {"PRODUCTID":"cu_f    ","PRODUCTGROUPID":"cu      ","PRODUCTSORTNO":10,"PRODUCTNAME":"铜                  ",
-        "DELIVERYMONTH":"2112","PRESETTLEMENTPRICE":69850,"OPENPRICE":69770,"HIGHESTPRICE":70280,"LOWESTPRICE":69600,
-        "CLOSEPRICE":69900,"SETTLEMENTPRICE":69950,"ZD1_CHG":50,"ZD2_CHG":100,"VOLUME":19450,"TURNOVER":680294.525,
-        "TASVOLUME":"","OPENINTEREST":19065,"OPENINTERESTCHG":-5585,"ORDERNO":0,"ORDERNO2":0}
-                    """
-                    # error_data = inst_data
-                    if inst_data['DELIVERYMONTH'] == '小计' or inst_data['PRODUCTID'] == '总计':
-                        continue
-                    if '_f' not in inst_data['PRODUCTID']:
-                        continue
-                    # logger.info(f'inst_data: {inst_data}')
-                    code = inst_data['PRODUCTGROUPID'].strip()
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    name = inst_data['PRODUCTNAME'].strip()
-                    if code not in inst_name_dict:
-                        inst_name_dict[code] = name
-                    exchange_str = ExchangeType.SHFE
-                    # 上期能源的四个品种
-                    if code in INE_INST_LIST:
-                        exchange_str = ExchangeType.INE
-                    DailyBar.objects.update_or_create(
-                        code=code + inst_data['DELIVERYMONTH'],
-                        exchange=exchange_str, time=day, defaults={
-                            'expire_date': inst_data['DELIVERYMONTH'],
-                            'open': inst_data['OPENPRICE'] if inst_data['OPENPRICE'] else inst_data['CLOSEPRICE'],
-                            'high': inst_data['HIGHESTPRICE'] if inst_data['HIGHESTPRICE'] else
-                            inst_data['CLOSEPRICE'],
-                            'low': inst_data['LOWESTPRICE'] if inst_data['LOWESTPRICE']
-                            else inst_data['CLOSEPRICE'],
-                            'close': inst_data['CLOSEPRICE'],
-                            'settlement': inst_data['SETTLEMENTPRICE'] if inst_data['SETTLEMENTPRICE'] else
-                            inst_data['PRESETTLEMENTPRICE'],
-                            'volume': inst_data['VOLUME'] if inst_data['VOLUME'] else 0,
-                            'open_interest': inst_data['OPENINTEREST'] if inst_data['OPENINTEREST'] else 0})
-                # 更新上期所合约中文名称
-                for code, name in inst_name_dict.items():
-                    Instrument.objects.filter(product_code=code).update(name=name)
+        response_list = await fetch_daily_bar(exchange, day, source)
+        await asyncio.get_running_loop().run_in_executor(None, call_in_thread, save_daily_bar, exchange, day, response_list)
         return True
     except Exception as e:
-        logger.warning(f'update_from_shfe failed: {repr(e)}', exc_info=True)
+        for cache_key, _ in response_list:
+            source.discard(cache_key)
+        logger.warning(f'update_from_{exchange.lower()} failed: {repr(e)}', exc_info=True)
         return False
 
 
-async def update_from_czce(day: datetime.datetime) -> bool:
-    try:
-        async with aiohttp.ClientSession() as session:
-            day_str = day.strftime('%Y%m%d')
-            async with session.get(
-                    f'http://{czce_ip}/cn/DFSStaticFiles/Future/{day.year}/{day_str}/FutureDataDaily.txt') as response:
-                rst = await response.text()
-                for lines in rst.split('\n')[1:-3]:
-                    if '小计' in lines or '合约' in lines or '品种' in lines:
-                        continue
-                    inst_data = [x.strip() for x in lines.split('|' if '|' in lines else ',')]
-                    """
-        [0'合约代码', 1'昨结算', 2'今开盘', 3'最高价', 4'最低价', 5'今收盘', 6'今结算', 7'涨跌1', 8'涨跌2', 9'成交量(手)', 
-         10'持仓量', 11'增减量', 12'成交额(万元)', 13'交割结算价']
-        ['CF601', '11,970.00', '11,970.00', '11,970.00', '11,800.00', '11,870.00', '11,905.00', '-100.00',
-         '-65.00', '13,826', '59,140', '-10,760', '82,305.24', '']
-                    """
-                    # print(f'inst_data: {inst_data}')
-                    if re.findall('[A-Za-z]+', inst_data[0])[0] in IGNORE_INST_LIST:
-                        continue
-                    close = inst_data[5].replace(',', '') if Decimal(inst_data[5].replace(',', '')) > 0.1 \
-                        else inst_data[6].replace(',', '')
-                    DailyBar.objects.update_or_create(
-                        code=inst_data[0],
-                        exchange=ExchangeType.CZCE, time=day, defaults={
-                            'expire_date': get_expire_date(inst_data[0], day),
-                            'open': inst_data[2].replace(',', '') if Decimal(inst_data[2].replace(',', '')) > 0.1
-                            else close,
-                            'high': inst_data[3].replace(',', '') if Decimal(inst_data[3].replace(',', '')) > 0.1
-                            else close,
-                            'low': inst_data[4].replace(',', '') if Decimal(inst_data[4].replace(',', '')) > 0.1
-                            else close,
-                            'close': close,
-                            'settlement': inst_data[6].replace(',', '') if
-                            Decimal(inst_data[6].replace(',', '')) > 0.1 else inst_data[1].replace(',', ''),
-                            'volume': inst_data[9].replace(',', ''),
-                            'open_interest': inst_data[10].replace(',', '')})
-                return True
-    except Exception as e:
-        logger.warning(f'update_from_czce failed: {repr(e)}', exc_info=True)
-        return False
+async def update_from_shfe(day: datetime.datetime, source: ExchangeSource = exchange_client) -> bool:
+    return await update_daily_bar(ExchangeType.SHFE, day, source)
 
 
-async def update_from_dce(day: datetime.datetime) -> bool:
-    try:
-        async with aiohttp.ClientSession() as session:
-            await max_conn_dce.acquire()
-            async with session.post(f'http://{dce_ip}/publicweb/quotesdata/exportDayQuotesChData.html', data={
-                    'dayQuotes.variety': 'all', 'dayQuotes.trade_type': 0, 'exportFlag': 'txt',
-                    'year': day.year, 'month': day.month-1, 'day': day.day}) as response:
-                rst = await response.text()
-                max_conn_dce.release()
-                for lines in rst.split('\r\n')[3:-3]:
-                    if '小计' in lines or '品种' in lines:
-                        continue
-                    inst_data_raw = [x.strip() for x in lines.split('\t')]
-                    inst_data = []
-                    for cell in inst_data_raw:
-                        if len(cell) > 0:
-                            inst_data.append(cell)
-                    """
-    [0'商品名称', 1'交割月份', 2'开盘价', 3'最高价', 4'最低价', 5'收盘价', 6'前结算价', 7'结算价', 8'涨跌', 9'涨跌1', 10'成交量', 
-     11'持仓量', 12'持仓量变化', 13'成交额']
-    ['豆一', '1611', '3,760', '3,760', '3,760', '3,760', '3,860', '3,760', '-100', '-100', '2', '0', '0', '7.52']
-                    """
-                    if '小计' in inst_data[0]:
-                        continue
-                    if DCE_NAME_CODE[inst_data[0]] in IGNORE_INST_LIST:
-                        continue
-                    expire_date = inst_data[1].removeprefix(DCE_NAME_CODE[inst_data[0]])
-                    DailyBar.objects.update_or_create(
-                        code=inst_data[1],
-                        exchange=ExchangeType.DCE, time=day, defaults={
-                            'expire_date': expire_date,
-                            'open': inst_data[2].replace(',', '') if inst_data[2] != '-' else
-                            inst_data[5].replace(',', ''),
-                            'high': inst_data[3].replace(',', '') if inst_data[3] != '-' else
-                            inst_data[5].replace(',', ''),
-                            'low': inst_data[4].replace(',', '') if inst_data[4] != '-' else
-                            inst_data[5].replace(',', ''),
-                            'close': inst_data[5].replace(',', ''),
-                            'settlement': inst_data[7].replace(',', '') if inst_data[7] != '-' else
-                            inst_data[6].replace(',', ''),
-                            'volume': inst_data[10].replace(',', ''),
-                            'open_interest': inst_data[11].replace(',', '')})
-                return True
-    except Exception as e:
-        logger.warning(f'update_from_dce failed: {repr(e)}', exc_info=True)
-        return False
+async def update_from_czce(day: datetime.datetime, source: ExchangeSource = exchange_client) -> bool:
+    return await update_daily_bar(ExchangeType.CZCE, day, source)
 
 
-async def update_from_gfex(day: datetime.datetime) -> bool:
-    try:
-        async with aiohttp.ClientSession() as session:
-            await max_conn_gfex.acquire()
-            for ids in ['lc', 'si']:
-                async with session.post(f'http://{gfex_ip}/gfexweb/Quote/getQuote_ftr', data={'varietyid': ids}) as response:
-                    rst = await response.text()
-                    rst = json.loads(rst)
-                    max_conn_gfex.release()
-                    for inst_code, inst_data in rst['contractQuote'].items():
-                        expire_date = inst_code.removeprefix(ids)
-                        DailyBar.objects.update_or_create(
-                            code=inst_code,
-                            exchange=ExchangeType.GFEX, time=day, defaults={
-                                'expire_date': expire_date,
-                                'open': inst_data['openPrice'] if inst_data['openPrice'] != "--" else inst_data['closePrice'],
-                                'high': inst_data['highPrice'] if inst_data['highPrice'] != "--" else inst_data['closePrice'],
-                                'low': inst_data['lowPrice'] if inst_data['lowPrice'] != "--" else inst_data['closePrice'],
-                                'close': inst_data['closePrice'],
-                                'settlement': inst_data['clearPrice'],
-                                'volume': inst_data['matchTotQty'] if inst_data['matchTotQty'] != "--" else 0,
-                                'open_interest': inst_data['openInterest'] if inst_data['openInterest'] != "--" else 0})
-    except Exception as e:
-        logger.warning(f'update_from_gfex failed: {repr(e)}', exc_info=True)
-        return False
-    return True
+async def update_from_dce(day: datetime.datetime, source: ExchangeSource = exchange_client) -> bool:
+    return await update_daily_bar(ExchangeType.DCE, day, source)
 
 
-async def update_from_cffex(day: datetime.datetime) -> bool:
-    try:
-        async with aiohttp.ClientSession() as session:
-            await max_conn_cffex.acquire()
-            async with session.get(f"http://{cffex_ip}/sj/hqsj/rtj/{day.strftime('%Y%m/%d')}/index.xml?id=7") as response:
-                rst = await response.text()
-                max_conn_cffex.release()
-                tree = ET.fromstring(rst)
-                for inst_data in tree:
-                    """
-                    <dailydata>
-                    <instrumentid>IC2112</instrumentid>
-                    <tradingday>20211209</tradingday>
-                    <openprice>7272</openprice>
-                    <highestprice>7330</highestprice>
-                    <lowestprice>7264.4</lowestprice>
-                    <closeprice>7302.4</closeprice>
-                    <preopeninterest>107546</preopeninterest>
-                    <openinterest>101956</openinterest>
-                    <presettlementprice>7274.4</presettlementprice>
-                    <settlementpriceif>7314.2</settlementpriceif>
-                    <settlementprice>7314.2</settlementprice>
-                    <volume>51752</volume>
-                    <turnover>75570943720</turnover>
-                    <productid>IC</productid>
-                    <delta/>
-                    <expiredate>20211217</expiredate>
-                    </dailydata>
-                    """
-                    # 不存储期权合约
-                    if len(inst_data.findtext('instrumentid').strip()) > 6:
-                        continue
-                    if inst_data.findtext('productid').strip() in IGNORE_INST_LIST:
-                        continue
-                    DailyBar.objects.update_or_create(
-                        code=inst_data.findtext('instrumentid').strip(),
-                        exchange=ExchangeType.CFFEX, time=day, defaults={
-                            'expire_date': inst_data.findtext('expiredate')[2:6],
-                            'open': inst_data.findtext('openprice').replace(',', '') if inst_data.findtext(
-                                'openprice') else inst_data.findtext('closeprice').replace(',', ''),
-                            'high': inst_data.findtext('highestprice').replace(',', '') if inst_data.findtext(
-                                'highestprice') else inst_data.findtext('closeprice').replace(',', ''),
-                            'low': inst_data.findtext('lowestprice').replace(',', '') if inst_data.findtext(
-                                'lowestprice') else inst_data.findtext('closeprice').replace(',', ''),
-                            'close': inst_data.findtext('closeprice').replace(',', ''),
-                            'settlement': inst_data.findtext('settlementprice').replace(',', '')
-                            if inst_data.findtext('settlementprice') else
-                            inst_data.findtext('presettlementprice').replace(',', ''),
-                            'volume': inst_data.findtext('volume').replace(',', ''),
-                            'open_interest': inst_data.findtext('openinterest').replace(',', '')})
-                return True
-    except Exception as e:
-        logger.warning(f'update_from_cffex failed: {repr(e)}', exc_info=True)
-        return False
+async def update_from_gfex(day: datetime.datetime, source: ExchangeSource = exchange_client) -> bool:
+    return await update_daily_bar(ExchangeType.GFEX, day, source)
+
+
+async def update_from_cffex(day: datetime.datetime, source: ExchangeSource = exchange_client) -> bool:
+    return await update_daily_bar(ExchangeType.CFFEX, day, source)
 
 
 def store_main_bar(inst: Instrument, bar: DailyBar):
@@ -364,18 +417,65 @@ def store_main_bar(inst: Instrument, bar: DailyBar):
 
 def handle_rollover(inst: Instrument, new_bar: DailyBar):
     """
-    换月处理, 基差=新合约收盘价-旧合约收盘价, 从今日起之前的所有连续合约的OHLC加上基差
+    换月处理, 基差=新合约收盘价-旧合约收盘价, 记录到 MainBarAdjust
+    MainBar 保存原始价格, 读取时 MainBar.objects.adjusted() 给今日之前的K线加上基差
     """
     old_bar = DailyBar.objects.filter(exchange=inst.exchange, code=inst.last_main, time=new_bar.time).first()
-    main_bar = MainBar.objects.get(exchange=inst.exchange, product_code=inst.product_code, time=new_bar.time)
     old_close = old_bar.close if old_bar else new_bar.close
     basis = new_bar.close - old_close
-    main_bar.basis = basis
-    basis = float(basis)
-    main_bar.save(update_fields=['basis'])
-    MainBar.objects.filter(exchange=inst.exchange, product_code=inst.product_code, time__lt=new_bar.time).update(
-        open=F('open') + basis, high=F('high') + basis, low=F('low') + basis, close=F('close') + basis,
-        settlement=F('settlement') + basis)
+    MainBar.objects.filter(exchange=inst.exchange, product_code=inst.product_code, time=new_bar.time).update(basis=basis)
+    MainBarAdjust.objects.update_or_create(
+        exchange=inst.exchange, product_code=inst.product_code, time=new_bar.time, defaults={'basis': basis})
+    indicator_store.invalidate(inst.product_code)  # 复权价格变了, 指标需要重新计算
+    correlation_service.invalidate()  # 复权前的收益率也变了
+
+
+def fill_daily_bar_product_code():
+    """
+    一次性转换: 给没有 product_code 的历史日线补上品种代码, 按合约逐个更新, 每次都走 code 索引
+    """
+    code_list = DailyBar.objects.filter(product_code__isnull=True).values_list('code', flat=True).distinct()
+    for code in tqdm(list(code_list)):
+        product_code = re.match('[A-Za-z]+', code)
+        if product_code is not None:
+            DailyBar.objects.filter(code=code, product_code__isnull=True).update(product_code=product_code.group())
+    print('all done!')
+
+
+def unadjust_main_bar(inst: Instrument):
+    """
+    一次性转换: 旧版 handle_rollover 直接把基差累加到了历史K线上,
+    按 MainBar.basis 生成 MainBarAdjust 并把历史K线还原为原始价格
+    新版 handle_rollover 同时写 MainBar.basis 和 MainBarAdjust, 没有对应 MainBarAdjust 的基差才是旧版留下的,
+    只还原这些基差, 转换前已经按新版换过月的品种也能正确转换, 重复运行不会重复还原
+    """
+    adjusted = set(MainBarAdjust.objects.filter(
+        exchange=inst.exchange, product_code=inst.product_code).values_list('time', flat=True))
+    bar_list = list(MainBar.objects.filter(exchange=inst.exchange, product_code=inst.product_code).order_by('-time'))
+    if not any(bar.basis and bar.time not in adjusted for bar in bar_list):
+        logger.info(f'{inst} 已经转换过, 跳过')
+        return False
+    adjust_list = []
+    adjust = Decimal(0)
+    for bar in bar_list:  # 日期倒序, adjust 为该K线之后所有旧版换月基差之和
+        if adjust:
+            for field in MAIN_BAR_PRICE_FIELDS:
+                if getattr(bar, field) is not None:
+                    setattr(bar, field, getattr(bar, field) - adjust)
+        if bar.basis and bar.time not in adjusted:
+            adjust_list.append(MainBarAdjust(
+                exchange=inst.exchange, product_code=inst.product_code, time=bar.time, basis=bar.basis))
+            adjust += bar.basis
+    with transaction.atomic():
+        MainBar.objects.bulk_update(bar_list, MAIN_BAR_PRICE_FIELDS, batch_size=1000)
+        MainBarAdjust.objects.bulk_create(adjust_list)
+    return True
+
+
+def unadjust_main_bar_all():
+    for inst in Instrument.objects.all():
+        print(inst, unadjust_main_bar(inst))
+    print('all done!')
 
 
 def calc_main_inst(inst: Instrument, day: datetime.datetime):
@@ -384,22 +484,23 @@ def calc_main_inst(inst: Instrument, day: datetime.datetime):
     # 条件1: 成交量最大 & (成交量>1万 & 持仓量>1万 or 股指) = 主力合约
     check_bar = DailyBar.objects.filter(
         (Q(exchange=ExchangeType.CFFEX) | (Q(volume__gte=10000) & Q(open_interest__gte=10000))),
-        exchange=inst.exchange, code__regex=f"^{inst.product_code}[0-9]+",
+        exchange=inst.exchange, product_code=inst.product_code,
         expire_date__gte=expire_date, time=day.date()).order_by('-volume').first()
     # 条件2: 不满足条件1但是连续3天成交量最大 = 主力合约
     if check_bar is None:
         check_bars = DailyBar.objects.raw(
-            "SELECT a.* from panel_dailybar a INNER JOIN (SELECT time, max(volume) v FROM panel_dailybar "
-            "WHERE CODE RLIKE %s and time<=%s GROUP BY time ORDER BY time DESC LIMIT 3) b "
-            "WHERE a.time=b.time and a.volume=b.v ORDER BY a.time DESC LIMIT 3", [f"^{inst.product_code}[0-9]+", day])
+            "SELECT a.* FROM panel_dailybar a INNER JOIN (SELECT time, max(volume) v FROM panel_dailybar "
+            "WHERE exchange=%s AND product_code=%s AND time<=%s GROUP BY time ORDER BY time DESC LIMIT 3) b "
+            "ON a.time=b.time AND a.volume=b.v WHERE a.exchange=%s AND a.product_code=%s ORDER BY a.time DESC LIMIT 3",
+            [inst.exchange, inst.product_code, day.date(), inst.exchange, inst.product_code])
         check_bar = check_bars[0] if len(set(bar.code for bar in check_bars)) == 1 else None
     # 条件3: 取当前成交量最大的作为主力
     if check_bar is None:
         check_bar = DailyBar.objects.filter(
-            exchange=inst.exchange, code__regex=f"^{inst.product_code}[0-9]+",
+            exchange=inst.exchange, product_code=inst.product_code,
             expire_date__gte=expire_date, time=day.date()).order_by('-volume', '-open_interest', 'code').first()
     if check_bar is None:
-        check_bar = DailyBar.objects.filter(code=inst.main_code).last()
+        check_bar = DailyBar.objects.filter(exchange=inst.exchange, code=inst.main_code).order_by('time').last()
         logger.error(f"calc_main_inst 未找到主力合约：{inst} 使用上一个主力合约")
     if inst.main_code is None:  # 之前没有主力合约
         inst.main_code = check_bar.code
@@ -421,26 +522,114 @@ def calc_main_inst(inst: Instrument, day: datetime.datetime):
     return inst.main_code, updated
 
 
-def create_main(inst: Instrument):
+MAIN_BAR_VALUE_FIELDS = ['open', 'high', 'low', 'close', 'settlement', 'volume', 'open_interest']
+
+
+def build_main_bar(inst: Instrument, start: datetime.date = None):
+    """
+    批量计算主力合约, 规则与 calc_main_inst 相同, 但整个品种只查一次 DailyBar:
+    1. 成交量最大 & (成交量>1万 & 持仓量>1万 or 股指)
+    2. 不满足条件1但是连续3天成交量最大
+    3. 取当前成交量最大的作为主力
+    与日期无关的部分(条件2、排序)用 pandas 整体计算, 只有依赖当前主力的部分逐日循环
+    :param inst: 品种, 使用其 main_code/last_main 作为初始状态
+    :param start: 只计算 start 之后(不含)的日期, 为空时从头计算
+    :return: (MainBar列表, MainBarAdjust列表), inst 的主力状态会被更新(不保存)
+    """
+    bar_qs = DailyBar.objects.filter(exchange=inst.exchange, product_code=inst.product_code)
+    if start is not None:  # 条件2需要往前看3个交易日
+        bar_qs = bar_qs.filter(time__gt=start - datetime.timedelta(days=20))
+    df = pd.DataFrame.from_records(list(bar_qs.values_list('time', 'code', 'expire_date', *MAIN_BAR_VALUE_FIELDS)),
+                                   columns=['time', 'code', 'expire_date', *MAIN_BAR_VALUE_FIELDS])
+    if df.empty:
+        return [], []
+    df['oi'] = df.open_interest.astype(float)
+    df['expire'] = df.expire_date.fillna(-1).astype(int)
+    df['qualified'] = (inst.exchange == ExchangeType.CFFEX) | ((df.volume >= 10000) & (df.oi >= 10000))
+    # 每天的合约按 成交量降序, 持仓量降序, 合约代码升序 排列, 条件1和条件3各取第一个满足到期日要求的
+    df = df.sort_values(['time', 'volume', 'oi', 'code'], ascending=[True, False, False, True], ignore_index=True)
+    # 条件2: 每天成交量最大的合约连续3天相同
+    top = df.drop_duplicates('time')
+    top_same = (top.code == top.code.shift(1)) & (top.code == top.code.shift(2))
+    rule2_dict = dict(zip(top.time[top_same], top.index[top_same]))
+    close_dict = dict(zip(zip(df.code, df.time), df.close))
+    code_arr = df.code.to_numpy()
+    expire_arr = df.expire.to_numpy()
+    qualified_arr = df.qualified.to_numpy()
+    main_list, adjust_list = [], []
+    expire_cache = dict()
+    for day, idx in df.groupby('time', sort=True).indices.items():
+        if start is not None and day <= start:
+            continue
+        if inst.main_code:
+            key = (inst.main_code, day.year)
+            if key not in expire_cache:
+                expire_cache[key] = get_expire_date(inst.main_code, day)
+            expire_date = expire_cache[key]
+        else:
+            expire_date = int(day.strftime('%y%m'))
+        valid = idx[expire_arr[idx] >= expire_date]
+        rule1 = valid[qualified_arr[valid]]
+        if len(rule1):
+            row = rule1[0]
+        elif day in rule2_dict:
+            row = rule2_dict[day]
+        elif len(valid):
+            row = valid[0]
+        else:
+            row = next((i for i in idx if code_arr[i] == inst.main_code), None)
+            logger.error(f"build_main_bar 未找到主力合约：{inst} {day} 使用上一个主力合约")
+            if row is None:
+                continue
+        code = code_arr[row]
+        basis = None
+        if inst.main_code is None:
+            inst.main_code = code
+            inst.change_time = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+        elif code != inst.main_code and code > inst.main_code:
+            basis = df.close[row] - close_dict.get((inst.main_code, day), df.close[row])
+            inst.last_main = inst.main_code
+            inst.main_code = code
+            inst.change_time = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+            adjust_list.append(MainBarAdjust(
+                exchange=inst.exchange, product_code=inst.product_code, time=day, basis=basis))
+        main_list.append(MainBar(
+            exchange=inst.exchange, product_code=inst.product_code, code=code, time=day, basis=basis,
+            **{field: df[field][row] for field in MAIN_BAR_VALUE_FIELDS}))
+    return main_list, adjust_list
+
+
+def save_main_bar(inst: Instrument, main_list: list, adjust_list: list, start: datetime.date = None):
+    """用 build_main_bar 的结果替换 start 之后(不含)的连续合约"""
+    main_qs = MainBar.objects.filter(exchange=inst.exchange, product_code=inst.product_code)
+    adjust_qs = MainBarAdjust.objects.filter(exchange=inst.exchange, product_code=inst.product_code)
+    if start is not None:
+        main_qs = main_qs.filter(time__gt=start)
+        adjust_qs = adjust_qs.filter(time__gt=start)
+    with transaction.atomic():
+        main_qs.delete()
+        adjust_qs.delete()
+        MainBar.objects.bulk_create(main_list, batch_size=1000)
+        MainBarAdjust.objects.bulk_create(adjust_list)
+    indicator_store.invalidate(inst.product_code)
+    correlation_service.invalidate()
+
+
+def create_main(inst: Instrument, save_inst: bool = True):
     print('processing ', inst.product_code)
-    if inst.change_time is None:
-        for day in DailyBar.objects.filter(
-                # time__gte=datetime.datetime.strptime('20211211', '%Y%m%d'),
-                exchange=inst.exchange, code__regex='^{}[0-9]+'.format(inst.product_code)).order_by(
-                'time').values_list('time', flat=True).distinct():
-            print(day, calc_main_inst(inst, timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))))
-    else:
-        for day in DailyBar.objects.filter(
-                time__gt=inst.change_time,
-                exchange=inst.exchange, code__regex='^{}[0-9]+'.format(inst.product_code)).order_by(
-                'time').values_list('time', flat=True).distinct():
-            print(day, calc_main_inst(inst, timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))))
+    start = timezone.localtime(inst.change_time).date() if inst.change_time else None
+    main_list, adjust_list = build_main_bar(inst, start)
+    save_main_bar(inst, main_list, adjust_list, start)
+    if save_inst:
+        inst.save(update_fields=['last_main', 'main_code', 'change_time'])
     return True
 
 
 def create_main_all():
-    for inst in Instrument.objects.all():
-        create_main(inst)
+    inst_list = list(Instrument.objects.all())
+    for inst in inst_list:
+        create_main(inst, save_inst=False)
+    Instrument.objects.bulk_update(inst_list, ['last_main', 'main_code', 'change_time'])
     print('all done!')
 
 
@@ -463,16 +652,10 @@ def calc_sma(price, period):
 
 
 def calc_corr(day: datetime.datetime):
-    price_dict = dict()
-    begin_day = day.replace(year=day.year - 3)
-    for code in Strategy.objects.get(name='大哥2.0').instruments.all().order_by('id').values_list(
-            'product_code', flat=True):
-        price_dict[code] = to_df(MainBar.objects.filter(
-            time__gte=begin_day.date(),
-            product_code=code).order_by('time').values_list('time', 'close'), index_col='time', parse_dates=['time'])
-        price_dict[code].index = pd.DatetimeIndex(price_dict[code].time)
-        price_dict[code]['price'] = price_dict[code].close.pct_change()
-    return pd.DataFrame({k: v.price for k, v in price_dict.items()}).corr()
+    """策略全部品种截止 day 的日收益率相关系数矩阵, 见 trader.utils.correlation"""
+    code_list = list(Strategy.objects.get(name='大哥2.0').instruments.all().order_by('id').values_list(
+        'product_code', flat=True))
+    return correlation_service.corr(code_list, day)
 
 
 def nCr(n, r):
@@ -480,138 +663,41 @@ def nCr(n, r):
     return f(n) / f(r) / f(n-r)
 
 
-def find_best_score(n: int = 20):
+def find_best_score(n: int = 20, method: str = 'local', time_budget: float = 10, top_k: int = 3):
     """
-    一秒钟算5个组合，要算100年..
+    从策略的全部品种中选出相关性最低的 n 个, 方法和得分见 trader.utils.portfolio
     """
     corr_matrix = calc_corr(datetime.datetime.today())
-    code_list = Strategy.objects.get(name='大哥2.0').instruments.all().order_by('id').values_list(
-        'product_code', flat=True)
-    result = list()
-    for code_list in tqdm(combinations(code_list, n), total=nCr(code_list.count(), n)):
-        score_df = pd.DataFrame([corr_matrix.iloc[i, j] for i, j in combinations(code_list, 2)])
-        score = (round((1 - (score_df.abs() ** 2).mean()[0]) * 100, 3) - 50) * 2
-        result.append((score, ','.join(code_list)))
-    result.sort(key=lambda tup: tup[0])
-    print('得分最高: ', result[-3:])
-    print('得分最低: ', result[:3])
-
-
-def calc_history_signal(inst: Instrument, day: datetime.datetime, strategy: Strategy):
-    break_n = strategy.param_set.get(code='BreakPeriod').int_value
-    atr_n = strategy.param_set.get(code='AtrPeriod').int_value
-    long_n = strategy.param_set.get(code='LongPeriod').int_value
-    short_n = strategy.param_set.get(code='ShortPeriod').int_value
-    stop_n = strategy.param_set.get(code='StopLoss').int_value
-    df = to_df(MainBar.objects.filter(
-        time__lte=day.date(),
-        exchange=inst.exchange, product_code=inst.product_code).order_by('time').values_list(
-        'time', 'open', 'high', 'low', 'close', 'settlement'), index_col='time', parse_dates=['time'])
-    df.index = pd.DatetimeIndex(df.time, tz=pytz.FixedOffset(480))
-    df['atr'] = ATR(df.high, df.low, df.close, timeperiod=atr_n)
-    # df columns: 0:time,1:open,2:high,3:low,4:close,5:settlement,6:atr,7:short_trend,8:long_trend
-    df['short_trend'] = df.close
-    df['long_trend'] = df.close
-    for idx in range(1, df.shape[0]):
-        df.iloc[idx, 7] = (df.iloc[idx - 1, 7] * (short_n - 1) + df.iloc[idx, 4]) / short_n
-        df.iloc[idx, 8] = (df.iloc[idx - 1, 8] * (long_n - 1) + df.iloc[idx, 4]) / long_n
-    df['high_line'] = df.close.rolling(window=break_n).max()
-    df['low_line'] = df.close.rolling(window=break_n).min()
-    cur_pos = 0
-    last_trade = None
-    for cur_idx in range(break_n+1, df.shape[0]):
-        idx = cur_idx - 1
-        cur_date = df.index[cur_idx].to_pydatetime()
-        prev_date = df.index[idx].to_pydatetime()
-        if cur_pos == 0:
-            if df.short_trend[idx] > df.long_trend[idx] and int(df.close[idx]) >= int(df.high_line[idx-1]):
-                new_bar = MainBar.objects.filter(
-                    exchange=inst.exchange, product_code=inst.product_code, time=cur_date).first()
-                Signal.objects.create(
-                    code=new_bar.code, trigger_value=df.atr[idx],
-                    strategy=strategy, instrument=inst, type=SignalType.BUY, processed=True,
-                    trigger_time=prev_date, price=new_bar.open, volume=1, priority=PriorityType.LOW)
-                last_trade = Trade.objects.create(
-                    broker=strategy.broker, strategy=strategy, instrument=inst,
-                    code=new_bar.code, direction=DirectionType.values[DirectionType.LONG],
-                    open_time=cur_date, shares=1, filled_shares=1, avg_entry_price=new_bar.open)
-                cur_pos = cur_idx
-            elif df.short_trend[idx] < df.long_trend[idx] and int(df.close[idx]) < int(df.low_line[idx-1]):
-                new_bar = MainBar.objects.filter(
-                    exchange=inst.exchange, product_code=inst.product_code,
-                    time=df.index[cur_idx].to_pydatetime().date()).first()
-                Signal.objects.create(
-                    code=new_bar.code, trigger_value=df.atr[idx],
-                    strategy=strategy, instrument=inst, type=SignalType.SELL_SHORT, processed=True,
-                    trigger_time=prev_date, price=new_bar.open, volume=1, priority=PriorityType.LOW)
-                last_trade = Trade.objects.create(
-                    broker=strategy.broker, strategy=strategy, instrument=inst,
-                    code=new_bar.code, direction=DirectionType.values[DirectionType.SHORT],
-                    open_time=cur_date, shares=1, filled_shares=1, avg_entry_price=new_bar.open)
-                cur_pos = cur_idx * -1
-        elif cur_pos > 0 and prev_date > last_trade.open_time:
-            hh = float(MainBar.objects.filter(
-                exchange=inst.exchange, product_code=inst.product_code,
-                time__gte=last_trade.open_time,
-                time__lt=prev_date).aggregate(Max('high'))['high__max'])
-            if df.close[idx] <= hh - df.atr[cur_pos-1] * stop_n:
-                new_bar = MainBar.objects.filter(
-                    exchange=inst.exchange, product_code=inst.product_code,
-                    time=df.index[cur_idx].to_pydatetime().date()).first()
-                Signal.objects.create(
-                    strategy=strategy, instrument=inst, type=SignalType.SELL, processed=True,
-                    code=new_bar.code,
-                    trigger_time=prev_date, price=new_bar.open, volume=1, priority=PriorityType.LOW)
-                last_trade.avg_exit_price = new_bar.open
-                last_trade.close_time = cur_date
-                last_trade.closed_shares = 1
-                last_trade.profit = (new_bar.open - last_trade.avg_entry_price) * inst.volume_multiple
-                last_trade.save()
-                cur_pos = 0
-        elif cur_pos < 0 and prev_date > last_trade.open_time:
-            ll = float(MainBar.objects.filter(
-                exchange=inst.exchange, product_code=inst.product_code,
-                time__gte=last_trade.open_time,
-                time__lt=prev_date).aggregate(Min('low'))['low__min'])
-            if df.close[idx] >= ll + df.atr[cur_pos * -1-1] * stop_n:
-                new_bar = MainBar.objects.filter(
-                    exchange=inst.exchange, product_code=inst.product_code,
-                    time=df.index[cur_idx].to_pydatetime().date()).first()
-                Signal.objects.create(
-                    code=new_bar.code,
-                    strategy=strategy, instrument=inst, type=SignalType.BUY_COVER, processed=True,
-                    trigger_time=prev_date, price=new_bar.open, volume=1, priority=PriorityType.LOW)
-                last_trade.avg_exit_price = new_bar.open
-                last_trade.close_time = cur_date
-                last_trade.closed_shares = 1
-                last_trade.profit = (last_trade.avg_entry_price - new_bar.open) * inst.volume_multiple
-                last_trade.save()
-                cur_pos = 0
-        if cur_pos != 0 and cur_date.date() == day.date():
-            last_trade.avg_exit_price = df.open[cur_idx]
-            last_trade.close_time = cur_date
-            last_trade.closed_shares = 1
-            if last_trade.direction == DirectionType.values[DirectionType.LONG]:
-                last_trade.profit = (last_trade.avg_entry_price - Decimal(df.open[cur_idx])) * \
-                                    inst.volume_multiple
-            else:
-                last_trade.profit = (Decimal(df.open[cur_idx]) - last_trade.avg_entry_price) * \
-                                    inst.volume_multiple
-            last_trade.save()
-
-
-def calc_his_all(day: datetime.datetime):
+    result = PortfolioSelector(corr_matrix).select(n, method, time_budget, top_k)
+    for score, code_list in result:
+        print(f'得分: {score:.3f} 品种: {",".join(code_list)}')
+    return result
+
+
+def calc_history_signal(inst: Instrument, day: datetime.datetime, strategy: Strategy, save: bool = True):
+    """
+    用内存回测模拟 inst 截止 day 的历史信号, save 为真时一次性写入 Signal/Trade
+    :return: BacktestResult, 没有连续合约数据时返回 None
+    """
+    bars = load_bar_range([inst.product_code], day).get(inst.product_code)
+    if bars is None:
+        return None
+    result = run_backtest({inst.product_code: bars}, [inst], param_cache.get(strategy))
+    if save:
+        save_backtest(result, strategy, [inst])
+    return result
+
+
+def calc_his_all(day: datetime.datetime, save: bool = True):
+    """回测策略全部品种截止 day 的历史信号, 一条SQL读取K线, 一个事务写入结果"""
     strategy = Strategy.objects.get(name='大哥2.0')
     print(f'calc_his_all day: {day} stragety: {strategy}')
-    for inst in strategy.instruments.all():
-        print('process', inst)
-        last_day = Trade.objects.filter(instrument=inst, close_time__isnull=True).values_list(
-            'open_time', flat=True).first()
-        if last_day is None:
-            last_day = datetime.datetime.combine(
-                MainBar.objects.filter(product_code=inst.product_code, time__lte=day).order_by(
-                    '-time').values_list('time', flat=True).first(), timezone.make_aware(datetime.time.min))
-        calc_history_signal(inst, last_day, strategy)
+    inst_list = list(strategy.instruments.all())
+    bar_dict = load_bar_range([inst.product_code for inst in inst_list], day)
+    result = run_backtest(bar_dict, inst_list, param_cache.get(strategy))
+    if save:
+        save_backtest(result, strategy, inst_list)
+    return result
 
 
 def calc_his_up_limit(inst: Instrument, bar: DailyBar):
@@ -682,7 +768,7 @@ def load_kt_data(directory: str = r'D:\test'):
 
 
 # 从交易所获取合约当日的涨跌停幅度 TODO: 广期所
-async def get_contracts_argument(day: datetime.datetime = None) -> bool:
+async def get_contracts_argument(day: datetime.datetime = None, source: ExchangeSource = exchange_client) -> bool:
     try:
         if day is None:
             day = timezone.localtime()
@@ -690,106 +776,105 @@ async def get_contracts_argument(day: datetime.datetime = None) -> bool:
         redis_client = redis.StrictRedis(
             host=config.get('REDIS', 'host', fallback='localhost'),
             db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
-        async with aiohttp.ClientSession() as session:
-            # 上期所
-            async with session.get(
-                    f'http://{shfe_ip}/data/busiparamdata/future/ContractDailyTradeArgument{day_str}.dat') as response:
-                rst = await response.read()
-                rst_json = json.loads(rst)
-                for inst_data in rst_json['ContractDailyTradeArgument']:
-                    """
+        # 上期所
+        response = await source.get(
+            f'http://{shfe_ip}/data/busiparamdata/future/ContractDailyTradeArgument{day_str}.dat',
+            cache_key=(ExchangeType.SHFE, day, 'ContractDailyTradeArgument'))
+        rst_json = json.loads(response.body)
+        for inst_data in rst_json['ContractDailyTradeArgument']:
+            """
 {"HDEGE_LONGMARGINRATIO":".10000000","HDEGE_SHORTMARGINRATIO":".10000000","INSTRUMENTID":"cu2201",
 "LOWER_VALUE":".08000000","PRICE_LIMITS":"","SPEC_LONGMARGINRATIO":".10000000","SPEC_SHORTMARGINRATIO":".10000000",
 "TRADINGDAY":"20211217","UPDATE_DATE":"2021-12-17 09:51:20","UPPER_VALUE":".08000000","id":124468118}
-                    """
-                    # logger.info(f'inst_data: {inst_data}')
-                    code = re.findall('[A-Za-z]+', inst_data['INSTRUMENTID'])[0]
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    exchange = ExchangeType.INE if code in INE_INST_LIST else ExchangeType.SHFE
-                    limit_ratio = str_to_number(inst_data['UPPER_VALUE'])
-                    redis_client.set(f"LIMITRATIO:{exchange}:{code}:{inst_data['INSTRUMENTID']}", limit_ratio)
-            # 大商所
-            async with session.post(f'http://{dce_ip}/publicweb/notificationtips/exportDayTradPara.html',
-                                    data={'exportFlag': 'txt'}) as response:
-                rst = await response.text()
-                for lines in rst.split('\r\n')[3:400]:
-                    # 跳过期权合约
-                    if '本系列限额' in lines:
-                        break
-                    inst_data_raw = [x.strip() for x in lines.split('\t')]
-                    inst_data = []
-                    for cell in inst_data_raw:
-                        if len(cell) > 0:
-                            inst_data.append(cell)
-                    if len(inst_data) == 0:
-                        continue
-                    """
+            """
+            # logger.info(f'inst_data: {inst_data}')
+            code = re.findall('[A-Za-z]+', inst_data['INSTRUMENTID'])[0]
+            if code in IGNORE_INST_LIST:
+                continue
+            exchange = ExchangeType.INE if code in INE_INST_LIST else ExchangeType.SHFE
+            limit_ratio = str_to_number(inst_data['UPPER_VALUE'])
+            redis_client.set(f"LIMITRATIO:{exchange}:{code}:{inst_data['INSTRUMENTID']}", limit_ratio)
+        # 大商所
+        response = await source.post(f'http://{dce_ip}/publicweb/notificationtips/exportDayTradPara.html',
+                                     data={'exportFlag': 'txt'}, cache_key=(ExchangeType.DCE, day, 'DayTradPara'))
+        rst = response.text()
+        for lines in rst.split('\r\n')[3:400]:
+            # 跳过期权合约
+            if '本系列限额' in lines:
+                break
+            inst_data_raw = [x.strip() for x in lines.split('\t')]
+            inst_data = []
+            for cell in inst_data_raw:
+                if len(cell) > 0:
+                    inst_data.append(cell)
+            if len(inst_data) == 0:
+                continue
+            """
 [0合约,1交易保证金比例(投机),2交易保证金金额（元/手）(投机),3交易保证金比例(套保),4交易保证金金额（元/手）(套保),5涨跌停板比例,
      6涨停板价位（元）,7跌停板价位（元）]
 ['a2201','0.12','7,290','0.08','4,860','0.08','6,561','5,589','30,000','15,000']
-                    """
-                    code = re.findall('[A-Za-z]+', inst_data[0])[0]
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    limit_ratio = str_to_number(inst_data[5])
-                    redis_client.set(f"LIMITRATIO:{ExchangeType.DCE}:{code}:{inst_data[0]}", limit_ratio)
-            # 郑商所
-            async with session.get(f'http://{czce_ip}/cn/DFSStaticFiles/Future/{day.year}/{day_str}/'
-                                   f'FutureDataClearParams.txt') as response:
-                rst = await response.text()
-                for lines in rst.split('\n')[2:]:
-                    if not lines:
-                        continue
-                    inst_data = [x.strip() for x in lines.split('|' if '|' in lines else ',')]
-                    """
+            """
+            code = re.findall('[A-Za-z]+', inst_data[0])[0]
+            if code in IGNORE_INST_LIST:
+                continue
+            limit_ratio = str_to_number(inst_data[5])
+            redis_client.set(f"LIMITRATIO:{ExchangeType.DCE}:{code}:{inst_data[0]}", limit_ratio)
+        # 郑商所
+        response = await source.get(f'http://{czce_ip}/cn/DFSStaticFiles/Future/{day.year}/{day_str}/'
+                                    f'FutureDataClearParams.txt',
+                                    cache_key=(ExchangeType.CZCE, day, 'FutureDataClearParams'))
+        rst = response.text()
+        for lines in rst.split('\n')[2:]:
+            if not lines:
+                continue
+            inst_data = [x.strip() for x in lines.split('|' if '|' in lines else ',')]
+            """
 [0合约代码,1当日结算价,2是否单边市,3连续单边市天数,4交易保证金率(%),5涨跌停板(%),6交易手续费,7交割手续费,8日内平今仓交易手续费,9日持仓限额]
 ['AP201','8,148.00','N','0','10','±9','5.00','0.00','20.00','200','']
-                    """
-                    code = re.findall('[A-Za-z]+', inst_data[0])[0]
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    limit_ratio = str_to_number(inst_data[5][1:]) / 100
-                    redis_client.set(f"LIMITRATIO:{ExchangeType.CZCE}:{code}:{inst_data[0]}", limit_ratio)
-            # 中金所
-            async with session.get(f"http://{cffex_ip}/sj/jycs/{day.strftime('%Y%m/%d')}/index.xml") as response:
-                rst = await response.text()
-                max_conn_cffex.release()
-                tree = ET.fromstring(rst)
-                for inst_data in tree:
-                    """
-                    <INDEX>
-                    <TRADING_DAY>20211216</TRADING_DAY>
-                    <PRODUCT_ID>IC</PRODUCT_ID>
-                    <INSTRUMENT_ID>IC2112</INSTRUMENT_ID>
-                    <INSTRUMENT_MONTH>2112</INSTRUMENT_MONTH>
-                    <BASIS_PRICE>6072.8</BASIS_PRICE>
-                    <OPEN_DATE>20210419</OPEN_DATE>
-                    <END_TRADING_DAY>20211217</END_TRADING_DAY>
-                    <UPPER_VALUE>0.1</UPPER_VALUE>
-                    <LOWER_VALUE>0.1</LOWER_VALUE>
-                    <UPPERLIMITPRICE>8063.6</UPPERLIMITPRICE>
-                    <LOWERLIMITPRICE>6597.6</LOWERLIMITPRICE>
-                    <LONG_LIMIT>1200</LONG_LIMIT>
-                    </INDEX>
-                    """
-                    inst_id = inst_data.findtext('INSTRUMENT_ID').strip()
-                    # 不存储期权合约
-                    if len(inst_id) > 6:
-                        continue
-                    code = inst_data.findtext('PRODUCT_ID').strip()
-                    if code in IGNORE_INST_LIST:
-                        continue
-                    limit_ratio = str_to_number(inst_data.findtext('UPPER_VALUE').strip())
-                    redis_client.set(f"LIMITRATIO:{ExchangeType.CFFEX}:{code}:{inst_id}", limit_ratio)
-            # 保存数据
-            for inst in Instrument.objects.all():
-                ratio = redis_client.get(f"LIMITRATIO:{inst.exchange}:{inst.product_code}:{inst.main_code}")
-                if ratio:
-                    ratio = str_to_number(ratio)
-                    inst.up_limit_ratio = ratio
-                    inst.down_limit_ratio = ratio
-                    inst.save(update_fields=['up_limit_ratio', 'down_limit_ratio'])
+            """
+            code = re.findall('[A-Za-z]+', inst_data[0])[0]
+            if code in IGNORE_INST_LIST:
+                continue
+            limit_ratio = str_to_number(inst_data[5][1:]) / 100
+            redis_client.set(f"LIMITRATIO:{ExchangeType.CZCE}:{code}:{inst_data[0]}", limit_ratio)
+        # 中金所
+        response = await source.get(f"http://{cffex_ip}/sj/jycs/{day.strftime('%Y%m/%d')}/index.xml",
+                                    cache_key=(ExchangeType.CFFEX, day, 'jycs'))
+        tree = ET.fromstring(response.text())
+        for inst_data in tree:
+            """
+            <INDEX>
+            <TRADING_DAY>20211216</TRADING_DAY>
+            <PRODUCT_ID>IC</PRODUCT_ID>
+            <INSTRUMENT_ID>IC2112</INSTRUMENT_ID>
+            <INSTRUMENT_MONTH>2112</INSTRUMENT_MONTH>
+            <BASIS_PRICE>6072.8</BASIS_PRICE>
+            <OPEN_DATE>20210419</OPEN_DATE>
+            <END_TRADING_DAY>20211217</END_TRADING_DAY>
+            <UPPER_VALUE>0.1</UPPER_VALUE>
+            <LOWER_VALUE>0.1</LOWER_VALUE>
+            <UPPERLIMITPRICE>8063.6</UPPERLIMITPRICE>
+            <LOWERLIMITPRICE>6597.6</LOWERLIMITPRICE>
+            <LONG_LIMIT>1200</LONG_LIMIT>
+            </INDEX>
+            """
+            inst_id = inst_data.findtext('INSTRUMENT_ID').strip()
+            # 不存储期权合约
+            if len(inst_id) > 6:
+                continue
+            code = inst_data.findtext('PRODUCT_ID').strip()
+            if code in IGNORE_INST_LIST:
+                continue
+            limit_ratio = str_to_number(inst_data.findtext('UPPER_VALUE').strip())
+            redis_client.set(f"LIMITRATIO:{ExchangeType.CFFEX}:{code}:{inst_id}", limit_ratio)
+        # 保存数据
+        for inst in Instrument.objects.all():
+            ratio = redis_client.get(f"LIMITRATIO:{inst.exchange}:{inst.product_code}:{inst.main_code}")
+            if ratio:
+                ratio = str_to_number(ratio)
+                inst.up_limit_ratio = ratio
+                inst.down_limit_ratio = ratio
+                inst.save(update_fields=['up_limit_ratio', 'down_limit_ratio'])
         return True
     except Exception as e:
         logger.warning(f'get_contracts_argument failed: {repr(e)}', exc_info=True)
@@ -0,0 +1,189 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import asyncio
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection, transaction
+from django.utils import timezone
+from tqdm import tqdm
+
+from panel.models import BackfillCheckpoint, ExchangeType
+from trader.utils import fetch_daily_bar, parse_daily_bar, bulk_save_daily_bar, check_trading_day, exchange_client
+from trader.utils.exchange_source import ExchangeSource, ReplaySource
+from trader.utils.read_config import config
+from trader.utils.trading_calendar import trading_calendar
+
+logger = logging.getLogger('Backfill')
+
+# 默认回补的交易所, 广期所接口只返回最新行情, 没有历史数据, 不在其中
+BACKFILL_EXCHANGE_LIST = [ExchangeType.SHFE, ExchangeType.DCE, ExchangeType.CZCE, ExchangeType.CFFEX]
+# 只能获取当天数据的交易所, 指定时只回补今天(离线回放不受限制)
+LATEST_ONLY_EXCHANGE_LIST = [ExchangeType.GFEX]
+
+
+class Backfill:
+    """
+    历史日线批量回补
+
+    按 (交易所, 日期) 拆分任务, 分三级流水线执行, 互不等待:
+    1. 下载: 每个交易所单独限制并发数
+    2. 解析: 线程池中解析原始数据
+    3. 写库: 单线程攒批写入, 日线和回补进度在同一个事务里提交
+    完成的 (交易所, 日期) 记录在 BackfillCheckpoint, 中断后重新运行只处理剩余部分。
+    """
+    def __init__(self, exchanges: list = None, source: ExchangeSource = exchange_client):
+        self.exchanges = exchanges if exchanges else BACKFILL_EXCHANGE_LIST
+        self.source = source
+        self.concurrency = {exchange: config.getint('BACKFILL', exchange.lower(), fallback=3)
+                            for exchange in self.exchanges}
+        self.queue_size = config.getint('BACKFILL', 'queue_size', fallback=50)
+        self.batch_size = config.getint('BACKFILL', 'batch_size', fallback=20)
+        self.parse_workers = config.getint('BACKFILL', 'parse_workers', fallback=4)
+        self.parse_pool = ThreadPoolExecutor(self.parse_workers)
+        self.db_pool = ThreadPoolExecutor(1)  # 整个回补只占用一个数据库连接
+        self.failed = list()
+
+    async def get_trading_days(self, start: datetime.date, end: datetime.date) -> list:
+        if isinstance(self.source, ReplaySource):
+            day_set = set()
+            for exchange in self.exchanges:
+                day_set.update(day.date() for day in self.source.days(exchange))
+            return sorted(day for day in day_set if start <= day <= end)
+        day_list = []
+        probe_list = []
+        day = start
+        while day <= end:
+            if trading_calendar.is_confirmed(day):
+                day_list.append(day)
+            elif not trading_calendar.is_holiday(day):
+                probe_list.append(day)
+            day += datetime.timedelta(days=1)
+        # 日历里没有的工作日才去交易所确认, 确认结果补充进日历
+        result = await asyncio.gather(*[check_trading_day(self.to_datetime(day), self.source) for day in probe_list])
+        for day, trading in result:
+            if trading:
+                trading_calendar.add(day)
+                day_list.append(day.date())
+        return sorted(day_list)
+
+    @staticmethod
+    def to_datetime(day: datetime.date) -> datetime.datetime:
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+    @staticmethod
+    def load_checkpoint(start: datetime.date, end: datetime.date) -> set:
+        return set(BackfillCheckpoint.objects.filter(day__gte=start, day__lte=end).values_list('exchange', 'day'))
+
+    @staticmethod
+    def save(batch: list):
+        with transaction.atomic():
+            for _, _, bar_list in batch:
+                bulk_save_daily_bar(bar_list)
+            unique_fields = ['exchange', 'day'] if connection.features.supports_update_conflicts_with_target else None
+            BackfillCheckpoint.objects.bulk_create(
+                [BackfillCheckpoint(exchange=exchange, day=day, bar_count=len(bar_list))
+                 for exchange, day, bar_list in batch],
+                update_conflicts=True, unique_fields=unique_fields, update_fields=['bar_count', 'update_time'])
+
+    async def fetch(self, exchange: str, day: datetime.date, semaphore: asyncio.Semaphore, parse_queue: asyncio.Queue):
+        async with semaphore:
+            try:
+                response_list = await fetch_daily_bar(exchange, self.to_datetime(day), self.source)
+            except Exception as e:
+                logger.warning(f'下载 {exchange} {day} 失败: {repr(e)}')
+                self.failed.append((exchange, day))
+                return
+        await parse_queue.put((exchange, day, response_list))
+
+    async def parse(self, parse_queue: asyncio.Queue, write_queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await parse_queue.get()
+            if item is None:
+                break
+            exchange, day, response_list = item
+            try:
+                bar_list = await loop.run_in_executor(
+                    self.parse_pool, parse_daily_bar, exchange, self.to_datetime(day), response_list)
+            except Exception as e:
+                logger.warning(f'解析 {exchange} {day} 失败: {repr(e)}')
+                for cache_key, _ in response_list:
+                    self.source.discard(cache_key)
+                self.failed.append((exchange, day))
+                continue
+            await write_queue.put((exchange, day, bar_list))
+
+    async def write(self, write_queue: asyncio.Queue, progress: tqdm):
+        loop = asyncio.get_running_loop()
+        finished = False
+        while not finished:
+            batch = [await write_queue.get()]
+            while len(batch) < self.batch_size and not write_queue.empty():
+                batch.append(write_queue.get_nowait())
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                await loop.run_in_executor(self.db_pool, self.save, batch)
+            except Exception as e:
+                logger.warning(f'写入 {len(batch)} 个交易所日线失败: {repr(e)}', exc_info=True)
+                self.failed += [(exchange, day) for exchange, day, _ in batch]
+            progress.update(len(batch))
+
+    async def run(self, start: datetime.date, end: datetime.date, redo: bool = False) -> list:
+        """
+        :param start: 开始日期(含)
+        :param end: 结束日期(含)
+        :param redo: 忽略已完成的进度, 全部重新回补
+        :return: 失败的 [(交易所, 日期)]
+        """
+        loop = asyncio.get_running_loop()
+        self.failed.clear()
+        trading_days = await self.get_trading_days(start, end)
+        finished = set() if redo else await loop.run_in_executor(self.db_pool, self.load_checkpoint, start, end)
+        today = timezone.localtime().date()
+        replay = isinstance(self.source, ReplaySource)
+        job_list = [(exchange, day) for day in trading_days for exchange in self.exchanges
+                    if (exchange, day) not in finished and
+                    (replay or exchange not in LATEST_ONLY_EXCHANGE_LIST or day == today)]
+        skipped = [exchange for exchange in self.exchanges if exchange in LATEST_ONLY_EXCHANGE_LIST]
+        if skipped and not replay:
+            logger.info(f'{",".join(skipped)} 只能获取当天的行情, 只回补 {today}')
+        logger.info(f'回补 {start} ~ {end}: 交易日 {len(trading_days)} 天, 待处理 {len(job_list)} 项')
+        parse_queue = asyncio.Queue(maxsize=self.queue_size)
+        write_queue = asyncio.Queue(maxsize=self.queue_size)
+        semaphore = {exchange: asyncio.Semaphore(self.concurrency[exchange]) for exchange in self.exchanges}
+        with tqdm(total=len(job_list)) as progress:
+            parse_tasks = [asyncio.create_task(self.parse(parse_queue, write_queue))
+                           for _ in range(self.parse_workers)]
+            write_task = asyncio.create_task(self.write(write_queue, progress))
+            await asyncio.gather(*[self.fetch(exchange, day, semaphore[exchange], parse_queue)
+                                   for exchange, day in job_list])
+            for _ in parse_tasks:
+                await parse_queue.put(None)
+            await asyncio.gather(*parse_tasks)
+            await write_queue.put(None)
+            await write_task
+        await loop.run_in_executor(self.db_pool, connection.close)
+        if self.failed:
+            logger.warning(f'回补完成, 失败 {len(self.failed)} 项, 重新运行即可继续: {sorted(self.failed)}')
+        else:
+            logger.info('回补完成!')
+        return self.failed
@@ -0,0 +1,258 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+大哥2.0 策略的内存回测, 规则与 brother2_signal.compute_signal 相同:
+1. 第 i 天收盘后计算信号, 第 i+1 天开盘价成交
+2. 开仓: 短期均线在长期均线上方且收盘价 >= 截止前一天的N日最高收盘价做多, 空头相反
+3. 止损: 收盘价 <= 开仓以来(不含当天)最高价 - 开仓信号当天的ATR * N, 空头相反, 换月不改变止损的起点
+4. 换月: 持仓合约小于当天的主力合约时平旧开新, 拆成两笔交易
+指标整段向量化计算, 只有持仓状态按天递推, 不访问数据库, 结果可以用 save_backtest 一次性写入 Signal/Trade
+"""
+import datetime
+import logging
+from dataclasses import dataclass
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+from django.utils import timezone
+
+from panel.const import DirectionType, SignalType, PriorityType
+from panel.models import Strategy, Signal, Trade
+from trader.utils.bar_history import BarHistory
+from trader.utils.indicator import atr, wilder_average, rolling_high, rolling_low
+from trader.utils.strategy_param import StrategyParam
+
+logger = logging.getLogger('Backtest')
+
+TRADE_COLUMNS = ['product_code', 'code', 'direction', 'shares', 'trigger_value',
+                 'open_type', 'open_signal_time', 'open_time', 'open_price',
+                 'close_type', 'close_signal_time', 'close_time', 'close_price', 'profit']
+
+
+@dataclass
+class BacktestResult:
+    trades: pd.DataFrame  # 每笔交易, 列见 TRADE_COLUMNS, 未平仓的 close_* 为空, profit 为持仓盈亏
+    equity: pd.DataFrame  # 每日盈亏, 每个品种一列, 另有 total(当日合计) 和 equity(累计权益)
+
+
+def tick_round(x, price_tick) -> np.ndarray:
+    """
+    按最小变动价位取整后的档数, 比较大小的结果与 price_round 相同
+    恰好落在两档中间的值(浮点误差下舍入方向不确定)逐个用 Decimal 计算
+    """
+    x = np.asarray(x, dtype=float)
+    ratio = x / float(price_tick)
+    out = np.round(ratio)
+    for i in np.flatnonzero(np.abs(ratio - np.floor(ratio) - 0.5) < 1e-9):
+        out[i] = float(round(Decimal(x[i]) / Decimal(price_tick)))
+    return out
+
+
+class IndicatorCache:
+    """
+    单个品种的指标缓存, 参数扫描时不同参数组合共用同一周期的指标(如同一个 atr_n 的ATR)
+    """
+    def __init__(self, bars: BarHistory, price_tick: Decimal):
+        self.bars = bars
+        self.price_tick = price_tick
+        self.__cache = dict()
+
+    def _get(self, key: tuple, func):
+        if key not in self.__cache:
+            self.__cache[key] = func()
+        return self.__cache[key]
+
+    def atr(self, n: int) -> np.ndarray:
+        return self._get(('atr', n), lambda: atr(self.bars.high, self.bars.low, self.bars.close, n))
+
+    def wilder_average(self, n: int) -> np.ndarray:
+        return self._get(('wilder', n), lambda: wilder_average(self.bars.close, n))
+
+    def close_tick(self) -> np.ndarray:
+        return self._get(('close_tick',), lambda: tick_round(self.bars.close, self.price_tick))
+
+    def high_tick(self, n: int) -> np.ndarray:
+        """截止前一天的N日最高收盘价, 按最小变动价位取整后的档数"""
+        return self._get(('high_tick', n), lambda: tick_round(_shift(rolling_high(self.bars.close, n)), self.price_tick))
+
+    def low_tick(self, n: int) -> np.ndarray:
+        """截止前一天的N日最低收盘价, 按最小变动价位取整后的档数"""
+        return self._get(('low_tick', n), lambda: tick_round(_shift(rolling_low(self.bars.close, n)), self.price_tick))
+
+
+def _shift(x: np.ndarray) -> np.ndarray:
+    out = np.full_like(x, np.nan)
+    out[1:] = x[:-1]
+    return out
+
+
+def backtest_product(product_code: str, bars: BarHistory, param: StrategyParam, price_tick: Decimal,
+                     volume_multiple: int, capital: Decimal = None, start: datetime.date = None,
+                     indicators: IndicatorCache = None) -> (list, np.ndarray):
+    """
+    回测单个品种
+    :param capital: 开仓资金, 手数 = capital * risk / (ATR * 合约乘数), 为空时每次开1手
+    :param start: 从这一天(含)开始计算信号, 之前的K线只用来计算指标
+    :param indicators: 可选, 多次回测同一品种时共用的指标缓存
+    :return: (交易列表, 每天开盘成交后的持仓手数, 多为正空为负)
+    """
+    n = len(bars)
+    if indicators is None:
+        indicators = IndicatorCache(bars, price_tick)
+    atr_arr = indicators.atr(param.atr_n)
+    short_trend = indicators.wilder_average(param.short_n)
+    long_trend = indicators.wilder_average(param.long_n)
+    close_tick = indicators.close_tick()
+    buy_sig = ((short_trend > long_trend) & (close_tick >= indicators.high_tick(param.break_n))).tolist()
+    sell_sig = ((short_trend < long_trend) & (close_tick <= indicators.low_tick(param.break_n))).tolist()
+    # 与 IndicatorState.build 相同, K线数量足够时才计算信号
+    first = max(param.atr_n, param.break_n) + 1
+    if start is not None:
+        first = max(first, int(np.searchsorted(bars.time, np.datetime64(start))))
+    time_list = bars.time
+    open_list, high_list, low_list, close_list = (v.tolist() for v in (bars.open, bars.high, bars.low, bars.close))
+    atr_list = atr_arr.tolist()
+    code_list = bars.code.tolist() if bars.code is not None else [None] * n
+    multiple = float(volume_multiple)
+    risk = float(param.risk)
+    position = np.zeros(n)
+    trade_list = list()
+    cur = None  # 当前持仓
+    direction = shares = open_idx = 0
+    stop_atr = extreme = None
+
+    def open_trade(open_type: str, i: int, code: str) -> dict:
+        return {'product_code': product_code, 'code': code, 'shares': shares, 'trigger_value': atr_list[i],
+                'direction': DirectionType.values[DirectionType.LONG if direction > 0 else DirectionType.SHORT],
+                'open_type': open_type, 'open_signal_time': time_list[i], 'open_time': time_list[i + 1],
+                'open_price': open_list[i + 1]}
+
+    def close_trade(close_type: str, i: int):
+        cur.update({'close_type': close_type, 'close_signal_time': time_list[i], 'close_time': time_list[i + 1],
+                    'close_price': open_list[i + 1],
+                    'profit': direction * (open_list[i + 1] - cur['open_price']) * multiple * shares})
+        trade_list.append(cur)
+
+    for i in range(first, n - 1):
+        if cur is None:
+            if buy_sig[i] or sell_sig[i]:
+                shares = 1 if capital is None else round(float(capital) * risk / (atr_list[i] * multiple))
+                if shares > 0:
+                    direction = 1 if buy_sig[i] else -1
+                    cur = open_trade(SignalType.BUY if direction > 0 else SignalType.SELL_SHORT, i, code_list[i])
+                    open_idx, stop_atr, extreme = i + 1, atr_list[i], None
+        else:
+            if i > open_idx:
+                if direction > 0:
+                    extreme = high_list[i - 1] if extreme is None else max(extreme, high_list[i - 1])
+                else:
+                    extreme = low_list[i - 1] if extreme is None else min(extreme, low_list[i - 1])
+            if extreme is not None and direction > 0 and close_list[i] <= extreme - stop_atr * param.stop_n:
+                close_trade(SignalType.SELL, i)
+                cur = None
+            elif extreme is not None and direction < 0 and close_list[i] >= extreme + stop_atr * param.stop_n:
+                close_trade(SignalType.BUY_COVER, i)
+                cur = None
+            elif cur['code'] is not None and code_list[i] is not None and cur['code'] < code_list[i]:
+                close_trade(SignalType.ROLL_CLOSE, i)
+                cur = open_trade(SignalType.ROLL_OPEN, i, code_list[i])
+        position[i + 1] = direction * shares if cur is not None else 0
+    if cur is not None:
+        cur['profit'] = direction * (close_list[-1] - cur['open_price']) * multiple * shares
+        trade_list.append(cur)
+    return trade_list, position
+
+
+def daily_pnl(bars: BarHistory, position: np.ndarray, volume_multiple: int) -> np.ndarray:
+    """开盘成交, 每日盈亏 = 昨日持仓 * (开盘 - 昨收) + 今日持仓 * (收盘 - 开盘)"""
+    pnl = np.zeros(len(bars))
+    pnl[1:] = position[:-1] * (bars.open[1:] - bars.close[:-1]) + position[1:] * (bars.close[1:] - bars.open[1:])
+    return pnl * float(volume_multiple)
+
+
+def run_backtest(bar_dict: dict, inst_list: list, param: StrategyParam, capital: Decimal = None,
+                 start: datetime.date = None) -> BacktestResult:
+    """
+    回测一组品种
+    :param bar_dict: {product_code: BarHistory}, 需要包含主力合约代码, 见 load_bar_range
+    :param inst_list: 品种列表
+    :param capital: 开仓资金, 为空时每次开1手
+    :param start: 从这一天开始计算信号
+    """
+    trade_list = list()
+    pnl_dict = dict()
+    for inst in inst_list:
+        bars = bar_dict.get(inst.product_code)
+        if bars is None or len(bars) == 0:
+            logger.warning(f'{inst} 没有连续合约数据, 跳过')
+            continue
+        trades, position = backtest_product(
+            inst.product_code, bars, param, inst.price_tick, inst.volume_multiple, capital, start)
+        trade_list += trades
+        pnl_dict[inst.product_code] = pd.Series(
+            daily_pnl(bars, position, inst.volume_multiple), index=pd.DatetimeIndex(bars.time, name='time'))
+    equity = pd.DataFrame(pnl_dict).sort_index().fillna(0)
+    equity['total'] = equity.sum(axis=1)
+    equity['equity'] = equity.total.cumsum() + float(capital if capital else 0)
+    return BacktestResult(trades=pd.DataFrame(trade_list, columns=TRADE_COLUMNS), equity=equity)
+
+
+def _to_decimal(value) -> Decimal:
+    return Decimal(str(round(value, 3)))
+
+
+def _to_datetime(value) -> datetime.datetime:
+    return timezone.make_aware(pd.Timestamp(value).to_pydatetime())
+
+
+def save_backtest(result: BacktestResult, strategy: Strategy, inst_list: list) -> (int, int):
+    """
+    把回测结果一次性写入 Signal/Trade, 信号都标记为已处理
+    同一个事务中先删除这些品种上次回测写入的记录, 重复回测不会产生重复的信号和交易:
+        回测的信号没有对应的报单, 回测的交易没有开平仓报单, 也没有手续费(save_position 同步的持仓有手续费)
+    :return: (信号数, 交易数)
+    """
+    inst_dict = {inst.product_code: inst for inst in inst_list}
+    signal_list = list()
+    trade_list = list()
+    for row in result.trades.itertuples(index=False):
+        inst = inst_dict[row.product_code]
+        signal_list.append(Signal(
+            strategy=strategy, instrument=inst, code=row.code, type=row.open_type,
+            trigger_value=_to_decimal(row.trigger_value), trigger_time=_to_datetime(row.open_signal_time),
+            price=_to_decimal(row.open_price), volume=row.shares, priority=PriorityType.LOW, processed=True))
+        trade = Trade(
+            broker=strategy.broker, strategy=strategy, instrument=inst, code=row.code, direction=row.direction,
+            open_time=_to_datetime(row.open_time), shares=row.shares, filled_shares=row.shares,
+            avg_entry_price=_to_decimal(row.open_price), profit=_to_decimal(row.profit))
+        if pd.notna(row.close_time):
+            signal_list.append(Signal(
+                strategy=strategy, instrument=inst, code=row.code, type=row.close_type,
+                trigger_time=_to_datetime(row.close_signal_time), price=_to_decimal(row.close_price),
+                volume=row.shares, priority=PriorityType.LOW, processed=True))
+            trade.close_time = _to_datetime(row.close_time)
+            trade.closed_shares = row.shares
+            trade.avg_exit_price = _to_decimal(row.close_price)
+        trade_list.append(trade)
+    with transaction.atomic():
+        Signal.objects.filter(strategy=strategy, instrument__in=inst_list, processed=True, order__isnull=True).delete()
+        Trade.objects.filter(strategy=strategy, instrument__in=inst_list, open_order__isnull=True,
+                             close_order__isnull=True, cost__isnull=True).delete()
+        Signal.objects.bulk_create(signal_list, batch_size=1000)
+        Trade.objects.bulk_create(trade_list, batch_size=1000)
+    return len(signal_list), len(trade_list)
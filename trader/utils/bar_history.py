@@ -0,0 +1,113 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import datetime
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from pandas.io.sql import read_sql_query
+from django.db import connection
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from panel.models import MainBar, MainBarAdjust, DailyBar, MAIN_BAR_PRICE_FIELDS
+
+
+@dataclass
+class BarHistory:
+    """单个品种的复权主力连续K线, 日期升序"""
+    time: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    settlement: np.ndarray
+    code: np.ndarray = None  # 每天的主力合约, 只有 load_bar_range 会读取
+
+    def __len__(self):
+        return len(self.time)
+
+    def to_df(self) -> pd.DataFrame:
+        """与 MainBar.objects.adjusted_df('time', 'open', 'high', 'low', 'close', index_col='time') 相同的格式"""
+        return pd.DataFrame({'open': self.open, 'high': self.high, 'low': self.low, 'close': self.close},
+                            index=pd.DatetimeIndex(self.time, name='time'))
+
+
+def load_bar_history(product_list: list, day: datetime.datetime, limit: int = 400) -> dict:
+    """
+    一条SQL读取多个品种截止 day 的最近 limit 根复权K线
+    内层按品种开窗只取原始K线的前N条, 外层再对这N条加上其后的换月基差之和(同 MainBarQuerySet.adjusted),
+    复权的子查询只对每个品种N行执行, 不随全部历史增长
+    :param product_list: 品种代码列表
+    :param day: 截止日期(含)
+    :param limit: 每个品种最多读取的K线数
+    :return: {product_code: BarHistory}
+    """
+    product_list = list(product_list)
+    if not product_list:  # IN () 生成不了SQL, sql_with_params 会抛出 EmptyResultSet
+        return dict()
+    queryset = MainBar.objects.filter(time__lte=day.date(), product_code__in=product_list).annotate(
+        row_number=Window(RowNumber(), partition_by=[F('exchange'), F('product_code')],
+                          order_by=F('time').desc())).values_list(
+        'exchange', 'product_code', 'time', *MAIN_BAR_PRICE_FIELDS, 'row_number')
+    query, params = queryset.query.sql_with_params()
+    qn = connection.ops.quote_name
+    adjust = f'COALESCE((SELECT SUM(a.{qn("basis")}) FROM {qn(MainBarAdjust._meta.db_table)} a ' \
+             f'WHERE a.{qn("exchange")} = t.{qn("exchange")} AND a.{qn("product_code")} = t.{qn("product_code")} ' \
+             f'AND a.{qn("time")} > t.{qn("time")}), 0)'
+    adj_columns = ', '.join(f'u.{qn(field)} + u.{qn("adjust")} AS {qn("adj_" + field)}' for field in MAIN_BAR_PRICE_FIELDS)
+    df = read_sql_query(f'SELECT u.{qn("product_code")}, u.{qn("time")}, {adj_columns} FROM ('
+                        f'SELECT t.*, {adjust} AS {qn("adjust")} FROM ({query}) t WHERE t.{qn("row_number")} <= %s) u '
+                        f'ORDER BY u.{qn("product_code")}, u.{qn("time")}',
+                        connection, params=[*params, limit], parse_dates=['time'])
+    result = dict()
+    for product_code, group in df.groupby('product_code', sort=False):
+        result[product_code] = BarHistory(
+            time=group.time.to_numpy(), open=group.adj_open.to_numpy(dtype=float),
+            high=group.adj_high.to_numpy(dtype=float), low=group.adj_low.to_numpy(dtype=float),
+            close=group.adj_close.to_numpy(dtype=float), settlement=group.adj_settlement.to_numpy(dtype=float))
+    return result
+
+
+def load_daily_bar(day: datetime.datetime) -> dict:
+    """
+    一次读出某日全部合约的日线, 供计算信号时查询当日价格
+    :return: {(exchange, code): DailyBar}
+    """
+    return {(bar.exchange, bar.code): bar for bar in DailyBar.objects.filter(time=day.date())}
+
+
+def load_bar_range(product_list: list, end: datetime.datetime = None, start: datetime.datetime = None) -> dict:
+    """
+    一条SQL读取多个品种 [start, end] 之间的全部复权K线(含主力合约代码), 用于回测
+    :return: {product_code: BarHistory}
+    """
+    queryset = MainBar.objects.adjusted().filter(product_code__in=list(product_list))
+    if start is not None:
+        queryset = queryset.filter(time__gte=start.date())
+    if end is not None:
+        queryset = queryset.filter(time__lte=end.date())
+    df = queryset.order_by('product_code', 'time').adjusted_df(
+        'product_code', 'code', 'time', 'open', 'high', 'low', 'close', 'settlement', parse_dates=['time'])
+    result = dict()
+    if df.empty:
+        return result
+    for product_code, group in df.groupby('product_code', sort=False):
+        result[product_code] = BarHistory(
+            time=group.time.to_numpy(), open=group.open.to_numpy(dtype=float), high=group.high.to_numpy(dtype=float),
+            low=group.low.to_numpy(dtype=float), close=group.close.to_numpy(dtype=float),
+            settlement=group.settlement.to_numpy(dtype=float), code=group.code.to_numpy())
+    return result
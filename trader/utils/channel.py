@@ -0,0 +1,66 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+消息频道的解析和分发
+
+频道名的最后一段是 key(合约代码、报单引用、请求编号等), 前面的部分是前缀:
+    MSG:CTP:RSP:TRADE:OnRtnTrade:000012300045 -> 前缀 MSG:CTP:RSP:TRADE:OnRtnTrade, 消息类型 OnRtnTrade, key 000012300045
+每个不同的频道名只解析一次(LRU 缓存), 分发时按前缀精确查表, 不再按订阅模式匹配
+"""
+import functools
+from typing import NamedTuple
+from collections import defaultdict
+
+
+class Channel(NamedTuple):
+    name: str  # 完整的频道名
+    prefix: str
+    msg_type: str
+    key: str
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_channel(name: str) -> Channel:
+    prefix, _, key = name.rpartition(':')
+    return Channel(name, prefix, prefix.rpartition(':')[2], key)
+
+
+def pattern_prefix(pattern: str) -> str:
+    """订阅模式 前缀:* 中的前缀"""
+    if not pattern.endswith(':*') or '*' in pattern[:-2]:
+        raise ValueError(f'只支持 前缀:* 形式的订阅模式: {pattern}')
+    return pattern[:-2]
+
+
+class ChannelDispatcher:
+    """
+    前缀 -> 回调列表, 同一个前缀可以注册多个回调
+    回调的参数为 (Channel, 消息内容), 多个回调收到的是同一个消息对象
+    """
+    def __init__(self):
+        self.__handlers = defaultdict(list)
+
+    def register(self, pattern: str, handler):
+        self.__handlers[pattern_prefix(pattern)].append(handler)
+
+    def patterns(self) -> list:
+        return [f'{prefix}:*' for prefix in self.__handlers]
+
+    def handlers(self, channel: Channel) -> list:
+        return self.__handlers.get(channel.prefix, [])
+
+    def clear(self):
+        self.__handlers.clear()
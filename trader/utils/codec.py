@@ -0,0 +1,173 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Redis 频道消息的编解码, 由 [MSG_CHANNEL] codec 选择, 发布和接收两端使用同一个 codec
+
+json: 原来的格式, 文本
+msgpack: 二进制, 需要安装 msgpack
+struct: 行情(OnRtnDepthMarketData)按固定的二进制布局编码, 字段类型取自 ApiStruct.T, 其他消息仍用 JSON
+二进制 codec 接收消息的 Redis 客户端不能 decode_responses, 见 Codec.binary
+"""
+import struct
+import functools
+from decimal import Decimal
+
+import ujson as json
+
+from trader.utils.ApiStruct import T
+from trader.utils.read_config import config
+
+
+@functools.lru_cache(maxsize=4096)
+def message_type(channel: str) -> str:
+    """
+    频道名中的消息类型
+    MSG:CTP:RSP:MARKET:OnRtnDepthMarketData:rb2410 -> OnRtnDepthMarketData
+    MSG:CTP:REQ:ReqOrderInsert -> ReqOrderInsert
+    """
+    parts = channel.split(':')
+    return parts[4] if len(parts) > 4 and parts[2] == 'RSP' else parts[-1]
+
+
+class Codec:
+    name = None
+    binary = False
+
+    def encode(self, channel: str, obj) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, channel: str, data):
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    def encode(self, channel: str, obj) -> str:
+        return json.dumps(obj)
+
+    def decode(self, channel: str, data):
+        return json.loads(data)
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return str(obj)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    binary = True
+
+    def __init__(self):
+        import msgpack
+        self.__packer = functools.partial(msgpack.packb, use_bin_type=True, default=_msgpack_default)
+        self.__unpacker = functools.partial(msgpack.unpackb, raw=False)
+
+    def encode(self, channel: str, obj) -> bytes:
+        return self.__packer(obj)
+
+    def decode(self, channel: str, data):
+        return self.__unpacker(data)
+
+
+C_FORMATS = {'double': 'd', 'int': 'i', 'short': 'h', 'char': '1s'}
+
+
+class StructLayout:
+    def __init__(self, fields: list):
+        """
+        :param fields: [(字段名, 类型)], 类型为 ApiStruct.T 中的类型名(如 Price), 或者直接写C类型(如 char[24])
+        """
+        self.names = [name for name, _ in fields]
+        fmt = '<'
+        self.text_index = list()  # 字符串字段的位置
+        self.number_index = list()
+        for i, (_, type_name) in enumerate(fields):
+            c_type = T.get(type_name, type_name)
+            if c_type.startswith('char['):
+                fmt += f'{int(c_type[5:-1])}s'
+            else:
+                fmt += C_FORMATS[c_type]
+            if fmt.endswith('s'):
+                self.text_index.append(i)
+            else:
+                self.number_index.append((i, float if c_type == 'double' else int))
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+    def pack(self, obj: dict) -> bytes:
+        """没有的字段填0或空字符串, 布局以外的字段被丢弃"""
+        values = [obj.get(name) for name in self.names]
+        for i in self.text_index:
+            value = values[i]
+            values[i] = value.encode() if isinstance(value, str) else (value if value else b'')
+        for i, cast in self.number_index:
+            values[i] = cast(values[i]) if values[i] is not None else 0
+        return self.struct.pack(*values)
+
+    def unpack(self, data: bytes) -> dict:
+        values = list(self.struct.unpack(data))
+        for i in self.text_index:
+            values[i] = values[i].rstrip(b'\0').decode()
+        return dict(zip(self.names, values))
+
+
+# CThostFtdcDepthMarketDataField
+DEPTH_MARKET_DATA = StructLayout([
+    ('TradingDay', 'Date'), ('InstrumentID', 'InstrumentID'), ('ExchangeID', 'ExchangeID'),
+    ('ExchangeInstID', 'ExchangeInstID'), ('LastPrice', 'Price'), ('PreSettlementPrice', 'Price'),
+    ('PreClosePrice', 'Price'), ('PreOpenInterest', 'LargeVolume'), ('OpenPrice', 'Price'),
+    ('HighestPrice', 'Price'), ('LowestPrice', 'Price'), ('Volume', 'Volume'), ('Turnover', 'Money'),
+    ('OpenInterest', 'LargeVolume'), ('ClosePrice', 'Price'), ('SettlementPrice', 'Price'),
+    ('UpperLimitPrice', 'Price'), ('LowerLimitPrice', 'Price'), ('PreDelta', 'Ratio'), ('CurrDelta', 'Ratio'),
+    # 网关发送的 UpdateTime 带日期和毫秒: 20240105 09:00:01:500, 比 ApiStruct 中的 Time 长
+    ('UpdateTime', 'char[24]'), ('UpdateMillisec', 'Millisec'),
+    ('BidPrice1', 'Price'), ('BidVolume1', 'Volume'), ('AskPrice1', 'Price'), ('AskVolume1', 'Volume'),
+    ('BidPrice2', 'Price'), ('BidVolume2', 'Volume'), ('AskPrice2', 'Price'), ('AskVolume2', 'Volume'),
+    ('BidPrice3', 'Price'), ('BidVolume3', 'Volume'), ('AskPrice3', 'Price'), ('AskVolume3', 'Volume'),
+    ('BidPrice4', 'Price'), ('BidVolume4', 'Volume'), ('AskPrice4', 'Price'), ('AskVolume4', 'Volume'),
+    ('BidPrice5', 'Price'), ('BidVolume5', 'Volume'), ('AskPrice5', 'Price'), ('AskVolume5', 'Volume'),
+    ('AveragePrice', 'Price'), ('ActionDay', 'Date'),
+])
+
+STRUCT_LAYOUTS = {'OnRtnDepthMarketData': DEPTH_MARKET_DATA}
+
+
+class StructCodec(JsonCodec):
+    name = 'struct'
+    binary = True
+
+    def encode(self, channel: str, obj) -> bytes:
+        layout = STRUCT_LAYOUTS.get(message_type(channel))
+        if layout is not None and isinstance(obj, dict):
+            return layout.pack(obj)
+        return json.dumps(obj).encode()
+
+    def decode(self, channel: str, data):
+        layout = STRUCT_LAYOUTS.get(message_type(channel))
+        if layout is not None and len(data) == layout.size:
+            return layout.unpack(data)
+        return json.loads(data)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec, StructCodec)}
+
+
+def get_codec(name: str = None) -> Codec:
+    """:param name: json/msgpack/struct, 默认为 [MSG_CHANNEL] codec"""
+    return CODECS[name if name else config.get('MSG_CHANNEL', 'codec', fallback='json')]()
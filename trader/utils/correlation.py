@@ -0,0 +1,251 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+品种日收益率的相关系数矩阵, 增量维护
+
+对每一对品种 (i, j), 只统计两者都有收益率的日期(与 pandas corr 相同), 保存:
+    n[i, j]   = 有效天数
+    sx[i, j]  = sum(x_i)       sxx[i, j] = sum(x_i^2)       sxy[i, j] = sum(x_i * x_j)
+新的一天加入窗口、最早的一天移出窗口都是 O(p^2) 的外积更新, 不用重新读取K线
+指数加权版本用同样的量, 只统计同一个窗口: 每天先乘以衰减系数, 再减去移出窗口的一天(权重 decay^window), 加入新的一天
+这样增量更新的结果与用窗口内的数据重新计算相同
+"""
+import io
+import math
+import logging
+import datetime
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import redis
+
+from panel.models import MainBar
+from trader.utils.read_config import config
+
+logger = logging.getLogger('Correlation')
+
+CORRELATION_KEY = 'CORRELATION:STATE'
+
+
+@dataclass
+class PairSums:
+    """按品种对统计的和, 每个都是 p x p 矩阵"""
+    n: np.ndarray
+    sx: np.ndarray
+    sxx: np.ndarray
+    sxy: np.ndarray
+
+    @classmethod
+    def zeros(cls, size: int):
+        return cls(*(np.zeros((size, size)) for _ in range(4)))
+
+    @classmethod
+    def from_rows(cls, rows: np.ndarray, weight: np.ndarray = None):
+        """rows 为 (天数, p) 的收益率, NaN 表示当天没有收益率; weight 为每一天的权重"""
+        mask = ~np.isnan(rows)
+        value = np.where(mask, rows, 0.0)
+        mask = mask.astype(float)
+        weighted_mask, weighted_value = (mask, value) if weight is None else (mask * weight[:, None], value * weight[:, None])
+        return cls(n=weighted_mask.T @ mask, sx=weighted_value.T @ mask,
+                   sxx=(weighted_value * value).T @ mask, sxy=weighted_value.T @ value)
+
+    def add(self, row: np.ndarray, sign: float = 1.0):
+        mask = ~np.isnan(row)
+        value = np.where(mask, row, 0.0)
+        mask = mask.astype(float)
+        self.n += sign * np.outer(mask, mask)
+        self.sx += sign * np.outer(value, mask)
+        self.sxx += sign * np.outer(value * value, mask)
+        self.sxy += sign * np.outer(value, value)
+
+    def decay(self, factor: float):
+        for matrix in (self.n, self.sx, self.sxx, self.sxy):
+            matrix *= factor
+
+    def corr(self) -> np.ndarray:
+        # sx.T[i, j] = sx[j, i] 即 (i, j) 两者都有数据时 x_j 的和
+        cov = self.n * self.sxy - self.sx * self.sx.T
+        var_i = self.n * self.sxx - self.sx ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = cov / np.sqrt(var_i * var_i.T)
+        result[(self.n < 2) | ~np.isfinite(result)] = np.nan
+        return np.clip(result, -1.0, 1.0)
+
+
+@dataclass
+class CorrelationState:
+    codes: list
+    window: int
+    halflife: float
+    day: str = None  # 已包含的最后一天
+    last_close: np.ndarray = None  # 每个品种最近的收盘价, 用来计算下一天的收益率
+    rows: np.ndarray = None  # 窗口内的收益率, 环形缓冲区 (window, p)
+    head: int = 0  # 下一行写入的位置
+    count: int = 0  # 窗口内的天数
+    sums: PairSums = None
+    ew_sums: PairSums = None  # 窗口内第 k 天(0为最新)的权重为 decay^k
+
+    @property
+    def decay(self) -> float:
+        return 0.5 ** (1 / self.halflife)
+
+    @classmethod
+    def build(cls, codes: list, closes: pd.DataFrame, window: int, halflife: float):
+        """
+        用收盘价(日期 x 品种)初始化, 收益率按每个品种自己的K线计算, 缺失的日期不参与
+        """
+        state = cls(list(codes), window, halflife)
+        closes = closes.reindex(columns=state.codes)
+        returns = pd.DataFrame({code: closes[code].dropna().pct_change() for code in state.codes}).reindex(closes.index)
+        rows = returns.to_numpy(dtype=float)[-window:]
+        size = len(state.codes)
+        state.rows = np.full((window, size), np.nan)
+        state.count = len(rows)
+        state.rows[:state.count] = rows
+        state.head = state.count % window
+        state.sums = PairSums.from_rows(rows)
+        state.ew_sums = PairSums.from_rows(rows, state.decay ** np.arange(len(rows) - 1, -1, -1, dtype=float))
+        state.last_close = closes.ffill().iloc[-1].to_numpy(dtype=float) if len(closes) else np.full(size, np.nan)
+        state.day = closes.index[-1].date().isoformat() if len(closes) else None
+        return state
+
+    def apply(self, day: str, close: np.ndarray):
+        """加入一天的收盘价, NaN 表示该品种当天没有K线"""
+        row = close / self.last_close - 1
+        self.last_close = np.where(np.isnan(close), self.last_close, close)
+        self.ew_sums.decay(self.decay)
+        if self.count == self.window:
+            # 移出窗口的一天, 衰减后的权重为 decay^window
+            self.sums.add(self.rows[self.head], -1.0)
+            self.ew_sums.add(self.rows[self.head], -self.decay ** self.window)
+        else:
+            self.count += 1
+        self.rows[self.head] = row
+        self.head = (self.head + 1) % self.window
+        self.sums.add(row)
+        self.ew_sums.add(row)
+        self.day = day
+
+    def corr(self) -> pd.DataFrame:
+        return pd.DataFrame(self.sums.corr(), index=self.codes, columns=self.codes)
+
+    def ew_corr(self) -> pd.DataFrame:
+        return pd.DataFrame(self.ew_sums.corr(), index=self.codes, columns=self.codes)
+
+    def dumps(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez(buffer, codes=np.array(self.codes), meta=np.array([self.window, self.halflife, self.head, self.count], dtype=float),
+                 day=np.array([self.day or '']), last_close=self.last_close, rows=self.rows,
+                 **{f'{name}_{key}': getattr(sums, key) for name, sums in (('sums', self.sums), ('ew', self.ew_sums))
+                    for key in ('n', 'sx', 'sxx', 'sxy')})
+        return buffer.getvalue()
+
+    @classmethod
+    def loads(cls, data: bytes):
+        with np.load(io.BytesIO(data)) as f:
+            window, halflife, head, count = f['meta'].tolist()
+            return cls(codes=f['codes'].tolist(), window=int(window), halflife=halflife, day=str(f['day'][0]) or None,
+                       last_close=f['last_close'], rows=f['rows'], head=int(head), count=int(count),
+                       sums=PairSums(*(f[f'sums_{key}'] for key in ('n', 'sx', 'sxx', 'sxy'))),
+                       ew_sums=PairSums(*(f[f'ew_{key}'] for key in ('n', 'sx', 'sxx', 'sxy'))))
+
+
+class CorrelationService:
+    """
+    相关系数矩阵服务, 状态保存在 Redis 的 CORRELATION:STATE 中
+    窗口为最近 [CORRELATION] window 个交易日, 指数加权的半衰期为 [CORRELATION] halflife 个交易日
+    品种列表或参数变化时重新计算, 换月后复权价格变了需要 invalidate
+    """
+    def __init__(self, window: int = None, halflife: float = None, redis_client: redis.StrictRedis = None):
+        self.window = window if window else config.getint('CORRELATION', 'window', fallback=730)
+        self.halflife = halflife if halflife else config.getfloat('CORRELATION', 'halflife', fallback=120)
+        self.__redis = redis_client
+        self.__state = None
+
+    def _get_redis(self) -> redis.StrictRedis:
+        if self.__redis is None:
+            # 状态是二进制数据, 不能 decode_responses
+            self.__redis = redis.StrictRedis(
+                host=config.get('REDIS', 'host', fallback='localhost'),
+                port=config.getint('REDIS', 'port', fallback=6379),
+                db=config.getint('REDIS', 'db', fallback=0))
+        return self.__redis
+
+    def _load(self):
+        if self.__state is None:
+            try:
+                data = self._get_redis().get(CORRELATION_KEY)
+                self.__state = CorrelationState.loads(data) if data else None
+            except Exception as e:
+                logger.warning(f'读取相关系数状态失败: {repr(e)}', exc_info=True)
+        return self.__state
+
+    def _save(self, state: CorrelationState):
+        self.__state = state
+        try:
+            self._get_redis().set(CORRELATION_KEY, state.dumps())
+        except Exception as e:
+            logger.warning(f'保存相关系数状态失败: {repr(e)}', exc_info=True)
+
+    def invalidate(self):
+        self.__state = None
+        self._get_redis().delete(CORRELATION_KEY)
+
+    @staticmethod
+    def load_closes(codes: list, day: datetime.datetime, start: datetime.date = None) -> pd.DataFrame:
+        """一次读取多个品种 (start, day] 之间的复权收盘价, 返回 日期 x 品种"""
+        queryset = MainBar.objects.filter(product_code__in=codes, time__lte=day.date())
+        if start is not None:
+            queryset = queryset.filter(time__gt=start)
+        df = queryset.order_by('time').adjusted_df('time', 'product_code', 'close', parse_dates=['time'])
+        if df.empty:
+            return pd.DataFrame(columns=codes, dtype=float)
+        return df.pivot(index='time', columns='product_code', values='close').reindex(columns=codes)
+
+    def rebuild(self, codes: list, day: datetime.datetime) -> CorrelationState:
+        # 多读一天用来计算窗口内第一天的收益率
+        day_list = list(MainBar.objects.filter(product_code__in=codes, time__lte=day.date()).order_by(
+            '-time').values_list('time', flat=True).distinct()[:self.window + 1])
+        start = day_list[-1] - datetime.timedelta(days=1) if day_list else None
+        state = CorrelationState.build(codes, self.load_closes(codes, day, start), self.window, self.halflife)
+        logger.debug(f'相关系数重新计算完成: {len(codes)}个品种 {state.count}天')
+        return state
+
+    def update(self, codes: list, day: datetime.datetime) -> CorrelationState:
+        """把状态推进到 day, 通常只需要读取并加入一天的收盘价"""
+        codes = list(codes)
+        state = self._load()
+        if state is None or state.codes != codes or state.window != self.window or \
+                not math.isclose(state.halflife, self.halflife) or state.day is None or state.day > day.date().isoformat():
+            state = self.rebuild(codes, day)
+        elif state.day < day.date().isoformat():
+            closes = self.load_closes(codes, day, datetime.date.fromisoformat(state.day))
+            for time, close in zip(closes.index, closes.to_numpy(dtype=float)):
+                state.apply(time.date().isoformat(), close)
+        else:
+            return state
+        self._save(state)
+        return state
+
+    def corr(self, codes: list, day: datetime.datetime) -> pd.DataFrame:
+        return self.update(codes, day).corr()
+
+    def ew_corr(self, codes: list, day: datetime.datetime) -> pd.DataFrame:
+        return self.update(codes, day).ew_corr()
+
+
+correlation_service = CorrelationService()
@@ -0,0 +1,145 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+回调中的数据库访问和事件循环阻塞检查
+
+DBExecutor: 在固定大小的线程池中执行同步的 ORM 代码, 回调 await 结果, 期间事件循环继续处理其他消息
+    Django 的数据库连接是线程本地的, 每个线程复用自己的连接, 执行前后用 close_old_connections 清理超时或出错的连接
+    同一个 key 的调用(如同一合约的成交和委托回报)按到达顺序串行执行, 一个调用可以同时占用多个 key
+LoopWatchdog: 后台线程定期向事件循环投递一个回调, 超过阈值没有执行说明循环被阻塞, 打印事件循环线程当前的调用栈
+"""
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from trader.utils.read_config import config
+
+logger = logging.getLogger('DBExecutor')
+
+
+def call_in_thread(func, *args, **kwargs):
+    """在线程池中执行 ORM 代码, 执行前后清理该线程超时或出错的数据库连接"""
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+class DBExecutor:
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers if max_workers else config.getint('EVENT_LOOP', 'db_workers', fallback=4)
+        self.__pool = None
+        self.__locks = dict()  # {key: [asyncio.Lock, 使用中的调用数]}
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self.__pool is None:
+            self.__pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='db')
+        return self.__pool
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key):
+        """同一个 key 的调用串行执行, 没有调用在使用时删除该 key 的锁"""
+        entry = self.__locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.__locks[key]
+
+    async def run(self, func, *args, key=None, **kwargs):
+        """
+        在线程池中执行 func(*args, **kwargs)
+        :param key: 不为空时与相同 key 的调用串行执行, 为 list/tuple 时与其中任意一个 key 的调用都串行执行
+        """
+        call = functools.partial(call_in_thread, func, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+        if key is None:
+            return await loop.run_in_executor(self._get_pool(), call)
+        async with contextlib.AsyncExitStack() as stack:
+            # 多个 key 按固定顺序加锁, 避免互相等待
+            for k in sorted(set(key)) if isinstance(key, (list, tuple)) else [key]:
+                await stack.enter_async_context(self.lock(k))
+            return await loop.run_in_executor(self._get_pool(), call)
+
+    def shutdown(self):
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False, cancel_futures=True)
+            self.__pool = None
+
+
+class LoopWatchdog:
+    def __init__(self, loop: asyncio.AbstractEventLoop, threshold: float = None, interval: float = None):
+        """
+        :param threshold: 事件循环阻塞超过该时间(秒)时打印调用栈, 0 表示不检查
+        :param interval: 检查间隔(秒), 默认为阈值的一半
+        """
+        self.loop = loop
+        self.threshold = threshold if threshold is not None else \
+            config.getfloat('EVENT_LOOP', 'block_threshold', fallback=0.5)
+        self.interval = interval if interval else self.threshold / 2
+        self.__loop_thread = None
+        self.__last_beat = 0.0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def _beat(self):
+        self.__last_beat = time.monotonic()
+
+    def start(self):
+        """在事件循环中调用"""
+        if self.threshold <= 0 or self.__thread is not None:
+            return
+        self.__loop_thread = threading.get_ident()
+        self.__last_beat = time.monotonic()
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self._run, name='loop-watchdog', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread = None
+
+    def _run(self):
+        blocked_since = None
+        while not self.__stop.wait(self.interval):
+            now = time.monotonic()
+            blocked = now - self.__last_beat
+            if blocked > self.threshold:
+                if blocked_since is None:
+                    # 每次阻塞只打印一次调用栈
+                    blocked_since = self.__last_beat
+                    frame = sys._current_frames().get(self.__loop_thread)
+                    stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+                    logger.warning(f'事件循环已阻塞{blocked:.2f}秒, 当前调用栈:\n{stack}')
+            elif blocked_since is not None:
+                logger.warning(f'事件循环阻塞结束, 共{self.__last_beat - blocked_since:.2f}秒')
+                blocked_since = None
+            try:
+                self.loop.call_soon_threadsafe(self._beat)
+            except RuntimeError:  # 事件循环已关闭
+                break
@@ -0,0 +1,104 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import gzip
+import hashlib
+import datetime
+import logging
+import threading
+import ujson as json
+
+from trader.utils.read_config import app_dir, config
+
+logger = logging.getLogger('ExchangeCache')
+
+
+class ExchangeCache:
+    """
+    交易所原始数据的本地缓存
+
+    目录结构:
+        objects/ab/abcdef...gz          按内容sha256存放的gzip压缩原始数据
+        index/SHFE/20211209/kx.json     (交易所, 日期, 接口) -> 内容hash、ETag、Last-Modified、编码
+    在当天 [HTTP] final_hour 点以后下载的数据视为定稿, 命中后直接读盘;
+    其他数据(收盘前下载的、旧版本没有下载时间的)带上ETag/Last-Modified做条件请求, 返回304后更新下载时间。
+    """
+    def __init__(self, root: str = None):
+        self.root = root if root else os.path.join(app_dir.user_cache_dir, 'exchange')
+        self.final_hour = config.getint('HTTP', 'final_hour', fallback=17)
+
+    def is_final(self, day: datetime.date, meta: dict) -> bool:
+        """数据是在交易所发布当日数据之后下载的, 不需要再访问交易所"""
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        fetched_at = meta.get('fetched_at')
+        if not fetched_at:
+            return False
+        final_time = datetime.datetime.combine(day, datetime.time(self.final_hour))
+        return datetime.datetime.fromisoformat(fetched_at) >= final_time
+
+    def _index_path(self, exchange: str, day: datetime.date, endpoint: str) -> str:
+        return os.path.join(self.root, 'index', exchange, day.strftime('%Y%m%d'), f'{endpoint}.json')
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'objects', digest[:2], f'{digest}.gz')
+
+    @staticmethod
+    def _write_atomic(path: str, content: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 缓存读写在线程池中执行, 临时文件名要区分进程和线程
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def get(self, exchange: str, day: datetime.date, endpoint: str) -> (dict, bytes):
+        """
+        :return: (meta, body), 未命中时返回 (None, None)
+        """
+        try:
+            with open(self._index_path(exchange, day, endpoint), 'rb') as f:
+                meta = json.loads(f.read())
+            with gzip.open(self._object_path(meta['digest']), 'rb') as f:
+                return meta, f.read()
+        except FileNotFoundError:
+            return None, None
+        except Exception as e:
+            logger.warning(f'读取缓存 {exchange}.{day:%Y%m%d}.{endpoint} 失败: {repr(e)}')
+            return None, None
+
+    def put(self, exchange: str, day: datetime.date, endpoint: str, body: bytes, encoding: str, headers: dict):
+        digest = hashlib.sha256(body).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            self._write_atomic(object_path, gzip.compress(body))
+        # 响应头的大小写不固定(ETag/Etag), 统一转成小写再取
+        headers = {key.lower(): value for key, value in headers.items()}
+        meta = {'digest': digest, 'encoding': encoding,
+                'etag': headers.get('etag'), 'last_modified': headers.get('last-modified')}
+        self.touch(exchange, day, endpoint, meta)
+
+    def touch(self, exchange: str, day: datetime.date, endpoint: str, meta: dict):
+        """记录下载(或条件请求确认未变化)的时间"""
+        meta = dict(meta, fetched_at=datetime.datetime.now().isoformat(timespec='seconds'))
+        self._write_atomic(self._index_path(exchange, day, endpoint), json.dumps(meta).encode())
+
+    def discard(self, exchange: str, day: datetime.date, endpoint: str):
+        """解析失败的数据不能留在缓存里, 只删索引, 内容文件可能被其他日期引用"""
+        try:
+            os.remove(self._index_path(exchange, day, endpoint))
+        except FileNotFoundError:
+            pass
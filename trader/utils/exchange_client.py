@@ -0,0 +1,129 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import asyncio
+import logging
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import aiohttp
+from multidict import CIMultiDict
+
+from trader.utils.read_config import config
+from trader.utils.exchange_cache import ExchangeCache
+from trader.utils.exchange_source import ExchangeSource, ExchangeResponse
+
+logger = logging.getLogger('ExchangeClient')
+
+
+class ExchangeClient(ExchangeSource):
+    """
+    进程内共享的交易所HTTP客户端
+
+    所有交易所抓取函数共用一个 aiohttp.ClientSession:
+    1. keep-alive 连接池, 批量回补时复用TCP连接
+    2. 每个交易所单独限制并发连接数
+    3. DNS缓存、超时控制、失败后指数退避重试
+    4. 带 cache_key 的请求走本地缓存, 历史数据不重复下载
+    """
+    def __init__(self, host_limit: dict = None):
+        self.host_limit = host_limit if host_limit else dict()
+        self.default_limit = config.getint('HTTP', 'limit_per_host', fallback=5)
+        self.total_limit = config.getint('HTTP', 'limit', fallback=100)
+        self.dns_cache = config.getint('HTTP', 'dns_cache', fallback=600)
+        self.keepalive = config.getint('HTTP', 'keepalive', fallback=60)
+        self.timeout = config.getint('HTTP', 'timeout', fallback=30)
+        self.retry = config.getint('HTTP', 'retry', fallback=3)
+        self.backoff = config.getfloat('HTTP', 'backoff', fallback=1.0)
+        self.cache = ExchangeCache() if config.getboolean('HTTP', 'cache', fallback=True) else None
+        self.__session = None
+        self.__host_semaphore = defaultdict(lambda: None)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # ClientSession 必须在事件循环内创建, 所以延迟到第一次请求时
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.total_limit, limit_per_host=max([self.default_limit, *self.host_limit.values()]),
+                ttl_dns_cache=self.dns_cache, keepalive_timeout=self.keepalive)
+            self.__session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.__session
+
+    def _get_semaphore(self, host: str) -> asyncio.Semaphore:
+        if self.__host_semaphore[host] is None:
+            self.__host_semaphore[host] = asyncio.Semaphore(self.host_limit.get(host, self.default_limit))
+        return self.__host_semaphore[host]
+
+    async def request(self, method: str, url: str, cache_key: tuple = None, **kwargs) -> ExchangeResponse:
+        """
+        发送请求并读取全部内容, 网络错误或5xx时按 backoff * 2^n 秒退避重试
+        :param method: GET/POST
+        :param url: 请求地址
+        :param cache_key: (交易所, 日期, 接口名), 为空时不使用缓存
+        :param kwargs: 透传给 aiohttp 的参数, 如 data, allow_redirects, headers
+        :return: ExchangeResponse
+        """
+        if cache_key is None or self.cache is None:
+            return await self._request(method, url, **kwargs)
+        # 缓存的读写要解压缩和读写文件, 批量回补时有成千上万个文件, 放到线程池中执行, 不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        meta, body = await loop.run_in_executor(None, self.cache.get, *cache_key)
+        if meta is not None:
+            if self.cache.is_final(cache_key[1], meta):
+                return ExchangeResponse(status=200, body=body, encoding=meta['encoding'], cached=True)
+            headers = dict(kwargs.pop('headers', None) or {})
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+            kwargs['headers'] = headers
+        response = await self._request(method, url, **kwargs)
+        if response.status == 304 and meta is not None:
+            await loop.run_in_executor(None, self.cache.touch, *cache_key, meta)
+            return ExchangeResponse(status=200, body=body, encoding=meta['encoding'], cached=True)
+        if response.status == 200:
+            await loop.run_in_executor(
+                None, self.cache.put, *cache_key, response.body, response.encoding, response.headers)
+        return response
+
+    def discard(self, cache_key: tuple):
+        if self.cache is not None:
+            self.cache.discard(*cache_key)
+
+    async def _request(self, method: str, url: str, **kwargs) -> ExchangeResponse:
+        session = self._get_session()
+        semaphore = self._get_semaphore(urlsplit(url).hostname)
+        for retry in range(self.retry + 1):
+            try:
+                # 每次尝试单独占用并发名额, 退避等待期间不占用, 一个失败的请求不会拖住同一交易所的其他请求
+                async with semaphore:
+                    async with session.request(method, url, **kwargs) as response:
+                        body = await response.read()
+                        if response.status < 500 or retry == self.retry:
+                            return ExchangeResponse(
+                                status=response.status, body=body, encoding=response.get_encoding(),
+                                headers=CIMultiDict(response.headers))
+                        logger.debug(f'{method} {url} 返回 {response.status}, 第{retry + 1}次重试')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if retry == self.retry:
+                    raise
+                logger.debug(f'{method} {url} 发生错误: {repr(e)}, 第{retry + 1}次重试')
+            await asyncio.sleep(self.backoff * 2 ** retry)
+
+    async def close(self):
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
+        self.__host_semaphore.clear()
@@ -0,0 +1,80 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+import datetime
+from abc import abstractmethod, ABCMeta
+from dataclasses import dataclass, field
+
+from trader.utils.exchange_cache import ExchangeCache
+
+
+@dataclass
+class ExchangeResponse:
+    """交易所返回的原始数据，读取完毕后连接即归还连接池"""
+    status: int
+    body: bytes
+    encoding: str = 'utf-8'
+    headers: dict = field(default_factory=dict)  # 网络请求时为 CIMultiDict, 不区分大小写
+    cached: bool = False
+
+    def text(self) -> str:
+        return self.body.decode(self.encoding)
+
+
+class ExchangeSource(metaclass=ABCMeta):
+    """
+    交易所原始数据来源, update_from_* 只通过这个接口取数据
+    cache_key 为 (交易所, 日期, 接口名), 离线回放时据此定位数据文件
+    """
+    @abstractmethod
+    async def request(self, method: str, url: str, cache_key: tuple = None, **kwargs) -> ExchangeResponse:
+        pass
+
+    async def get(self, url: str, **kwargs) -> ExchangeResponse:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> ExchangeResponse:
+        return await self.request('POST', url, **kwargs)
+
+    def discard(self, cache_key: tuple):
+        pass
+
+    async def close(self):
+        pass
+
+
+class ReplaySource(ExchangeSource):
+    """
+    从事先抓取的目录回放交易所数据, 不访问网络
+    目录格式与 ExchangeCache 相同, 把线上的缓存目录拷贝过来即可使用
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.cache = ExchangeCache(root)
+
+    async def request(self, method: str, url: str, cache_key: tuple = None, **kwargs) -> ExchangeResponse:
+        meta, body = self.cache.get(*cache_key) if cache_key else (None, None)
+        if meta is None:
+            return ExchangeResponse(status=404, body=b'')
+        return ExchangeResponse(status=200, body=body, encoding=meta['encoding'], cached=True)
+
+    def days(self, exchange: str) -> list:
+        """目录中某个交易所已有数据的全部日期, 升序"""
+        try:
+            day_list = os.listdir(os.path.join(self.root, 'index', exchange))
+        except FileNotFoundError:
+            return []
+        return sorted(datetime.datetime.strptime(day, '%Y%m%d') for day in day_list)
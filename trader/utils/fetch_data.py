@@ -1,5 +1,6 @@
 import sys
 import os
+import time
 import datetime
 import asyncio
 import pytz
@@ -17,33 +18,18 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "dashboard.settings"
 os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
 django.setup()
 from trader.utils import is_trading_day, update_from_shfe, update_from_dce, update_from_czce, update_from_cffex, \
-    create_main_all, fetch_from_quandl_all, clean_daily_bar, load_kt_data, calc_his_all, check_trading_day
+    create_main_all, fetch_from_quandl_all, clean_daily_bar, load_kt_data, calc_his_all, check_trading_day, \
+    update_from_gfex
+from trader.utils.exchange_source import ReplaySource
+from trader.utils.backfill import Backfill
+from panel.const import ExchangeType
 from django.utils import timezone
 
 
 async def fetch_bar():
-    day_end = timezone.localtime()
+    day_end = timezone.localtime().date()
     day_start = day_end - datetime.timedelta(days=365)
-    tasks = []
-    while day_start <= day_end:
-        tasks.append(check_trading_day(day_start))
-        day_start += datetime.timedelta(days=1)
-    trading_days = []
-    for f in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
-        rst = await f
-        trading_days.append(rst)
-    tasks.clear()
-    for day, trading in trading_days:
-        if trading:
-            tasks += [
-                asyncio.ensure_future(update_from_shfe(day)),
-                asyncio.ensure_future(update_from_dce(day)),
-                asyncio.ensure_future(update_from_czce(day)),
-                asyncio.ensure_future(update_from_cffex(day)),
-            ]
-    print('task len=', len(tasks))
-    for f in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
-        await f
+    await Backfill().run(day_start, day_end)
 
 
 async def fetch_bar2():
@@ -64,7 +50,24 @@ async def fetch_bar2():
     print('all done!')
 
 
+async def replay_bar(directory: str):
+    """
+    从事先抓取的目录离线重建日线, 不访问网络, 同时统计整个入库流程的耗时
+    """
+    source = ReplaySource(directory)
+    day_set = set()
+    for exchange in ExchangeType.values.keys():
+        day_set.update(source.days(exchange))
+    begin = time.perf_counter()
+    for day in tqdm(sorted(day_set)):
+        day = timezone.make_aware(day)
+        await asyncio.gather(*[func(day, source) for func in (
+            update_from_shfe, update_from_dce, update_from_czce, update_from_cffex, update_from_gfex)])
+    print(f'replay {len(day_set)} days cost {time.perf_counter() - begin:.1f}s')
+
+
 # asyncio.get_event_loop().run_until_complete(fetch_bar2())
+# asyncio.get_event_loop().run_until_complete(replay_bar('/path/to/exchange'))
 create_main_all()
 # fetch_from_quandl_all()
 # clean_dailybar()
@@ -0,0 +1,110 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+技术指标, 输入为一维数组或二维 (日期 x 品种) 数组, 二维时按列分别计算
+
+递推类指标没有用 ewm/lfilter: 它们把 (y*(n-1)+x)/n 改写成 y*(1-1/n)+x/n,
+末位会有舍入差异, 而信号判断依赖价格比较, 这里逐日递推、按品种向量化, 保证与原来的结果完全一致。
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def wilder_average(x, n: int) -> np.ndarray:
+    """
+    平滑移动平均: y[0] = x[0], y[i] = (y[i-1] * (n-1) + x[i]) / n
+    y[i-1] 为 NaN 时从 x[i] 重新开始
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.empty_like(x)
+    if x.shape[0] == 0:
+        return y
+    if x.ndim == 1:  # 一维时用 Python float 递推, 比逐个访问 numpy 标量快
+        values = x.tolist()
+        prev = values[0]
+        result = [prev]
+        for value in values[1:]:
+            prev = value if prev != prev else (prev * (n - 1) + value) / n
+            result.append(prev)
+        y[:] = result
+        return y
+    y[0] = x[0]
+    for i in range(1, x.shape[0]):
+        y[i] = np.where(np.isnan(y[i - 1]), x[i], (y[i - 1] * (n - 1) + x[i]) / n)
+    return y
+
+
+def true_range(high, low, close) -> np.ndarray:
+    """真实波幅, 第一天没有昨收, 为 NaN (与 talib.TRANGE 相同)"""
+    high, low, close = (np.asarray(v, dtype=float) for v in (high, low, close))
+    tr = np.full_like(high, np.nan)
+    prev_close = close[:-1]
+    tr[1:] = np.maximum(np.maximum(high[1:] - low[1:], np.abs(high[1:] - prev_close)), np.abs(low[1:] - prev_close))
+    return tr
+
+
+def atr(high, low, close, n: int) -> np.ndarray:
+    """
+    平均真实波幅, 与 talib.ATR 逐位相同:
+    第 n 天为前 n 个真实波幅的简单平均(顺序累加), 之后 atr = (atr * (n-1) + tr) / n
+    开头缺失的数据(如晚上市的品种)与 talib 一样跳过, 从第一个三者都有值的位置开始计算
+    """
+    high, low, close = (np.asarray(v, dtype=float) for v in (high, low, close))
+    begin = np.argmax(~(np.isnan(high) | np.isnan(low) | np.isnan(close)), axis=0)
+    if np.any(begin > 0):
+        if high.ndim == 1:
+            out = np.full_like(high, np.nan)
+            out[begin:] = atr(high[begin:], low[begin:], close[begin:], n)
+            return out
+        return np.column_stack([atr(high[:, i], low[:, i], close[:, i], n) for i in range(high.shape[1])])
+    tr = true_range(high, low, close)
+    if n <= 1:
+        return tr
+    out = np.full_like(tr, np.nan)
+    if tr.shape[0] <= n:
+        return out
+    prev = np.cumsum(tr[1:n + 1], axis=0)[-1] / n
+    out[n] = prev
+    if tr.ndim == 1:
+        prev = float(prev)
+        result = []
+        for value in tr[n + 1:].tolist():
+            prev = (prev * (n - 1) + value) / n
+            result.append(prev)
+        out[n + 1:] = result
+        return out
+    for i in range(n + 1, tr.shape[0]):
+        prev = (prev * (n - 1) + tr[i]) / n
+        out[i] = prev
+    return out
+
+
+def rolling_high(x, n: int) -> np.ndarray:
+    """N日最高, 前 n-1 天为 NaN (与 pandas rolling(n).max() 相同)"""
+    return _rolling(x, n, np.max)
+
+
+def rolling_low(x, n: int) -> np.ndarray:
+    """N日最低, 前 n-1 天为 NaN (与 pandas rolling(n).min() 相同)"""
+    return _rolling(x, n, np.min)
+
+
+def _rolling(x, n: int, func) -> np.ndarray:
+    x = np.asarray(x, dtype=float)
+    out = np.full_like(x, np.nan)
+    if x.shape[0] >= n:
+        out[n - 1:] = func(sliding_window_view(x, n, axis=0), axis=-1)
+    return out
@@ -0,0 +1,179 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import copy
+import logging
+from dataclasses import dataclass, field, asdict
+
+import numpy as np
+import redis
+import ujson as json
+
+from trader.utils.bar_history import BarHistory
+from trader.utils.indicator import atr, wilder_average
+from trader.utils.read_config import config
+
+logger = logging.getLogger('IndicatorState')
+
+INDICATOR_KEY = 'INDICATOR:{}:{}'
+
+
+@dataclass
+class IndicatorState:
+    """
+    某个品种、某组参数下, 截止最后一根K线的指标状态, 新K线到来时 O(1) 更新
+    closes 保存最近 break_n+1 个收盘价, 用于计算当天和前一天的N日最高/最低
+    prev 是应用最后一根K线之前的状态, 同一天重复计算(或数据修正)时先回退再重新应用
+    """
+    break_n: int
+    atr_n: int
+    short_n: int
+    long_n: int
+    time: str = None
+    close: float = None
+    atr: float = None
+    short_trend: float = None
+    long_trend: float = None
+    closes: list = field(default_factory=list)
+    prev: dict = None
+
+    @property
+    def key(self) -> str:
+        return f'{self.break_n}:{self.atr_n}:{self.short_n}:{self.long_n}'
+
+    @classmethod
+    def build(cls, bars: BarHistory, break_n: int, atr_n: int, short_n: int, long_n: int):
+        """
+        用整段K线计算初始状态, 结果与对这段K线整体计算指标完全相同
+        :return: IndicatorState, K线数量不足以计算全部指标时返回 None
+        """
+        if len(bars) < max(atr_n, break_n) + 2:
+            return None
+        time_list = np.datetime_as_string(bars.time, unit='D').tolist()
+        atr_arr = atr(bars.high, bars.low, bars.close, atr_n)
+        short_arr = wilder_average(bars.close, short_n)
+        long_arr = wilder_average(bars.close, long_n)
+        close_list = bars.close.tolist()
+
+        def snapshot(i: int) -> dict:
+            return {'time': time_list[i], 'close': close_list[i], 'atr': float(atr_arr[i]),
+                    'short_trend': float(short_arr[i]), 'long_trend': float(long_arr[i]),
+                    'closes': close_list[max(i - break_n, 0):i + 1]}
+        state = cls(break_n, atr_n, short_n, long_n, **snapshot(len(bars) - 1))
+        state.prev = snapshot(len(bars) - 2)
+        return state
+
+    def _snapshot(self) -> dict:
+        return {'time': self.time, 'close': self.close, 'atr': self.atr, 'short_trend': self.short_trend,
+                'long_trend': self.long_trend, 'closes': list(self.closes)}
+
+    def apply(self, time: str, high: float, low: float, close: float):
+        """应用一根新K线, time 与最后一根相同时视为修正, 先回退到前一天"""
+        if time == self.time:
+            if self.prev is None:
+                raise ValueError(f'{time} 无法回退')
+            for name, value in self.prev.items():
+                setattr(self, name, value)
+            self.prev = None
+        elif time < self.time:
+            raise ValueError(f'{time} 早于最后一根K线 {self.time}')
+        self.prev = self._snapshot()
+        tr = max(high - low, abs(high - self.close), abs(low - self.close))
+        self.atr = (self.atr * (self.atr_n - 1) + tr) / self.atr_n
+        self.short_trend = (self.short_trend * (self.short_n - 1) + close) / self.short_n
+        self.long_trend = (self.long_trend * (self.long_n - 1) + close) / self.long_n
+        self.closes = (self.closes + [close])[-(self.break_n + 1):]
+        self.close = close
+        self.time = time
+
+    def values(self) -> dict:
+        """
+        calc_signal 用到的指标, high_line/low_line 是截止前一天的N日最高/最低收盘价
+        """
+        return {'time': self.time, 'close': self.close, 'atr': self.atr,
+                'short_trend': self.short_trend, 'long_trend': self.long_trend,
+                'high_line': max(self.closes[:-1]), 'low_line': min(self.closes[:-1])}
+
+    def peek(self, time: str, high: float, low: float, close: float) -> dict:
+        """假设 K线(如盘中实时行情)收在 close, 计算指标但不改变状态"""
+        state = copy.deepcopy(self)
+        state.apply(time, high, low, close)
+        return state.values()
+
+    def dumps(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def loads(cls, data: str):
+        return cls(**json.loads(data))
+
+
+class IndicatorStore:
+    """
+    指标状态保存在 Redis 的 INDICATOR:品种:参数 中, 换月后连续合约的复权价格变化, 需要 invalidate
+    """
+    def __init__(self, redis_client: redis.StrictRedis = None):
+        self.__redis = redis_client
+
+    def _get_redis(self) -> redis.StrictRedis:
+        if self.__redis is None:
+            self.__redis = redis.StrictRedis(
+                host=config.get('REDIS', 'host', fallback='localhost'),
+                port=config.getint('REDIS', 'port', fallback=6379),
+                db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
+        return self.__redis
+
+    def get(self, product_code: str, break_n: int, atr_n: int, short_n: int, long_n: int):
+        data = self._get_redis().get(INDICATOR_KEY.format(product_code, f'{break_n}:{atr_n}:{short_n}:{long_n}'))
+        if data is None:
+            return None
+        try:
+            return IndicatorState.loads(data)
+        except Exception as e:
+            logger.warning(f'读取 {product_code} 指标状态失败: {repr(e)}')
+            return None
+
+    def save(self, product_code: str, state: IndicatorState):
+        self._get_redis().set(INDICATOR_KEY.format(product_code, state.key), state.dumps())
+
+    def invalidate(self, product_code: str):
+        client = self._get_redis()
+        for key in client.scan_iter(INDICATOR_KEY.format(product_code, '*')):
+            client.delete(key)
+
+    def advance(self, product_code: str, bars: BarHistory, break_n: int, atr_n: int, short_n: int, long_n: int):
+        """
+        把状态推进到 bars 的最后一根K线并保存, 通常只需应用一根新K线
+        没有状态、状态已不在 bars 范围内或者K线被修改过时, 用 bars 重新计算
+        :return: IndicatorState, K线数量不足时返回 None
+        """
+        state = self.get(product_code, break_n, atr_n, short_n, long_n)
+        time_list = np.datetime_as_string(bars.time, unit='D').tolist()
+        try:
+            start = time_list.index(state.time) if state is not None else None
+            if start is None or state.close != bars.close[start]:
+                raise ValueError('需要重新计算')
+            high, low, close = bars.high.tolist(), bars.low.tolist(), bars.close.tolist()
+            for i in range(start + 1, len(time_list)):
+                state.apply(time_list[i], high[i], low[i], close[i])
+        except ValueError:
+            state = IndicatorState.build(bars, break_n, atr_n, short_n, long_n)
+            if state is None:
+                return None
+        self.save(product_code, state)
+        return state
+
+
+indicator_store = IndicatorStore()
@@ -0,0 +1,201 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+策略参数扫描: 在进程池中用内存回测评估大量参数组合
+全部品种的K线放在一块共享内存中, 子进程只读不复制; 每个子进程按品种缓存各周期的指标, 不同组合之间共用
+"""
+import os
+import math
+import random
+import logging
+import itertools
+from dataclasses import asdict
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from panel.const import SignalType
+from trader.utils.bar_history import BarHistory
+from trader.utils.backtest import IndicatorCache, backtest_product, daily_pnl
+from trader.utils.strategy_param import StrategyParam
+
+logger = logging.getLogger('ParamSweep')
+
+PARAM_FIELDS = ['break_n', 'atr_n', 'long_n', 'short_n', 'stop_n', 'risk']
+BAR_ROWS = ['time', 'open', 'high', 'low', 'close', 'code']  # 共享内存中每行的内容, time 为天数, code 为合约的排序序号
+
+# 子进程中的全局数据, 由 _init_worker 设置
+_shm = None
+_products = list()  # [(product_code, BarHistory, price_tick, volume_multiple, 在全部日期中的位置)]
+_day_count = 0
+_capital = None
+_start = None
+_indicators = dict()  # {product_code: IndicatorCache}
+
+
+def make_grid(space: dict) -> list:
+    """
+    参数空间的全部组合, 去掉短期均线周期不小于长期均线周期的组合
+    :param space: {'break_n': [...], 'atr_n': [...], ...}
+    """
+    return [StrategyParam(**dict(zip(PARAM_FIELDS, values)))
+            for values in itertools.product(*[space[name] for name in PARAM_FIELDS])
+            if values[PARAM_FIELDS.index('short_n')] < values[PARAM_FIELDS.index('long_n')]]
+
+
+def sample_grid(space: dict, count: int, seed: int = None) -> list:
+    """从参数空间中随机抽取 count 个不重复的组合"""
+    grid = make_grid(space)
+    return grid if count >= len(grid) else random.Random(seed).sample(grid, count)
+
+
+def pack_bars(bar_dict: dict) -> (np.ndarray, list, np.ndarray):
+    """
+    把各品种的K线拼成一个 (len(BAR_ROWS), 总长度) 的数组
+    :return: (数组, [(product_code, 起点, 长度)], 全部日期(天数, 升序))
+    """
+    total = sum(len(bars) for bars in bar_dict.values())
+    data = np.empty((len(BAR_ROWS), total))
+    layout = list()
+    offset = 0
+    for product_code, bars in bar_dict.items():
+        size = len(bars)
+        data[0, offset:offset + size] = bars.time.astype('datetime64[D]').astype(np.int64)
+        for row, name in enumerate(BAR_ROWS[1:5], start=1):
+            data[row, offset:offset + size] = getattr(bars, name)
+        # 换月只比较合约大小, 用排序序号代替合约代码
+        code_list = bars.code.tolist() if bars.code is not None else [''] * size
+        rank = {code: i for i, code in enumerate(sorted(set(code_list)))}
+        data[5, offset:offset + size] = [rank[code] for code in code_list]
+        layout.append((product_code, offset, size))
+        offset += size
+    return data, layout, np.unique(data[0])
+
+
+def _init_worker(shm_name: str, shape: tuple, layout: list, days: np.ndarray, inst_info: dict,
+                 capital: Decimal, start):
+    global _shm, _day_count, _capital, _start
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    data = np.ndarray(shape, dtype=np.float64, buffer=_shm.buf)
+    for product_code, offset, size in layout:
+        block = data[:, offset:offset + size]
+        bars = BarHistory(time=block[0].astype(np.int64).astype('datetime64[D]'), open=block[1], high=block[2],
+                          low=block[3], close=block[4], settlement=block[4], code=block[5])
+        price_tick, volume_multiple = inst_info[product_code]
+        _products.append((product_code, bars, price_tick, volume_multiple, np.searchsorted(days, block[0])))
+        _indicators[product_code] = IndicatorCache(bars, price_tick)
+    _day_count = len(days)
+    _capital = capital
+    _start = start
+
+
+def summarize(pnl: np.ndarray, capital: Decimal = None) -> dict:
+    """根据组合每日盈亏计算评价指标"""
+    equity = pnl.cumsum() + float(capital if capital else 0)
+    drawdown = np.maximum.accumulate(equity) - equity
+    std = pnl.std()
+    result = {'profit': float(pnl.sum()), 'max_drawdown': float(drawdown.max()) if len(drawdown) else 0.0,
+              'sharpe': float(pnl.mean() / std * math.sqrt(252)) if std > 0 else 0.0}
+    if capital:
+        years = len(pnl) / 252
+        result['annual_return'] = result['profit'] / float(capital) / years if years > 0 else 0.0
+        result['max_drawdown_ratio'] = float((drawdown / np.maximum.accumulate(equity)).max())
+    return result
+
+
+def evaluate(param: StrategyParam) -> dict:
+    """在子进程中回测一组参数"""
+    pnl = np.zeros(_day_count)
+    position_count = win_count = 0
+    for product_code, bars, price_tick, volume_multiple, day_idx in _products:
+        trades, position = backtest_product(product_code, bars, param, price_tick, volume_multiple,
+                                            _capital, _start, _indicators[product_code])
+        pnl[day_idx] += daily_pnl(bars, position, volume_multiple)
+        # 换月拆开的几笔交易合并为一次持仓统计胜率
+        profit = None
+        for trade in trades:
+            if trade['open_type'] != SignalType.ROLL_OPEN:
+                if profit is not None:
+                    win_count += profit > 0
+                position_count += 1
+                profit = 0
+            profit += trade['profit']
+        if profit is not None:
+            win_count += profit > 0
+    result = {name: getattr(param, name) for name in PARAM_FIELDS}
+    result.update(summarize(pnl, _capital))
+    result['positions'] = position_count
+    result['win_rate'] = win_count / position_count if position_count else 0.0
+    return result
+
+
+def run_sweep(bar_dict: dict, inst_list: list, param_list: list, capital: Decimal = None, start=None,
+              workers: int = None, sort_by: str = 'sharpe') -> pd.DataFrame:
+    """
+    在进程池中评估全部参数组合
+    :param bar_dict: {product_code: BarHistory}, 见 load_bar_range
+    :param inst_list: 参与回测的品种
+    :param param_list: StrategyParam 列表, 见 make_grid/sample_grid
+    :param capital: 开仓资金, 为空时每次开1手
+    :param start: 从这一天开始计算信号
+    :param workers: 进程数, 默认为CPU核数
+    :param sort_by: 排序的评价指标, 从大到小
+    :return: 排好序的结果, 每行一组参数
+    """
+    inst_info = {inst.product_code: (inst.price_tick, inst.volume_multiple)
+                 for inst in inst_list if inst.product_code in bar_dict}
+    data, layout, days = pack_bars({code: bar_dict[code] for code in inst_info})
+    shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    try:
+        np.ndarray(data.shape, dtype=np.float64, buffer=shm.buf)[:] = data
+        workers = workers if workers else os.cpu_count()
+        # 每个子进程一次拿一批组合, 减少通信; 批次不宜太大, 否则最后几个进程空等
+        chunk_size = max(1, min(32, len(param_list) // (workers * 8)))
+        result_list = list()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(shm.name, data.shape, layout, days, inst_info, capital, start)) as pool:
+            for i, rst in enumerate(pool.map(evaluate, param_list, chunksize=chunk_size), start=1):
+                result_list.append(rst)
+                if i % 100 == 0 or i == len(param_list):
+                    logger.info(f'参数扫描进度: {i}/{len(param_list)}')
+    finally:
+        shm.close()
+        shm.unlink()
+    df = pd.DataFrame(result_list)
+    if not df.empty:
+        df = df.sort_values(sort_by, ascending=False).reset_index(drop=True)
+        df.index.name = 'rank'
+    return df
+
+
+def parse_values(text: str, cast=int) -> list:
+    """解析参数取值: 逗号分隔的列表 20,40,60 或者 起点:终点:步长(含终点) 20:100:10"""
+    if ':' in text:
+        begin, end, step = (Decimal(v) for v in text.split(':'))
+        values = list()
+        while begin <= end:
+            values.append(cast(begin))
+            begin += step
+        return values
+    return [cast(Decimal(v)) for v in text.split(',')]
+
+
+def current_space(param: StrategyParam) -> dict:
+    """只包含当前参数的参数空间, 命令行没有指定的参数保持不变"""
+    return {name: [value] for name, value in asdict(param).items()}
@@ -0,0 +1,158 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+品种组合选择: 从全部品种中选出 n 个, 使两两相关系数平方的均值最小
+得分与原 find_best_score 相同: (round((1 - mean(corr^2)) * 100, 3) - 50) * 2, 相关系数为 NaN 的品种对不参与平均
+
+组合数太多无法穷举, 这里维护每个品种与当前组合的相关系数平方和, 加入/移除/交换一个品种时 O(1) 更新得分:
+- greedy: 从相关性最低的一对开始, 每次加入使均值最小的品种
+- local: 贪心结果加随机初始组合, 反复做最优交换直到无法改进, 在时间预算内多次重启
+- beam: 逐个加入品种, 每层保留最好的 beam_width 个部分组合
+"""
+import time
+import random
+import heapq
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('Portfolio')
+
+
+def portfolio_score(mean_sq: float) -> float:
+    return (round((1 - mean_sq) * 100, 3) - 50) * 2
+
+
+class PortfolioSelector:
+    def __init__(self, corr: pd.DataFrame):
+        """
+        :param corr: 相关系数矩阵, 行列为品种代码, 见 calc_corr
+        """
+        self.codes = list(corr.columns)
+        value = corr.to_numpy(dtype=float)
+        valid = np.isfinite(value)
+        np.fill_diagonal(valid, False)
+        self.sq = np.where(valid, value ** 2, 0.0)  # 相关系数平方, 无效为0
+        self.cnt = valid.astype(float)  # 有效的品种对
+        self.size = len(self.codes)
+
+    def mean_sq(self, index_list) -> float:
+        idx = np.asarray(index_list)
+        count = self.cnt[np.ix_(idx, idx)].sum()
+        return self.sq[np.ix_(idx, idx)].sum() / count if count else 1.0
+
+    def _result(self, index_list) -> tuple:
+        index_list = sorted(index_list)
+        return portfolio_score(self.mean_sq(index_list)), tuple(self.codes[i] for i in index_list)
+
+    def greedy(self, n: int, start: list = None) -> list:
+        """从 start(默认为相关性最低的一对)开始, 每次加入使均值最小的品种"""
+        if start is None:
+            masked = np.where(self.cnt > 0, self.sq, np.inf)
+            start = np.unravel_index(np.argmin(masked), masked.shape)
+        selected = [int(i) for i in start]
+        row_sq = self.sq[selected].sum(axis=0)  # 每个品种与当前组合的相关系数平方和
+        row_cnt = self.cnt[selected].sum(axis=0)
+        total_sq, total_cnt = row_sq[selected].sum() / 2, row_cnt[selected].sum() / 2
+        while len(selected) < n:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.where(total_cnt + row_cnt > 0, (total_sq + row_sq) / (total_cnt + row_cnt), 1.0)
+            mean[selected] = np.inf
+            best = int(np.argmin(mean))
+            selected.append(best)
+            total_sq += row_sq[best]
+            total_cnt += row_cnt[best]
+            row_sq += self.sq[best]
+            row_cnt += self.cnt[best]
+        return selected
+
+    def improve(self, selected: list, deadline: float = None) -> list:
+        """反复做使均值下降最多的一次交换(移出一个, 加入一个), 直到无法改进或超过 deadline"""
+        in_set = np.zeros(self.size, dtype=bool)
+        in_set[selected] = True
+        row_sq = self.sq[in_set].sum(axis=0)
+        row_cnt = self.cnt[in_set].sum(axis=0)
+        total_sq = row_sq[in_set].sum() / 2
+        total_cnt = row_cnt[in_set].sum() / 2
+        while deadline is None or time.monotonic() < deadline:
+            inside = np.flatnonzero(in_set)
+            outside = np.flatnonzero(~in_set)
+            if len(outside) == 0:
+                break
+            # 移出 i 加入 j 后: 总和 - row[i] + row[j] - m[i, j]
+            new_sq = total_sq - row_sq[inside][:, None] + row_sq[outside][None, :] - self.sq[np.ix_(inside, outside)]
+            new_cnt = total_cnt - row_cnt[inside][:, None] + row_cnt[outside][None, :] - self.cnt[np.ix_(inside, outside)]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.where(new_cnt > 0, new_sq / new_cnt, 1.0)
+            k = int(np.argmin(mean))
+            current = total_sq / total_cnt if total_cnt else 1.0
+            if mean.flat[k] >= current - 1e-12:
+                break
+            i, j = inside[k // len(outside)], outside[k % len(outside)]
+            in_set[i], in_set[j] = False, True
+            total_sq, total_cnt = new_sq.flat[k], new_cnt.flat[k]
+            row_sq += self.sq[j] - self.sq[i]
+            row_cnt += self.cnt[j] - self.cnt[i]
+        return np.flatnonzero(in_set).tolist()
+
+    def local_search(self, n: int, time_budget: float = 10, top_k: int = 5, seed: int = None) -> list:
+        """贪心结果和随机组合作为起点做交换改进, 直到用完时间预算"""
+        rng = random.Random(seed)
+        deadline = time.monotonic() + time_budget
+        found = dict()
+        start = self.greedy(n)
+        while True:
+            selected = self.improve(start, deadline)
+            found[tuple(sorted(selected))] = self.mean_sq(selected)
+            if time.monotonic() >= deadline:
+                break
+            start = rng.sample(range(self.size), n)
+        return [self._result(index_list) for index_list in heapq.nsmallest(top_k, found, key=found.get)]
+
+    def beam_search(self, n: int, beam_width: int = 50, top_k: int = 5, time_budget: float = None) -> list:
+        """逐个加入品种, 每层只保留均值最小的 beam_width 个部分组合, 超出时间预算时把当前的部分组合贪心补足"""
+        deadline = time.monotonic() + time_budget if time_budget else None
+        beam = {(i,): (0.0, 0.0) for i in range(self.size)}  # {有序下标元组: (相关系数平方和, 有效对数)}
+        while len(next(iter(beam))) < n:
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.info('beam_search 超出时间预算, 用当前结果贪心补足')
+                beam = {tuple(sorted(self.greedy(n, list(index_tuple)))): None for index_tuple in beam}
+                break
+            candidate = dict()
+            for index_tuple, (total_sq, total_cnt) in beam.items():
+                idx = list(index_tuple)
+                new_sq = total_sq + self.sq[idx].sum(axis=0)
+                new_cnt = total_cnt + self.cnt[idx].sum(axis=0)
+                for j in range(self.size):
+                    if j not in index_tuple:
+                        candidate[tuple(sorted(index_tuple + (j,)))] = (new_sq[j], new_cnt[j])
+            beam = dict(heapq.nsmallest(beam_width, candidate.items(),
+                                        key=lambda item: item[1][0] / item[1][1] if item[1][1] else 1.0))
+        return sorted((self._result(index_tuple) for index_tuple in beam), reverse=True)[:top_k]
+
+    def select(self, n: int, method: str = 'local', time_budget: float = 10, top_k: int = 5,
+               beam_width: int = 50, seed: int = None) -> list:
+        """
+        :return: [(得分, (品种代码, ...))], 得分从高到低
+        """
+        if n >= self.size:
+            return [self._result(range(self.size))]
+        if method == 'greedy':
+            return [self._result(self.greedy(n))]
+        if method == 'beam':
+            return self.beam_search(n, beam_width, top_k, time_budget)
+        return self.local_search(n, time_budget, top_k, seed)
@@ -0,0 +1,46 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import time
+import asyncio
+
+
+class TokenBucket:
+    """
+    令牌桶限速: 每秒补充 rate 个令牌, 最多攒 capacity 个, 每次请求消耗一个
+    用于遵守CTP的查询流控(默认每秒1次)
+    """
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    async def acquire(self):
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        # 加锁保证按到达顺序发放令牌
+        async with self.__lock:
+            self._refill()
+            if self.__tokens < 1:
+                await asyncio.sleep((1 - self.__tokens) / self.rate)
+                self._refill()
+            self.__tokens -= 1
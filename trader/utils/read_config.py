@@ -29,10 +29,68 @@ trade_response_format = MSG:CTP:RSP:TRADE:{}:{}
 market_response_prefix = MSG:CTP:RSP:MARKET:
 market_response_format = MSG:CTP:RSP:MARKET:{}:{}
 weixin_log = MSG:LOG:WEIXIN
+# 消息编码: json, msgpack(需要安装 msgpack) 或 struct(行情按固定二进制布局, 其他消息为 JSON), 需要与网关一致
+codec = json
+# 回报的接收方式: pubsub 或 stream
+# stream 方式下网关把 MSG:CTP:RSP:TRADE:OnRtnTrade:<key> 的回报 XADD 到 MSG:CTP:RSP:TRADE:OnRtnTrade, 字段为 channel 和 data
+# 查询应答仍然走 pubsub
+transport = pubsub
+stream_group = trader
+# stream_consumer = TradeStrategy
+# 每次最多读取的消息数, 以及没有消息时阻塞等待的毫秒数
+stream_count = 100
+stream_block = 1000
+# 消费组第一次创建时开始读取的位置: $ 只读之后的新回报, 0 从 stream 中最早的回报开始(会重新处理全部历史成交)
+stream_start = $
 
 [TRADE]
 command_timeout = 5
 ignore_inst = WH,bb,JR,RI,RS,LR,PM,im
+# 检查策略参数是否被修改的间隔(秒)
+param_check_interval = 60
+# CTP查询流控: 每秒查询次数、可累积的次数, 以及更新合约时同时查询的品种数
+query_rate = 1
+query_burst = 1
+query_concurrency = 4
+
+[EVENT_LOOP]
+# 回调中访问数据库的线程数
+db_workers = 4
+# 事件循环被阻塞超过该时间(秒)时打印调用栈, 0 表示不检查
+block_threshold = 0.5
+
+[HTTP]
+limit = 100
+limit_per_host = 5
+dns_cache = 600
+keepalive = 60
+timeout = 30
+retry = 3
+backoff = 1.0
+cache = true
+# 当天这个时间(点)以后下载的交易所数据视为定稿, 之前下载的会重新做条件请求
+final_hour = 17
+# 离线回放: 指定后 collect_quote 从该目录(格式同 ~/.cache/trader/exchange)读取交易所数据
+# replay_dir = /data/exchange
+
+[BACKFILL]
+shfe = 3
+dce = 3
+czce = 3
+cffex = 3
+gfex = 3
+queue_size = 50
+batch_size = 20
+parse_workers = 4
+
+[TRADING_CALENDAR]
+# 节假日文件, 每行一个 YYYYMMDD, 用于推算日线数据范围以外的交易日
+# holiday_file = /data/holidays.txt
+
+[CORRELATION]
+# 相关系数的窗口(交易日)和指数加权的半衰期(交易日)
+window = 730
+halflife = 120
 
 [REDIS]
 host = 127.0.0.1
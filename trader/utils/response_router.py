@@ -0,0 +1,160 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import asyncio
+import logging
+from collections import defaultdict, deque
+
+import aioredis
+
+from trader.utils.codec import Codec, JsonCodec
+
+logger = logging.getLogger('ResponseRouter')
+
+
+class PendingRequest:
+    """
+    等待应答的请求, 在任意一个频道上收到 bIsLast 为真(或没有 bIsLast)的消息时完成
+    """
+    def __init__(self, channels: list, match: dict = None):
+        """
+        :param match: {频道: {字段: 值}}, 该频道上的消息带有这些字段时, 字段值相同才属于本请求
+        """
+        self.channels = channels
+        self.match = match if match else dict()
+        self.msg_list = list()
+        self.future = asyncio.get_running_loop().create_future()
+
+    def accept(self, channel: str, msg_dict: dict) -> bool:
+        if self.future.done():
+            return False
+        for key, value in self.match.get(channel, dict()).items():
+            if key in msg_dict and msg_dict[key] != value:
+                return False
+        return True
+
+    def feed(self, msg_dict: dict):
+        if 'empty' not in msg_dict or not msg_dict['empty']:
+            self.msg_list.append(msg_dict)
+        if ('bIsLast' not in msg_dict or msg_dict['bIsLast']) and not self.future.done():
+            self.future.set_result(self.msg_list)
+
+
+class ResponseRouter:
+    """
+    常驻的CTP应答订阅: 启动时 psubscribe 一次应答频道, 收到的消息按频道名分发给等待中的请求
+    一次请求只需要登记频道、publish、等待 future, 不再为每个请求建立和关闭订阅连接
+
+    同一频道可以有多个请求在等待(如行情订阅、撤单的应答频道编号都是0):
+        消息交给按登记顺序第一个接受它的请求, 登记时可以用 match 按消息内容区分(如撤单按 OrderRef)
+        没有可区分字段的频道按先进先出分发, 这要求网关按请求的顺序应答, 否则调用方需要自己串行发送请求
+    使用二进制 codec 时 redis_client 不能 decode_responses
+    """
+    def __init__(self, redis_client: aioredis.Redis, patterns: list, codec: Codec = None):
+        self.redis_client = redis_client
+        self.patterns = patterns
+        self.codec = codec if codec else JsonCodec()
+        self.__pending = defaultdict(deque)  # {channel: deque([PendingRequest])}
+        self.__pubsub = None
+        self.__task = None
+
+    async def start(self):
+        self.__pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        await self.__pubsub.psubscribe(*self.patterns)
+        self.__task = asyncio.create_task(self._reader())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        if self.__pubsub is not None:
+            try:
+                await self.__pubsub.punsubscribe()
+                await self.__pubsub.close()
+            except Exception as e:
+                logger.warning(f'关闭应答订阅发生错误: {repr(e)}')
+            self.__pubsub = None
+        for queue in self.__pending.values():
+            for request in queue:
+                request.future.cancel()
+        self.__pending.clear()
+
+    async def _reader(self):
+        while True:
+            try:
+                async for msg in self.__pubsub.listen():
+                    if msg['type'] != 'pmessage':
+                        continue
+                    channel = msg['channel'].decode() if self.codec.binary else msg['channel']
+                    queue = self.__pending.get(channel)
+                    if not queue:
+                        continue
+                    msg_dict = self.codec.decode(channel, msg['data'])
+                    for request in list(queue):
+                        if request.accept(channel, msg_dict):
+                            request.feed(msg_dict)
+                            if request.future.done():
+                                self.unregister(request)
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 连接断开时重新订阅, 等待中的请求会各自超时
+                logger.warning(f'应答订阅发生错误, 1秒后重连: {repr(e)}', exc_info=True)
+                await asyncio.sleep(1)
+                try:
+                    await self.__pubsub.close()
+                except Exception as ee:
+                    logger.warning(f'关闭应答订阅发生错误: {repr(ee)}')
+                try:
+                    self.__pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                    await self.__pubsub.psubscribe(*self.patterns)
+                except Exception as ee:
+                    logger.warning(f'重新订阅应答频道失败: {repr(ee)}')
+
+    def register(self, channels: list, match: dict = None) -> PendingRequest:
+        request = PendingRequest(channels, match)
+        for channel in channels:
+            self.__pending[channel].append(request)
+        return request
+
+    def unregister(self, request: PendingRequest):
+        for channel in request.channels:
+            queue = self.__pending.get(channel)
+            if queue is None:
+                continue
+            try:
+                queue.remove(request)
+            except ValueError:
+                pass
+            if not queue:
+                del self.__pending[channel]
+
+    async def request(self, channels: list, request_channel: str, data, timeout: float, match: dict = None) -> list:
+        """
+        先登记应答频道再发布请求, 等待全部应答
+        :param channels: 应答频道(完整的频道名)
+        :param request_channel: 请求频道
+        :param data: 请求内容, 用 codec 编码
+        :param timeout: 超时时间(秒), 超时抛出 asyncio.TimeoutError
+        :param match: 共用频道上区分本请求应答的字段, 见 PendingRequest
+        :return: 收到的应答列表, 不含 empty 的消息
+        """
+        request = self.register(channels, match)
+        try:
+            await self.redis_client.publish(request_channel, self.codec.encode(request_channel, data))
+            return await asyncio.wait_for(request.future, timeout)
+        finally:
+            self.unregister(request)
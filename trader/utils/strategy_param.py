@@ -0,0 +1,84 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import time
+import logging
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.db.models import Max, Count
+
+from panel.models import Strategy, Param
+from trader.utils.read_config import config
+
+logger = logging.getLogger('StrategyParam')
+
+
+@dataclass(frozen=True)
+class StrategyParam:
+    """大哥2.0 策略参数, 对应 Param 表中的各行"""
+    break_n: int  # BreakPeriod: 突破周期
+    atr_n: int  # AtrPeriod: ATR周期
+    long_n: int  # LongPeriod: 长期均线周期
+    short_n: int  # ShortPeriod: 短期均线周期
+    stop_n: int  # StopLoss: 止损ATR倍数
+    risk: Decimal  # Risk: 风险因子
+
+    @classmethod
+    def from_params(cls, param_list) -> 'StrategyParam':
+        param_dict = {param.code: param for param in param_list}
+        return cls(break_n=param_dict['BreakPeriod'].int_value, atr_n=param_dict['AtrPeriod'].int_value,
+                   long_n=param_dict['LongPeriod'].int_value, short_n=param_dict['ShortPeriod'].int_value,
+                   stop_n=param_dict['StopLoss'].int_value, risk=param_dict['Risk'].float_value)
+
+
+class ParamCache:
+    """
+    策略参数缓存, 避免每个品种都查询一遍 Param 表
+    距上次检查超过 check_interval 秒时, 用 max(update_time) 和行数判断参数是否被修改过, 修改过才重新加载
+    """
+    def __init__(self, check_interval: float = None):
+        self.check_interval = check_interval if check_interval is not None else \
+            config.getfloat('TRADE', 'param_check_interval', fallback=60)
+        self.__cache = dict()  # {strategy_id: (version, checked_at, StrategyParam)}
+
+    @staticmethod
+    def _version(strategy_id: int) -> tuple:
+        rst = Param.objects.filter(strategy_id=strategy_id).aggregate(update_time=Max('update_time'), count=Count('id'))
+        return rst['update_time'], rst['count']
+
+    def get(self, strategy: Strategy) -> StrategyParam:
+        cached = self.__cache.get(strategy.id)
+        now = time.monotonic()
+        if cached is not None and now - cached[1] < self.check_interval:
+            return cached[2]
+        version = self._version(strategy.id)
+        if cached is not None and cached[0] == version:
+            param = cached[2]
+        else:
+            param = StrategyParam.from_params(Param.objects.filter(strategy_id=strategy.id))
+            if cached is not None:
+                logger.info(f'{strategy} 参数已更新: {param}')
+        self.__cache[strategy.id] = (version, now, param)
+        return param
+
+    def invalidate(self, strategy: Strategy = None):
+        if strategy is None:
+            self.__cache.clear()
+        else:
+            self.__cache.pop(strategy.id, None)
+
+
+param_cache = ParamCache()
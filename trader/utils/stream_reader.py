@@ -0,0 +1,141 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+用 Redis Streams 接收CTP回报, 见 [MSG_CHANNEL] transport = stream
+
+约定: 订阅模式 MSG:CTP:RSP:TRADE:OnRtnTrade:* 对应的 stream 为去掉结尾 :* 的 MSG:CTP:RSP:TRADE:OnRtnTrade,
+网关对每条回报执行 XADD <stream> * channel <完整频道名> data <消息内容>
+
+用消费组读取: 每次 XREADGROUP 最多读 count 条, 这一批的回调全部完成后再读下一批(背压), 回调成功的消息才 XACK
+程序重启时先重新处理本消费者已读取但没有确认的消息, 再从消费组记录的位置继续读取, 重启期间的回报不会丢失
+消费组第一次创建时默认只读取之后的新回报([MSG_CHANNEL] stream_start = $), 不会把 stream 中的历史回报再处理一遍
+"""
+import asyncio
+import logging
+
+import aioredis
+from aioredis.exceptions import ResponseError
+
+from trader.utils.channel import pattern_prefix
+
+logger = logging.getLogger('StreamReader')
+
+
+def stream_key(pattern: str) -> str:
+    """订阅模式对应的 stream 名"""
+    return pattern_prefix(pattern)
+
+
+def _text(value) -> str:
+    # 二进制 codec 使用的客户端不 decode_responses, stream 名和字段名是 bytes
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class StreamReader:
+    def __init__(self, redis_client: aioredis.Redis, patterns: list, group: str, consumer: str,
+                 count: int = 100, block: int = 1000, start: str = '$'):
+        """
+        :param patterns: 订阅模式, 每个模式对应一个 stream
+        :param group: 消费组名称
+        :param consumer: 本消费者名称, 重启后名称不变才能取回未确认的消息
+        :param count: 每次最多读取的消息数
+        :param block: 没有新消息时阻塞等待的毫秒数
+        :param start: 消费组第一次创建时开始读取的消息ID, $ 为只读新消息, 0 为从头读取
+        """
+        self.redis_client = redis_client
+        self.streams = {stream_key(pattern): pattern for pattern in patterns}
+        self.group = group
+        self.consumer = consumer
+        self.count = count
+        self.block = block
+        self.start = start
+
+    async def create_group(self):
+        for stream in self.streams:
+            try:
+                # 消费组第一次创建时从 start 开始读取, 之后由 Redis 记录读取位置
+                await self.redis_client.xgroup_create(stream, self.group, id=self.start, mkstream=True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    async def _process(self, response: list, callback) -> int:
+        """
+        处理一次 XREADGROUP 的结果, 同一批的回调并发执行
+        :param callback: async callback(pattern, channel, data), data 为未解码的消息内容
+        :return: 处理的消息数
+        """
+        id_list = list()
+        task_list = list()
+        for stream, entries in response:
+            stream = _text(stream)
+            for msg_id, fields in entries:
+                id_list.append((stream, msg_id))
+                if not fields:  # 已被删除的消息, 直接确认
+                    task_list.append(asyncio.sleep(0))
+                    continue
+                fields = {_text(key): value for key, value in fields.items()}
+                task_list.append(callback(self.streams[stream], _text(fields['channel']), fields['data']))
+        result = await asyncio.gather(*task_list, return_exceptions=True)
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for (stream, msg_id), rst in zip(id_list, result):
+                if isinstance(rst, Exception):
+                    # 不确认, 重启后重新处理
+                    logger.warning(f'处理 {stream} 消息 {msg_id} 发生错误: {repr(rst)}', exc_info=rst)
+                else:
+                    pipe.xack(stream, self.group, msg_id)
+            await pipe.execute()
+        return len(id_list)
+
+    async def replay_pending(self, callback):
+        """重新处理本消费者上次退出前读取但没有确认的消息"""
+        last_id = {stream: '0' for stream in self.streams}
+        while last_id:
+            response = await self.redis_client.xreadgroup(self.group, self.consumer, last_id, count=self.count)
+            returned = {_text(stream): entries for stream, entries in response} if response else dict()
+            for stream in list(last_id):
+                if returned.get(stream):
+                    last_id[stream] = returned[stream][-1][0]
+                else:
+                    del last_id[stream]
+            count = await self._process(response, callback) if response else 0
+            if count:
+                logger.info(f'重新处理了{count}条未确认的消息')
+
+    async def run(self, callback):
+        # 启动时 Redis 可能还不可用, 与读取循环一样出错后重试
+        while True:
+            try:
+                await self.create_group()
+                await self.replay_pending(callback)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'创建消费组或处理未确认消息发生错误, 1秒后重试: {repr(e)}', exc_info=True)
+                await asyncio.sleep(1)
+        new_id = {stream: '>' for stream in self.streams}
+        while True:
+            try:
+                response = await self.redis_client.xreadgroup(
+                    self.group, self.consumer, new_id, count=self.count, block=self.block)
+                if response:
+                    await self._process(response, callback)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'读取回报 stream 发生错误, 1秒后重试: {repr(e)}', exc_info=True)
+                await asyncio.sleep(1)
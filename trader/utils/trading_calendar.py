@@ -0,0 +1,182 @@
+# coding=utf-8
+#
+# Copyright 2016 timercrack
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import bisect
+import datetime
+import logging
+
+import redis
+
+from panel.models import MainBar
+from trader.utils.read_config import config
+
+logger = logging.getLogger('TradingCalendar')
+
+
+def to_date(day) -> datetime.date:
+    return day.date() if isinstance(day, datetime.datetime) else day
+
+
+class TradingCalendar:
+    """
+    进程内缓存的交易日历
+
+    数据来源, 每天第一次使用时自动重新加载:
+    1. MainBar 中出现过的全部日期(time 上有索引, 比扫描 DailyBar 快得多, 每个交易日都会生成主力连续K线)
+    2. 节假日文件 [TRADING_CALENDAR] holiday_file, 每行一个 YYYYMMDD, # 开头为注释
+    3. Redis 中 CTP 写入的 TradingDay/LastTradingDay
+    已知区间 [第一根K线, 今天或TradingDay] 内严格按实际交易日判断,
+    区间以外按 "工作日且不在节假日文件中" 推算。
+    """
+    def __init__(self, holiday_file: str = None):
+        self.holiday_file = holiday_file if holiday_file else config.get('TRADING_CALENDAR', 'holiday_file', fallback=None)
+        self.__redis = None
+        self.__loaded = None
+        self.__days = list()  # 已知交易日, 升序
+        self.__day_set = set()
+        self.__holidays = set()
+        self.__first = None
+        self.__last = None
+
+    def _get_redis(self) -> redis.StrictRedis:
+        if self.__redis is None:
+            self.__redis = redis.StrictRedis(
+                host=config.get('REDIS', 'host', fallback='localhost'),
+                port=config.getint('REDIS', 'port', fallback=6379),
+                db=config.getint('REDIS', 'db', fallback=0), decode_responses=True)
+        return self.__redis
+
+    def load_holidays(self) -> set:
+        holidays = set()
+        if not self.holiday_file:
+            return holidays
+        try:
+            with open(self.holiday_file) as f:
+                for line in f:
+                    line = line.split('#', 1)[0].strip()
+                    if line:
+                        holidays.add(datetime.datetime.strptime(line, '%Y%m%d').date())
+        except Exception as e:
+            logger.warning(f'读取节假日文件 {self.holiday_file} 失败: {repr(e)}', exc_info=True)
+        return holidays
+
+    def refresh(self):
+        today = datetime.date.today()
+        day_set = set(MainBar.objects.order_by().values_list('time', flat=True).distinct())
+        last = max(day_set) if day_set else None
+        try:
+            redis_days = [day for day in self._get_redis().mget('TradingDay', 'LastTradingDay') if day]
+            for day in redis_days:
+                day_set.add(datetime.datetime.strptime(day, '%Y%m%d').date())
+            # Redis 中的交易日是CTP给出的, 可以确定今天以前(含)哪些天没有交易
+            if redis_days:
+                last = max(day_set | {today})
+        except Exception as e:
+            logger.warning(f'从Redis读取交易日失败: {repr(e)}', exc_info=True)
+        self.__holidays = self.load_holidays()
+        self.__day_set = day_set
+        self.__days = sorted(day_set)
+        self.__first = self.__days[0] if self.__days else None
+        self.__last = last
+        self.__loaded = today
+        logger.debug(f'交易日历加载完成: {self.__first} ~ {self.__last}, 共{len(self.__days)}个交易日')
+
+    def _ensure_loaded(self):
+        if self.__loaded != datetime.date.today():
+            self.refresh()
+
+    def add(self, day):
+        """外部确认过的交易日(如回补时从交易所探测到的)"""
+        self._ensure_loaded()
+        day = to_date(day)
+        if day not in self.__day_set:
+            self.__day_set.add(day)
+            bisect.insort(self.__days, day)
+
+    def is_confirmed(self, day) -> bool:
+        """day 确定是交易日(有K线或CTP给出), 不是推算的"""
+        self._ensure_loaded()
+        return to_date(day) in self.__day_set
+
+    def is_holiday(self, day) -> bool:
+        self._ensure_loaded()
+        day = to_date(day)
+        return day.isoweekday() >= 6 or day in self.__holidays
+
+    def is_trading_day(self, day) -> bool:
+        self._ensure_loaded()
+        day = to_date(day)
+        if day in self.__day_set:
+            return True
+        if self.__first is not None and self.__first <= day <= self.__last:
+            return False
+        return day.isoweekday() < 6 and day not in self.__holidays
+
+    def next_trading_day(self, day) -> datetime.date:
+        """day 之后(不含)的第一个交易日"""
+        self._ensure_loaded()
+        day = to_date(day)
+        if self.__last is None or day >= self.__last:
+            return self._guess(day, 1)
+        idx = bisect.bisect_right(self.__days, day)
+        if day < self.__first:
+            # 已知区间以前, 先推算, 推算结果超出区间时取第一个已知交易日
+            guess = self._guess(day, 1)
+            return guess if guess < self.__first else self.__days[0]
+        if idx < len(self.__days):
+            return self.__days[idx]
+        return self._guess(self.__last, 1)
+
+    def prev_trading_day(self, day) -> datetime.date:
+        """day 之前(不含)的最后一个交易日"""
+        self._ensure_loaded()
+        day = to_date(day)
+        if self.__first is None or day <= self.__first:
+            return self._guess(day, -1)
+        if day > self.__last:
+            guess = self._guess(day, -1)
+            if guess > self.__last:
+                return guess
+            day = self.__last + datetime.timedelta(days=1)
+        idx = bisect.bisect_left(self.__days, day)
+        return self.__days[idx - 1]
+
+    def trading_days_between(self, start, end) -> list:
+        """[start, end] 之间(含两端)的全部交易日, 升序"""
+        self._ensure_loaded()
+        start, end = to_date(start), to_date(end)
+        day_list = list()
+        day = start
+        while self.__first is not None and day < self.__first and day <= end:
+            if self.is_trading_day(day):
+                day_list.append(day)
+            day += datetime.timedelta(days=1)
+        if self.__last is not None:
+            day_list += self.__days[bisect.bisect_left(self.__days, day):bisect.bisect_right(self.__days, min(end, self.__last))]
+            day = max(day, self.__last + datetime.timedelta(days=1))
+        while day <= end:
+            if self.is_trading_day(day):
+                day_list.append(day)
+            day += datetime.timedelta(days=1)
+        return day_list
+
+    def _guess(self, day: datetime.date, step: int) -> datetime.date:
+        day += datetime.timedelta(days=step)
+        while day.isoweekday() >= 6 or day in self.__holidays:
+            day += datetime.timedelta(days=step)
+        return day
+
+
+trading_calendar = TradingCalendar()